@@ -29,6 +29,19 @@ class bbone_provider:
         """
         pass
 
+    @abstractmethod
+    def get_host_changes(self, since):
+        """
+        Returns the ids of the hosts whose state changed after the specified
+        revision, along with the status timestamps of all hosts.
+        :param int since: revision returned by a previous call, 0 to get
+                          all hosts
+        :return: dictionary with the current 'revision', the 'changed' host
+                 ids and the 'timestamps' of all hosts, keyed by host id
+        :rtype: dict
+        """
+        pass
+
     @abstractmethod
     def set_host_apps(self, id, apps_config):
         """
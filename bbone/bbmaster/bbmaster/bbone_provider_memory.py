@@ -7,6 +7,42 @@ This module is a mock implementation of the backbone provider interface.
 
 from bbmaster.bbone_provider import bbone_provider
 from datetime import datetime
+import time
+
+_TIMESTAMP_KEYS = ('timestamp', 'timestamp_on_du')
+
+# Host agent extensions whose data changes with every status message, like
+# the resource usage and load average. resmgr doesn't act on them, a change
+# to them alone doesn't make a host changed.
+VOLATILE_EXTENSIONS = ('resource_usage', 'cpu_stats')
+
+# Minimum seconds between two reports of a change to the volatile extensions
+# of a host in the changes feed
+METRICS_REVISION_PERIOD = 60
+
+def _revisioned_state(host_state):
+    """
+    :return: the part of the state of a host that its revision tracks
+    :rtype: dict
+    """
+    state = dict((k, v) for k, v in host_state.items()
+                 if k not in _TIMESTAMP_KEYS)
+    extensions = state.get('extensions')
+    if isinstance(extensions, dict):
+        state['extensions'] = dict((k, v) for k, v in extensions.items()
+                                   if k not in VOLATILE_EXTENSIONS)
+    return state
+
+def _volatile_state(host_state):
+    """
+    :return: the volatile extensions of a host
+    :rtype: dict
+    """
+    extensions = host_state.get('extensions')
+    if not isinstance(extensions, dict):
+        return {}
+    return dict((k, v) for k, v in extensions.items()
+                if k in VOLATILE_EXTENSIONS)
 
 class bbone_provider_memory(bbone_provider):
     """Mock provider class. Works off mock data loaded in memory"""
@@ -15,6 +51,18 @@ class bbone_provider_memory(bbone_provider):
         self.hosts = {}
         self.desired_apps = {}
         self.host_agents = {}
+        # Revision of the hosts table, bumped whenever the state of a host
+        # changes. Seeded from the clock so that it keeps increasing across
+        # restarts.
+        self.revision = int(time.time() * 1000)
+        self.host_revisions = {}
+        # Revision at which the volatile extensions of each host were last
+        # reported as changed, and when
+        self.host_metrics_revisions = {}
+        self.host_metrics_times = {}
+        # Sequence number of the last status message of each host that
+        # sends status deltas
+        self.host_seqs = {}
 
     def get_host_ids(self):
         """
@@ -30,6 +78,90 @@ class bbone_provider_memory(bbone_provider):
             id_list = [host_id for host_id in self.hosts]
         return [self.hosts[id] for id in id_list if id in self.hosts]
 
+    def get_host_changes(self, since):
+        if since > self.revision:
+            # The revision went backwards, e.g. the clock was reset before a
+            # restart. Report every host as changed.
+            since = 0
+        changed = [id for id, revision in self.host_revisions.items()
+                   if revision > since]
+        metrics_changed = [id for id, revision
+                           in self.host_metrics_revisions.items()
+                           if revision > since and
+                           self.host_revisions.get(id, 0) <= since]
+        timestamps = dict((id, dict((k, host.get(k)) for k in _TIMESTAMP_KEYS))
+                          for id, host in self.hosts.items())
+        return {
+            'revision': self.revision,
+            'changed': changed,
+            'metrics_changed': metrics_changed,
+            'timestamps': timestamps
+        }
+
+    def update_host(self, id, host_state, seq=None):
+        """
+        Store the state reported for a host. The host's revision is bumped
+        only if something other than the status timestamps and the volatile
+        extensions changed. A change to the volatile extensions alone is
+        reported in the metrics_changed hosts of the changes feed, at most
+        every METRICS_REVISION_PERIOD seconds.
+        :param str id: ID of the host
+        :param dict host_state: state of the host
+        :param int seq: sequence number of the host's status message, if any
+        :return: True if the host's revision was bumped
+        :rtype: bool
+        """
+        old_state = self.hosts.get(id)
+        self.hosts[id] = host_state
+        if seq is None:
+            self.host_seqs.pop(id, None)
+        else:
+            self.host_seqs[id] = seq
+        now = time.time()
+        if old_state is None or \
+                _revisioned_state(old_state) != _revisioned_state(host_state):
+            self.revision += 1
+            self.host_revisions[id] = self.revision
+            self.host_metrics_times[id] = now
+            return True
+        if _volatile_state(old_state) != _volatile_state(host_state) and \
+                now - self.host_metrics_times.get(id, 0) >= \
+                METRICS_REVISION_PERIOD:
+            self.revision += 1
+            self.host_metrics_revisions[id] = self.revision
+            self.host_metrics_times[id] = now
+        return False
+
+    def apply_host_delta(self, id, seq, delta, removed=(),
+                         removed_extensions=()):
+        """
+        Computes the state of a host from a status delta message.
+        :param str id: ID of the host
+        :param int seq: sequence number of the message
+        :param dict delta: the fields of the host state that changed. Its
+            extensions are only the extensions that changed.
+        :param list removed: the fields of the host state that were removed
+        :param list removed_extensions: the names of the extensions that
+            were removed
+        :return: the new state of the host, or None if the delta doesn't
+            directly follow the last status message of the host, which means
+            a full status is needed.
+        :rtype: dict
+        """
+        if id not in self.hosts or self.host_seqs.get(id) != seq - 1:
+            return None
+        host_state = dict(self.hosts[id])
+        if 'extensions' in delta or removed_extensions:
+            extensions = dict(host_state.get('extensions') or {})
+            extensions.update(delta.get('extensions') or {})
+            for name in removed_extensions:
+                extensions.pop(name, None)
+            delta = dict(delta, extensions=extensions)
+        host_state.update(delta)
+        for key in removed:
+            host_state.pop(key, None)
+        return host_state
+
     def set_host_apps(self, id, apps_config):
         """
         Update the desired app config of the host.
@@ -38,12 +170,12 @@ class bbone_provider_memory(bbone_provider):
             # timestamps are required in resmgr for its 'responding' calculation
             a_long_time_ago = \
                 datetime.fromtimestamp(0).strftime("%Y-%m-%d %H:%M:%S.%f")
-            self.hosts[id] = {
+            self.update_host(id, {
                 'host_id': id,
                 'status': 'missing',
                 'timestamp': a_long_time_ago,
                 'timestamp_on_du': a_long_time_ago
-            }
+            })
         self.desired_apps[id] = apps_config
 
     def set_host_agent_config(self, host_id, agent_config):
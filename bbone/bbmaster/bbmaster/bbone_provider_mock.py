@@ -18,6 +18,7 @@ class bbone_provider_mock(bbone_provider_memory):
 
     def load_test_data(self, test_data):
         self.hosts = test_data
+        self.host_revisions = dict((id, self.revision) for id in test_data)
 
     def set_host_apps(self, id, apps_config):
         """
@@ -12,20 +12,28 @@ import threading
 from bbcommon import constants
 from bbcommon.amqp import io_loop
 from bbcommon.exceptions import HostNotFound
+from bbcommon.messages import encode_msg, decode_msg, choose_encoding
 from bbcommon.utils import is_satisfied_by, get_ssl_options
 import base64
 import logging
-import json
+import notifier
 import os
 import pika
 import requests
 import socket
 import time
 import copy
+import collections
 from bbmaster.pf9_firmware_apps import (get_fw_apps_cfg,
     insert_fw_apps_config, remove_fw_apps_config)
 from pika.exceptions import AMQPConnectionError
 from bbmaster.file_writer import FileWriterS3
+from bbmaster.support_transfer import SupportTransfer
+
+# Seconds without progress after which the missing chunks of a support
+# bundle are requested again, and how many times
+SUPPORT_TRANSFER_TIMEOUT = 60
+SUPPORT_TRANSFER_RETRIES = 5
 
 class bbone_provider_pf9(bbone_provider_memory):
     """
@@ -49,6 +57,13 @@ class bbone_provider_pf9(bbone_provider_memory):
         self.support_dir_location = self.config.get('bbmaster',
                                                     'support_file_store')
         self.pending_msgs = []
+        # Message encodings each host can decode, from its last message
+        self.host_encodings = {}
+        # Support bundles being received in chunks, by (host id, sha256).
+        # Only used in the I/O thread.
+        self.support_transfers = {}
+        # The last completed ones, to ignore chunks that were sent again
+        self.completed_support_transfers = collections.deque(maxlen=100)
 
         self.global_config = ConfigParser()
         global_conf = os.environ.get('GLOBAL_CONFIG_FILE',
@@ -60,6 +75,9 @@ class bbone_provider_pf9(bbone_provider_memory):
         else:
             self.is_ddu = False
         self.firmware_apps_config = get_fw_apps_cfg(config=self.config, is_ddu=self.is_ddu)
+        # Host changes are announced on the pf9-changes exchange so that
+        # resmgr can react to them without waiting for its next poll
+        notifier.init(self.log, self.config)
         t = threading.Thread(target=self._io_thread)
         t.daemon = True
         t.start()
@@ -81,6 +99,10 @@ class bbone_provider_pf9(bbone_provider_memory):
         # thread safe (I think!)
         return super(bbone_provider_pf9, self).get_host_ids()
 
+    def get_host_changes(self, since):
+        with self.lock:
+            return super(bbone_provider_pf9, self).get_host_changes(since)
+
     def get_hosts(self, id_list=[], show_firmware_apps=False):
         """
         Returns existing host(s)
@@ -165,13 +187,17 @@ class bbone_provider_pf9(bbone_provider_memory):
         """
         def consume_msg(ch, method, properties, body):
             try:
-                body = json.loads(body.decode())
+                body = decode_msg(properties, body)
+                note_host_encodings(body)
                 if body['opcode'] == 'support':
                     handle_support_bundle(body)
                     return
                 if body['opcode'] == 'support_command_response':
                     handle_support_command_response(body['data'])
                     return
+                if body['opcode'] == 'status_delta':
+                    handle_status_delta(body)
+                    return
                 if body['opcode'] != 'status':
                     self.log.error('Unknown opcode: %s', body['opcode'])
                     raise ValueError()
@@ -181,16 +207,73 @@ class bbone_provider_pf9(bbone_provider_memory):
                 else:
                     self.log.info('Received: %s', body)
                 host_state = body['data']
-                host_state['timestamp_on_du'] = datetime.datetime.utcnow().\
-                                                strftime("%Y-%m-%d %H:%M:%S.%f")
                 id = host_state['host_id']
-                host_agent_state = host_state['host_agent']
+                # Only sent by hosts that send status deltas
+                seq = body.get('seq')
             except (ValueError, TypeError, KeyError):
                 self.log.error('Malformed message: %s', body)
                 return
+            store_host_state(id, host_state, seq)
+
+        def note_host_encodings(body):
+            """
+            Records the encodings the sender of a message can decode. A host
+            that starts advertising encodings is told about ours, so that it
+            can compress its messages too.
+            """
+            host_id = body['data']['host_id']
+            encodings = body.get('accept_encodings')
             with self.lock:
-                self.hosts[id] = host_state
+                previous = self.host_encodings.get(host_id)
+                self.host_encodings[host_id] = encodings
+            if encodings and encodings != previous:
+                # Our encodings are added to every message we send
+                self._send_msg(host_id, {'opcode': 'encodings'})
+
+        def handle_status_delta(body):
+            """
+            Applies a status message that only has the sections of the host
+            state that changed since the host's previous status message. If
+            that message was missed, asks the host for a full status.
+            """
+            try:
+                delta = body['data']
+                id = delta['host_id']
+                seq = int(body['seq'])
+                removed = body.get('removed', [])
+                removed_extensions = body.get('removed_extensions', [])
+                self.log.debug('Received: %s', body)
+                self.log.info('Received: host_id: {0}, opcode: {1}, status: {2}, seq: {3}'.format(id, body['opcode'], delta['status'], seq))
+            except (ValueError, TypeError, KeyError):
+                self.log.error('Malformed message: %s', body)
+                return
+            with self.lock:
+                host_state = self.apply_host_delta(id, seq, delta, removed,
+                                                   removed_extensions)
+            if host_state is None:
+                self.log.info('Status delta %d of host %s does not follow '
+                              'its last status, requesting a full status',
+                              seq, id)
+                self._send_msg(id, {'opcode': 'resync'})
+                return
+            store_host_state(id, host_state, seq)
+
+        def store_host_state(id, host_state, seq):
+            """
+            Stores the state reported by a host and announces the change.
+            """
+            host_state['timestamp_on_du'] = datetime.datetime.utcnow().\
+                                            strftime("%Y-%m-%d %H:%M:%S.%f")
+            try:
+                host_agent_state = host_state['host_agent']
+            except KeyError:
+                self.log.error('Malformed host state: %s', host_state)
+                return
+            with self.lock:
+                changed = self.update_host(id, host_state, seq)
                 super(bbone_provider_pf9, self).set_host_agent_config(id, host_agent_state)
+            if changed:
+                notifier.publish_notification('change', 'bbone_host', id)
                 #desired_apps = self.desired_apps.get(id)
             # Don't try to converge host at this point, resmgr would try to
             # converge hosts as necessary
@@ -200,14 +283,44 @@ class bbone_provider_pf9(bbone_provider_memory):
             """
             Evaluate the support msg on the broker and write the support file
             """
+            if 'chunk' in msg['data']:
+                handle_support_chunk(msg)
+                return
             self.log.info('Received support file from %s', msg['data']['info'])
             if msg['status'] == 'error':
                 self.log.error('Support bundle generation failed %s',
                                msg['error_message'])
                 return
+            if 'transfer' in msg['data']:
+                # Sent in chunks, which follow this manifest. A host sending
+                # the manifest again after a reconnection asks to resume the
+                # transfer. Stalled transfers are resumed by
+                # check_support_transfers().
+                transfer = get_support_transfer(msg)
+                if transfer is not None and msg['data'].get('resume'):
+                    request_support_chunks(msg['data']['host_id'], transfer)
+                return
 
             # Currently, msg['status'] can only be success or error. Below
             # would be the success case.
+            outfile, du_dir = support_bundle_paths(msg)
+            outfile_temp = outfile + '.part'
+            try:
+                with open(outfile_temp, 'wb') as f:
+                    if 'payload' in msg:
+                        # Sent as a binary message
+                        f.write(msg['payload'])
+                    else:
+                        f.write(base64.b64decode(msg['data']['contents']))
+                os.rename(outfile_temp, outfile)
+                upload_support_bundle(msg, outfile, du_dir)
+            except:
+                self.log.exception('Writing out support bundle failed')
+
+        def support_bundle_paths(msg):
+            """
+            :return: the local path of the support bundle and its path on S3
+            """
             time_now = datetime.datetime.now()
             host_name = msg['data']['info']['hostname']
             host_id = msg['data']['host_id']
@@ -231,20 +344,98 @@ class bbone_provider_pf9(bbone_provider_memory):
             if not os.path.exists(out_dir):
                 os.makedirs(out_dir)
             outfile = os.path.join(self.support_dir_location, hostfile)
-            outfile_temp = outfile + '.part'
+            return outfile, du_dir
+
+        def upload_support_bundle(msg, outfile, du_dir):
+            self.log.info('Received upload flag value as %s', msg['data']['upload'])
+            if msg['data']['upload'].lower() == "true":
+                self.log.info('Uploading up the support bundle.')
+                fb = FileWriterS3(self.log)
+                fb.upload(outfile, du_dir)
+            else:
+                self.log.info('Not uploading the support bundle.')
+
+        def get_support_transfer(msg):
+            """
+            :return: the SupportTransfer of a chunked support message, None
+                if its manifest is invalid or it was already received
+            """
+            data = msg['data']
+            key = (data['host_id'], data['transfer']['sha256'])
+            if key in self.completed_support_transfers:
+                return None
+            transfer = self.support_transfers.get(key)
+            if transfer is None:
+                # The chunks don't need to be kept with the transfer
+                msg = dict(msg, data=dict(data))
+                msg.pop('payload', None)
+                msg['data'].pop('chunk', None)
+                msg['data'].pop('resume', None)
+                try:
+                    transfer = SupportTransfer(
+                        os.path.join(self.support_dir_location,
+                                     data['host_id']),
+                        data['transfer'], msg)
+                except ValueError as e:
+                    self.log.error('%s', e)
+                    return None
+                self.log.info('Receiving support bundle %s from %s in %d '
+                              'chunks', transfer.sha256, data['host_id'],
+                              transfer.chunks)
+                self.support_transfers[key] = transfer
+            return transfer
+
+        def handle_support_chunk(msg):
+            """
+            Writes a chunk of a support bundle. Asks for the chunks that
+            are missing once the last one was received.
+            """
+            data = msg['data']
+            transfer = get_support_transfer(msg)
+            if transfer is None:
+                return
             try:
-                with open(outfile_temp, 'wb') as f:
-                    f.write(base64.b64decode(msg['data']['contents']))
-                os.rename(outfile_temp, outfile)
-                self.log.info('Received upload flag value as %s', msg['data']['upload'])
-                if msg['data']['upload'].lower() == "true":
-                    self.log.info('Uploading up the support bundle.')
-                    fb = FileWriterS3(self.log)
-                    fb.upload(outfile, du_dir)
-                else:
-                    self.log.info('Not uploading the support bundle.')
-            except:
-                self.log.exception('Writing out support bundle failed')
+                transfer.write_chunk(data['chunk'], msg['payload'])
+            except ValueError as e:
+                self.log.error('%s', e)
+            if transfer.complete():
+                key = (data['host_id'], transfer.sha256)
+                del self.support_transfers[key]
+                self.completed_support_transfers.append(key)
+                outfile, du_dir = support_bundle_paths(transfer.msg)
+                try:
+                    transfer.finish(outfile)
+                    self.log.info('Received support file from %s',
+                                  data['info'])
+                    upload_support_bundle(transfer.msg, outfile, du_dir)
+                except:
+                    self.log.exception('Writing out support bundle failed')
+            elif data['chunk'] == transfer.chunks - 1:
+                request_support_chunks(data['host_id'], transfer)
+
+        def request_support_chunks(host_id, transfer):
+            transfer.retries += 1
+            transfer.last_activity = time.time()
+            self._send_msg(host_id, {'opcode': 'support_resend',
+                                     'sha256': transfer.sha256,
+                                     'chunks': transfer.missing()})
+
+        def check_support_transfers():
+            """
+            Asks for the missing chunks of the stalled support bundle
+            transfers, gives up on them after a few attempts.
+            """
+            now = time.time()
+            for key, transfer in list(self.support_transfers.items()):
+                if now - transfer.last_activity < SUPPORT_TRANSFER_TIMEOUT:
+                    continue
+                if transfer.retries >= SUPPORT_TRANSFER_RETRIES:
+                    self.log.error('Giving up on support bundle %s from %s',
+                                   transfer.sha256, key[0])
+                    transfer.discard()
+                    del self.support_transfers[key]
+                    continue
+                request_support_chunks(key[0], transfer)
 
         def handle_support_command_response(data):
             """
@@ -279,10 +470,17 @@ class bbone_provider_pf9(bbone_provider_memory):
                 self.pending_msgs = []
             for routing_key, body in pending_msgs:
                 self.log.info('Sending to %s : %s', routing_key, body)
+                # Broadcasts stay plain JSON for the older hosts
+                with self.lock:
+                    encoding = choose_encoding(
+                        self.host_encodings.get(routing_key))
+                body, properties = encode_msg(body, encoding)
                 self.state['channel'].basic_publish(
                     exchange=constants.BBONE_EXCHANGE,
                     routing_key=routing_key,
-                    body=json.dumps(body))
+                    body=body,
+                    properties=properties)
+            check_support_transfers()
             self.state['connection'].add_timeout(self.send_pending_msgs_period,
                                                  send_pending_msgs)
 
@@ -33,6 +33,25 @@ class IdsController(RestController):
         """
         return _provider.get_host_ids()
 
+class ChangesController(RestController):
+    """ Controller for the .../changes request"""
+
+    @expose('json')
+    def get_all(self, **kwargs):
+        """
+        Handles request of type: GET /v1/hosts/changes?since=<revision>
+        :return: the current revision, the ids of the hosts that changed
+                 since the specified revision, the ids of the hosts whose
+                 resource usage or cpu stats alone changed since then and
+                 the status timestamps of all hosts
+        :rtype: dict
+        """
+        try:
+            since = int(kwargs.get('since', 0))
+        except ValueError:
+            abort(400)
+        return _provider.get_host_changes(since)
+
 class AppsController(RestController):
     """ Controller for the .../apps request """
 
@@ -163,6 +182,7 @@ class HostsController(RestController):
     """ Controller for the .../hosts endpoint"""
 
     ids = IdsController()
+    changes = ChangesController()
     apps = AppsController()
     apps_internal = AppsController(show_comms=True)
     hostagent = HostAgentController()
@@ -170,13 +190,22 @@ class HostsController(RestController):
     certs = HostAgentCertController()
 
     @expose('json')
-    def get_all(self):
+    def get_all(self, **kwargs):
         """
-        Handles request of type: GET /v1/hosts/
-        :return: a list of all host descriptors
-        :rtype: dict
+        Handles request of type: GET /v1/hosts/[?ids=<id1>,<id2>,...]
+        The optional ids query parameter is a comma separated list of host
+        ids. When specified, only the matching host descriptors are returned;
+        unknown ids are skipped.
+        :return: a list of host descriptors
+        :rtype: list
         """
-        return _provider.get_hosts()
+        ids = kwargs.get('ids')
+        if ids is None:
+            return _provider.get_hosts()
+        id_list = [id for id in ids.split(',') if id]
+        if not id_list:
+            return []
+        return _provider.get_hosts(id_list)
 
     @expose('json')
     def get_one(self, id):
@@ -0,0 +1,136 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Support bundles sent by the hosts in chunks.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+
+_SHA256_RE = re.compile('^[0-9a-f]{64}$')
+
+
+class SupportTransfer(object):
+    """
+    A support bundle received in chunks. The chunks are written to a .part
+    file as they arrive, in any order. The chunks received so far are
+    recorded next to it, so that a transfer interrupted by a restart resumes
+    where it stopped.
+    """
+
+    def __init__(self, dirname, manifest, msg):
+        """
+        :param str dirname: directory of the .part file
+        :param dict manifest: the transfer description sent by the host:
+            sha256, size, chunk_size and number of chunks of the bundle
+        :param dict msg: the support message, passed on when the transfer
+            completes
+        :raises ValueError: if the manifest is invalid
+        """
+        self.sha256 = str(manifest['sha256'])
+        self.size = int(manifest['size'])
+        self.chunk_size = int(manifest['chunk_size'])
+        self.chunks = int(manifest['chunks'])
+        if not _SHA256_RE.match(self.sha256) or self.chunk_size <= 0 or \
+                self.chunks != max(1, -(-self.size // self.chunk_size)):
+            raise ValueError('Invalid support bundle manifest: %s' % manifest)
+        self.manifest = manifest
+        self.msg = msg
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.path = os.path.join(dirname, '%s.part' % self.sha256)
+        self.state_path = self.path + '.json'
+        self.received = self._load_state()
+        # Requests for missing chunks since the last chunk was received
+        self.retries = 0
+        self.last_activity = time.time()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = None
+        if state and state.get('manifest') == self.manifest and \
+                os.path.exists(self.path):
+            return set(state['received'])
+        # Start over
+        with open(self.path, 'wb'):
+            pass
+        self._save_state(set())
+        return set()
+
+    def _save_state(self, received):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'manifest': self.manifest,
+                       'received': sorted(received)}, f)
+        os.rename(tmp_path, self.state_path)
+
+    def chunk_length(self, index):
+        """
+        :return: the expected length of a chunk
+        :rtype: int
+        """
+        if index == self.chunks - 1:
+            return self.size - index * self.chunk_size
+        return self.chunk_size
+
+    def write_chunk(self, index, data):
+        """
+        :param int index: index of the chunk
+        :param bytes data: the chunk
+        :raises ValueError: if the chunk doesn't fit the manifest
+        """
+        if not 0 <= index < self.chunks or len(data) != self.chunk_length(index):
+            raise ValueError('Invalid chunk %s of support bundle %s'
+                             % (index, self.sha256))
+        with open(self.path, 'r+b') as f:
+            f.seek(index * self.chunk_size)
+            f.write(data)
+        self.received.add(index)
+        self._save_state(self.received)
+        self.retries = 0
+        self.last_activity = time.time()
+
+    def missing(self):
+        """
+        :return: sorted indexes of the chunks not received yet
+        :rtype: list
+        """
+        return [i for i in range(self.chunks) if i not in self.received]
+
+    def complete(self):
+        return len(self.received) == self.chunks
+
+    def finish(self, outfile):
+        """
+        Verifies the received bundle and moves it to its final location.
+        :param str outfile: path of the bundle
+        :raises ValueError: if the checksum doesn't match. The received data
+            is discarded.
+        """
+        sha = hashlib.sha256()
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(self.chunk_size), b''):
+                sha.update(block)
+        if sha.hexdigest() != self.sha256:
+            self.discard()
+            raise ValueError('Checksum mismatch for support bundle %s'
+                             % self.sha256)
+        os.rename(self.path, outfile)
+        os.unlink(self.state_path)
+
+    def discard(self):
+        """
+        Removes the received data.
+        """
+        for path in (self.path, self.state_path):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
@@ -5,7 +5,7 @@ import os
 from pecan import set_config
 from pecan.testing import load_test_app
 
-from bbmaster import bbone_provider_mock
+from bbmaster import bbone_provider_memory, bbone_provider_mock
 
 from bbmaster.tests import mock_data
 
@@ -76,4 +76,103 @@ class TestRootController(FunctionalTest):
         assert 'info' not in body
         assert 'apps' not in body
 
-
+    def test_get_hosts_by_ids(self):
+        url = '/v1/hosts?ids=468860b4-8a16-11e3-909d-005056a93468,missingid'
+        body = self.app.get(url).json_body
+        assert type(body) is list
+        assert len(body) == 1
+        assert body[0]['host_id'] == '468860b4-8a16-11e3-909d-005056a93468'
+
+        body = self.app.get('/v1/hosts?ids=').json_body
+        assert body == []
+
+
+    def test_get_host_changes(self):
+        body = self.app.get('/v1/hosts/changes?since=0').json_body
+        revision = body['revision']
+        assert sorted(body['changed']) == sorted(mock_data.data.keys())
+        assert body['timestamps']['2d734f3a-8a16-11e3-909d-005056a93468'] \
+            ['timestamp'] == '2014-04-07 19:00:14.301721'
+
+        body = self.app.get('/v1/hosts/changes?since=%d' % revision).json_body
+        assert body['revision'] == revision
+        assert body['changed'] == []
+
+        # A new host shows up as a change
+        self.app.put_json('/v1/hosts/newid/apps', {})
+        body = self.app.get('/v1/hosts/changes?since=%d' % revision).json_body
+        assert body['revision'] > revision
+        assert body['changed'] == ['newid']
+
+        # Only the resource usage changed
+        provider = bbone_provider_mock.provider
+        state = dict(provider.get_hosts(['newid'])[0])
+        state['extensions'] = {
+            'resource_usage': {'status': 'ok', 'data': {'cpu': {'percent': 5}}},
+            'interfaces': {'status': 'ok', 'data': {'eth0': '10.0.0.1'}}
+        }
+        assert provider.update_host('newid', dict(state))
+        revision = provider.get_host_changes(0)['revision']
+        state['extensions'] = dict(state['extensions'], resource_usage={
+            'status': 'ok', 'data': {'cpu': {'percent': 75}}})
+        state['timestamp'] = '2014-04-07 19:01:14.301721'
+        assert not provider.update_host('newid', dict(state))
+        body = self.app.get('/v1/hosts/changes?since=%d' % revision).json_body
+        assert body['revision'] == revision
+        assert body['changed'] == []
+        # Reported as a metrics change once the period elapsed
+        provider.host_metrics_times['newid'] -= \
+            bbone_provider_memory.METRICS_REVISION_PERIOD
+        state['extensions'] = dict(state['extensions'], resource_usage={
+            'status': 'ok', 'data': {'cpu': {'percent': 50}}})
+        assert not provider.update_host('newid', dict(state))
+        body = self.app.get('/v1/hosts/changes?since=%d' % revision).json_body
+        assert body['revision'] > revision
+        assert body['changed'] == []
+        assert body['metrics_changed'] == ['newid']
+        state['extensions'] = dict(state['extensions'], interfaces={
+            'status': 'ok', 'data': {'eth0': '10.0.0.2'}})
+        assert provider.update_host('newid', dict(state))
+        body = self.app.get('/v1/hosts/changes?since=%d' % revision).json_body
+        assert body['changed'] == ['newid']
+        assert body['metrics_changed'] == []
+
+        response = self.app.get('/v1/hosts/changes?since=foo',
+                                expect_errors=True)
+        assert response.status_int == 400
+
+    def test_apply_host_delta(self):
+        provider = bbone_provider_mock.provider
+        host_id = '2d734f3a-8a16-11e3-909d-005056a93468'
+        state = dict(provider.get_hosts([host_id])[0])
+        state['desired_apps'] = {}
+
+        # Hosts that don't send deltas need a full status
+        assert provider.apply_host_delta(host_id, 1, {'status': 'ok'}) is None
+
+        provider.update_host(host_id, state, seq=5)
+        delta = {'host_id': host_id, 'status': 'converging'}
+        new_state = provider.apply_host_delta(host_id, 6, delta,
+                                              ['desired_apps'])
+        assert new_state['status'] == 'converging'
+        assert new_state['apps'] == state['apps']
+        assert 'desired_apps' not in new_state
+        assert state['status'] != 'converging'
+
+        # Only the extensions that changed are sent
+        state['extensions'] = {'interfaces': {'status': 'ok', 'data': 1},
+                               'resource_usage': {'status': 'ok', 'data': 2},
+                               'cpu_stats': {'status': 'ok', 'data': 3}}
+        provider.update_host(host_id, state, seq=10)
+        new_state = provider.apply_host_delta(
+            host_id, 11,
+            {'extensions': {'interfaces': {'status': 'ok', 'data': 4}}},
+            removed_extensions=['cpu_stats'])
+        assert new_state['extensions'] == {
+            'interfaces': {'status': 'ok', 'data': 4},
+            'resource_usage': {'status': 'ok', 'data': 2}}
+        assert len(state['extensions']) == 3
+
+        # Missed message
+        assert provider.apply_host_delta(host_id, 12, delta) is None
+        assert provider.apply_host_delta('unknown', 6, delta) is None
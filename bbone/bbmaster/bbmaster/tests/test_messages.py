@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+import pika
+
+from bbcommon.messages import encode_msg, decode_msg, choose_encoding
+
+
+class TestMessages(TestCase):
+
+    msg = {'opcode': 'status', 'data': {'host_id': 'foo', 'info': 'x' * 1000}}
+
+    def test_encodings(self):
+        for encoding in [None, 'zlib', 'gzip']:
+            body, properties = encode_msg(dict(self.msg), encoding)
+            assert properties.content_encoding == encoding
+            msg = decode_msg(properties, body)
+            assert msg.pop('accept_encodings')
+            assert msg == self.msg
+        assert len(encode_msg(dict(self.msg), 'zlib')[0]) < 1000
+
+        # Small messages aren't compressed
+        body, properties = encode_msg({'opcode': 'ping'}, 'zlib')
+        assert properties.content_encoding is None
+
+    def test_plain_json(self):
+        # Messages from older senders
+        msg = decode_msg(pika.BasicProperties(), b'{"opcode": "ping"}')
+        assert msg == {'opcode': 'ping'}
+        msg = decode_msg(None, b'{"opcode": "ping"}')
+        assert msg == {'opcode': 'ping'}
+
+    def test_payload(self):
+        body, properties = encode_msg({'opcode': 'support'}, 'zlib',
+                                      payload=b'\x00\xff')
+        assert body == b'\x00\xff'
+        msg = decode_msg(properties, body)
+        assert msg['opcode'] == 'support'
+        assert msg['payload'] == b'\x00\xff'
+
+    def test_malformed(self):
+        properties = pika.BasicProperties(content_encoding='zlib')
+        self.assertRaises(ValueError, decode_msg, properties, b'garbage')
+        properties = pika.BasicProperties(content_encoding='br')
+        self.assertRaises(ValueError, decode_msg, properties, b'{}')
+
+    def test_choose_encoding(self):
+        assert choose_encoding(None) is None
+        assert choose_encoding(['binary']) is None
+        assert choose_encoding(['gzip', 'zlib']) == 'zlib'
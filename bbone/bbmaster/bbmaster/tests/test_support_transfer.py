@@ -0,0 +1,206 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase, mock
+
+from bbcommon.messages import encode_msg
+from bbmaster.support_transfer import SupportTransfer
+
+
+class TestSupportTransfer(TestCase):
+
+    data = os.urandom(2500)
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.manifest = {
+            'sha256': hashlib.sha256(self.data).hexdigest(),
+            'size': len(self.data),
+            'chunk_size': 1000,
+            'chunks': 3
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _chunk(self, index):
+        return self.data[index * 1000:(index + 1) * 1000]
+
+    def test_out_of_order(self):
+        transfer = SupportTransfer(self.dirname, self.manifest, {})
+        for index in [2, 0, 1]:
+            assert not transfer.complete()
+            transfer.write_chunk(index, self._chunk(index))
+        assert transfer.complete()
+        outfile = os.path.join(self.dirname, 'bundle.tgz')
+        transfer.finish(outfile)
+        with open(outfile, 'rb') as f:
+            assert f.read() == self.data
+        assert os.listdir(self.dirname) == ['bundle.tgz']
+
+    def test_resume(self):
+        transfer = SupportTransfer(self.dirname, self.manifest, {})
+        transfer.write_chunk(1, self._chunk(1))
+        assert transfer.missing() == [0, 2]
+
+        # e.g. after a restart of the master
+        transfer = SupportTransfer(self.dirname, self.manifest, {})
+        assert transfer.missing() == [0, 2]
+        transfer.write_chunk(0, self._chunk(0))
+        transfer.write_chunk(2, self._chunk(2))
+        transfer.finish(os.path.join(self.dirname, 'bundle.tgz'))
+
+        # A different bundle starts over
+        manifest = dict(self.manifest, size=2000, chunks=2)
+        transfer = SupportTransfer(self.dirname, manifest, {})
+        assert transfer.missing() == [0, 1]
+
+    def test_checksum_mismatch(self):
+        transfer = SupportTransfer(self.dirname, self.manifest, {})
+        transfer.write_chunk(0, self._chunk(0))
+        transfer.write_chunk(1, b'x' * 1000)
+        transfer.write_chunk(2, self._chunk(2))
+        with self.assertRaises(ValueError):
+            transfer.finish(os.path.join(self.dirname, 'bundle.tgz'))
+        assert os.listdir(self.dirname) == []
+
+    def test_invalid(self):
+        for manifest in [dict(self.manifest, sha256='../foo'),
+                         dict(self.manifest, chunks=4),
+                         dict(self.manifest, chunk_size=0)]:
+            with self.assertRaises(ValueError):
+                SupportTransfer(self.dirname, manifest, {})
+        transfer = SupportTransfer(self.dirname, self.manifest, {})
+        for index, data in [(3, b'x'), (2, self._chunk(1)), (-1, b'')]:
+            with self.assertRaises(ValueError):
+                transfer.write_chunk(index, data)
+
+
+class TestSupportMessages(TestCase):
+    """
+    Support bundles sent in chunks, through the master's message handler
+    """
+
+    data = os.urandom(2500)
+    host_id = 'host-1'
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        conf = os.path.join(self.dirname, 'bbmaster.conf')
+        with open(conf, 'w') as f:
+            f.write('[bbmaster]\n'
+                    'connection_retry_period = 1\n'
+                    'send_pending_msgs_period = 1\n'
+                    'support_file_store = %s\n'
+                    '[amqp]\n'
+                    'host = localhost\n' % self.dirname)
+        global_conf = os.path.join(self.dirname, 'global.conf')
+        with open(global_conf, 'w') as f:
+            f.write('[DEFAULT]\nDU_FQDN = du.example.com\n')
+
+        cond = threading.Condition()
+        # Arguments of the I/O loops, one per provider
+        io_loops = []
+
+        def _io_loop(**kwargs):
+            with cond:
+                io_loops.append(kwargs)
+                cond.notify_all()
+            # Stands for the I/O loop, in the daemon I/O thread
+            threading.Event().wait()
+
+        self._patch(mock.patch.dict(os.environ, {
+            'BBMASTER_CONFIG_FILE': conf,
+            'GLOBAL_CONFIG_FILE': global_conf}))
+        self._patch(mock.patch('notifier.init'))
+        # The module creates a provider when first imported
+        self._patch(mock.patch('bbcommon.amqp.io_loop', _io_loop))
+        self._patch(mock.patch('bbmaster.pf9_firmware_apps.get_fw_apps_cfg',
+                               return_value={}))
+        from bbmaster import bbone_provider_pf9_pika
+        self._patch(mock.patch.object(bbone_provider_pf9_pika, 'io_loop',
+                                      _io_loop))
+        self._patch(mock.patch.object(bbone_provider_pf9_pika,
+                                      'get_fw_apps_cfg', return_value={}))
+
+        self.provider = bbone_provider_pf9_pika.bbone_provider_pf9()
+        self.provider._send_msg = mock.Mock()
+
+        def _consume_cb():
+            for kwargs in io_loops:
+                if kwargs['state'] is getattr(self.provider, 'state', None):
+                    return kwargs['consume_cb']
+        with cond:
+            assert cond.wait_for(_consume_cb, 10)
+            self.consume_msg = _consume_cb()
+
+    def _patch(self, patch):
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def _send(self, chunk=None, resume=False):
+        msg = {
+            'opcode': 'support',
+            'status': 'success',
+            'error_message': '',
+            'data': {
+                'host_id': self.host_id,
+                'info': {'hostname': 'host1'},
+                'upload': 'false',
+                'label': None,
+                'fingerprint': 'abc',
+                'transfer': {
+                    'sha256': hashlib.sha256(self.data).hexdigest(),
+                    'size': len(self.data),
+                    'chunk_size': 1000,
+                    'chunks': 3
+                }
+            }
+        }
+        payload = None
+        if chunk is not None:
+            msg['data']['chunk'] = chunk
+            payload = self.data[chunk * 1000:(chunk + 1) * 1000]
+        if resume:
+            msg['data']['resume'] = True
+        body, properties = encode_msg(msg, None, payload)
+        self.consume_msg(None, None, properties, body)
+
+    def _resend_requests(self):
+        return [call[0][1] for call in self.provider._send_msg.call_args_list
+                if call[0][1]['opcode'] == 'support_resend']
+
+    def _bundles(self):
+        host_dir = os.path.join(self.dirname, self.host_id)
+        return [name for name in os.listdir(host_dir)
+                if name.endswith('.gpg')]
+
+    def test_clean_transfer(self):
+        self._send()
+        for chunk in range(3):
+            self._send(chunk)
+        # Every chunk was sent once
+        assert self._resend_requests() == []
+        bundles = self._bundles()
+        assert len(bundles) == 1
+        with open(os.path.join(self.dirname, self.host_id, bundles[0]),
+                  'rb') as f:
+            assert f.read() == self.data
+
+    def test_resume(self):
+        self._send()
+        self._send(0)
+        # Reconnected: the host sends the manifest again
+        self._send(resume=True)
+        requests = self._resend_requests()
+        assert len(requests) == 1
+        assert requests[0]['chunks'] == [1, 2]
+        for chunk in [1, 2]:
+            self._send(chunk)
+        assert len(self._resend_requests()) == 1
+        assert len(self._bundles()) == 1
@@ -0,0 +1,378 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Host agent data extensions. Extensions are executables in the extensions
+directory whose name starts with fetch_ or check_. Their JSON output is
+reported to the backbone master in the status messages, keyed by the script
+name without the prefix. Python extensions can instead be written as plugins
+that the host agent imports once and calls in process, see
+EXTENSION_HEADER_RE.
+"""
+
+import glob
+import importlib.machinery
+import importlib.util
+import json
+import os
+import re
+import shlex
+import subprocess
+import time
+from concurrent import futures
+from os import environ
+from six import iteritems
+
+# Files which need to be run should start with one of these prefixes
+EXTENSION_PREFIXES = ['fetch_', 'check_']
+
+# Seconds after which an extension script is killed
+EXTENSION_TIMEOUT = 120
+
+# An extension script declares its options in '# <option>: <value>' lines
+# among its first few lines:
+#  refresh_interval: N   run the extension at most every N seconds, its last
+#                        result is reported in between
+#  extension_api: plugin the script is a python module with a get_data()
+#                        function returning the extension data. It's imported
+#                        by the host agent and called in process instead of
+#                        being run as a separate process.
+EXTENSION_HEADER_RE = re.compile(r'^#\s*(refresh_interval|extension_api)\s*:\s*(\S+)\s*$')
+EXTENSION_HEADER_LINES = 20
+EXTENSION_API_PLUGIN = 'plugin'
+
+
+def _run_command(command, log, run_env=environ):
+    """
+    Runs a command
+    :param str command: Command to be executed.
+    :return: a tuple representing (code, output), where code is the
+    return code of the command, output of the command
+    :rtype: tuple
+    """
+    try:
+        completed_proc = subprocess.run(shlex.split(command),
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        check=True)
+        # Command was successful, return code must be 0 with relevant output
+        return completed_proc.returncode, completed_proc.stdout, completed_proc.stderr
+    except subprocess.CalledProcessError as e:
+        log.error('%s command failed: %s', command, e)
+        return e.returncode, b'{"err_msg" : "' + e.output + b'"}', b''
+
+
+def run_extension_script(fpath, log):
+    """
+    Runs an extension script.
+    :param str fpath: path of the script
+    :param Logger log: logger
+    :return: the extension result: {'status': ..., 'data': ...}
+    :rtype: dict
+    """
+    # Run the command
+    try:
+        command = 'timeout %d %s' % (EXTENSION_TIMEOUT, fpath)
+        rcode, output, err = _run_command(command, log)
+        if err:
+            log.warn('Extension returned data in stderr : {}'.format(err))
+    except Exception as e:
+        msg = 'Error running extension script: %s' % e
+        log.error(msg)
+        # Setting rcode to an invalid system exit code value here
+        # just to ensure it is processed in below return structure.
+        rcode = 256
+        output = msg
+
+    if rcode:
+        #Execution of command has timed-out.
+        if rcode == 124:
+            ext_result = {
+                'status': 'timed-out',
+                'data': 'Extension script timed-out'
+            }
+        else:
+            # Running the extension failed
+            # Check for blank output in byte format.
+            if output == b'':
+                data = ""
+            else:
+                data = json.loads(output.decode(), strict=False)
+
+            ext_result = {
+                'status': 'error',
+                'data': data
+            }
+    else:
+        try:
+            # Try to build result dict which is JSON serializable
+            ext_result = {
+                'status': 'ok',
+                # Python3: JSON object cannot be 'bytes'. It has to be a string.
+                'data': json.loads(output.decode(), strict=False)
+            }
+        except Exception as e:
+            log.error('Extension data %s is not JSON serializable: %s',
+                       output, e)
+            ext_result = {
+                'status': 'error',
+                'data': 'Extension returned non JSON serializable data'
+            }
+    return ext_result
+
+
+def run_extension_plugin(module, log):
+    """
+    Gets the data of an extension plugin.
+    :param module module: the plugin module
+    :param Logger log: logger
+    :return: the extension result: {'status': ..., 'data': ...}
+    :rtype: dict
+    """
+    try:
+        data = module.get_data()
+        # Same check as the JSON decoding of a script's output
+        json.dumps(data)
+    except BaseException as e:
+        # Run in the host agent itself, a sys.exit() must not end it
+        log.exception('Extension plugin %s failed', module.__name__)
+        return {
+            'status': 'error',
+            'data': 'Error running extension plugin: %s' % e
+        }
+    return {
+        'status': 'ok',
+        'data': data
+    }
+
+
+def load_extension_plugin(name, fpath):
+    """
+    Imports an extension plugin.
+    :param str name: the extension name
+    :param str fpath: path of the plugin
+    :return: the plugin module
+    """
+    # The plugins don't need the .py extension
+    loader = importlib.machinery.SourceFileLoader('pf9_extension_%s' % name,
+                                                  fpath)
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    if not callable(getattr(module, 'get_data', None)):
+        raise AttributeError('%s has no get_data() function' % fpath)
+    return module
+
+
+def read_extension_header(fpath):
+    """
+    Reads the options declared by an extension script.
+    :param str fpath: path of the script
+    :return: dict of option name to value
+    :rtype: dict
+    """
+    options = {}
+    try:
+        with open(fpath, 'rb') as f:
+            for _ in range(EXTENSION_HEADER_LINES):
+                line = f.readline()
+                if not line:
+                    break
+                m = EXTENSION_HEADER_RE.match(line.decode('utf-8', 'replace').strip())
+                if m:
+                    options[m.group(1)] = m.group(2)
+    except (IOError, OSError):
+        pass
+    return options
+
+
+def find_extensions(extensions_path, log):
+    """
+    Finds the extension scripts.
+    :param str extensions_path: the extensions directory
+    :param Logger log: logger
+    :return: dict of extension name to script path
+    :rtype: dict
+    """
+    extensions = {}
+    for ftype in EXTENSION_PREFIXES:
+        # Find files that match the pattern
+        file_pattern = os.path.join(extensions_path, '%s*' % ftype)
+        for fpath in glob.iglob(file_pattern):
+            fname, ext = os.path.splitext(os.path.basename(fpath))
+            # The script name (without the fetch_ or check_ prefix)
+            # is used as a key in the output dict
+            try:
+                m = re.search('%s(.+)' % ftype, fname).group(1)
+            except AttributeError:
+                # deal with the error here.
+                log.error('File %s does not meet expected extension file '
+                          'naming convention', fname)
+                continue
+
+            if not os.access(fpath, os.X_OK):
+                # The file doesn't have execute permissions, skip it
+                continue
+            extensions[m] = fpath
+    return extensions
+
+
+class _Extension(object):
+    """
+    Run state of an extension script
+    """
+
+    def __init__(self, fpath, mtime, refresh_interval, module=None):
+        self.fpath = fpath
+        self.mtime = mtime
+        self.refresh_interval = refresh_interval
+        # The imported module of a plugin, None for scripts
+        self.module = module
+        # Last result and when the run that produced it started
+        self.result = None
+        self.result_time = None
+        # The run in progress, if any, and when it started
+        self.future = None
+        self.start_time = None
+        # Whether the plugin ran for longer than EXTENSION_TIMEOUT. It isn't
+        # run again until it is modified.
+        self.timed_out = False
+
+
+class ExtensionRunner(object):
+    """
+    Runs the extension scripts concurrently on a bounded pool of threads.
+    get_data() only waits a short while for the runs it starts: the last
+    result of an extension that is still running is reported instead, so
+    that one slow script doesn't hold up the status message. The plugins
+    run on a pool of their own, since a plugin that hangs can't be killed
+    and holds its thread. Not thread safe, meant to be called from the
+    session worker thread.
+    """
+
+    def __init__(self, extensions_path, log, max_workers=4, wait_timeout=5,
+                 refresh_interval=0):
+        """
+        :param str extensions_path: the extensions directory
+        :param Logger log: logger
+        :param int max_workers: maximum number of scripts, and of plugins,
+            run at a time
+        :param float wait_timeout: seconds get_data() waits for the runs
+            it starts
+        :param int refresh_interval: minimum seconds between runs of the
+            scripts that don't declare their own refresh interval
+        """
+        self.extensions_path = extensions_path
+        self.log = log
+        self.wait_timeout = wait_timeout
+        self.refresh_interval = refresh_interval
+        self._executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._plugin_executor = futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+        self._extensions = {}
+
+    def _refresh_extensions(self):
+        """
+        Picks up added, removed and modified extension scripts.
+        """
+        found = find_extensions(self.extensions_path, self.log)
+        for name in set(self._extensions) - set(found):
+            del self._extensions[name]
+        for name, fpath in iteritems(found):
+            try:
+                mtime = os.stat(fpath).st_mtime
+            except OSError:
+                mtime = None
+            ext = self._extensions.get(name)
+            if ext is None or ext.fpath != fpath or ext.mtime != mtime:
+                options = read_extension_header(fpath)
+                try:
+                    interval = int(options.get('refresh_interval',
+                                               self.refresh_interval))
+                except ValueError:
+                    self.log.error('Invalid refresh interval in %s', fpath)
+                    interval = self.refresh_interval
+                module = None
+                if options.get('extension_api') == EXTENSION_API_PLUGIN:
+                    try:
+                        module = load_extension_plugin(name, fpath)
+                    except BaseException:
+                        self.log.exception('Loading extension plugin %s '
+                                           'failed, running it as a script',
+                                           fpath)
+                new_ext = _Extension(fpath, mtime, interval, module)
+                if ext is not None and ext.fpath == fpath:
+                    # Keep reporting the old result until the next run
+                    new_ext.result = ext.result
+                    new_ext.future = ext.future
+                    new_ext.start_time = ext.start_time
+                self._extensions[name] = new_ext
+
+    def _collect(self, ext):
+        """
+        Stores the result of the extension's completed run, if any.
+        """
+        if ext.future is None or not ext.future.done():
+            return
+        try:
+            ext.result = ext.future.result()
+        except BaseException as e:
+            self.log.error('Error running extension script %s: %s',
+                           ext.fpath, e)
+            ext.result = {
+                'status': 'error',
+                'data': 'Error running extension script: %s' % e
+            }
+        ext.result_time = ext.start_time
+        ext.future = None
+
+    def get_data(self):
+        """
+        Starts the extension scripts that are due and returns the latest
+        result of each extension. Extensions that never completed a run yet
+        are left out.
+        :return: dict of extension name to {'status': ..., 'data': ...}
+        :rtype: dict
+        """
+        self._refresh_extensions()
+        now = time.time()
+        running = []
+        for name, ext in iteritems(self._extensions):
+            self._collect(ext)
+            if ext.future is None and not ext.timed_out and \
+                    (ext.result_time is None or
+                     now - ext.result_time >= ext.refresh_interval):
+                ext.start_time = now
+                if ext.module is not None:
+                    ext.future = self._plugin_executor.submit(
+                        run_extension_plugin, ext.module, self.log)
+                else:
+                    ext.future = self._executor.submit(run_extension_script,
+                                                       ext.fpath, self.log)
+            if ext.future is not None:
+                running.append(ext.future)
+
+        if running:
+            futures.wait(running, timeout=self.wait_timeout)
+
+        ext_data = {}
+        for name, ext in iteritems(self._extensions):
+            self._collect(ext)
+            if ext.future is not None:
+                self.log.debug('Extension %s is still running, reporting '
+                               'its previous result', name)
+                # A plugin can't be killed like a script, report it the same
+                # way as a script killed by the timeout
+                if ext.module is not None and not ext.timed_out and \
+                        time.time() - ext.start_time > EXTENSION_TIMEOUT:
+                    self.log.error('Extension plugin %s timed out, it is '
+                                   'not run again until it is modified',
+                                   ext.fpath)
+                    ext.timed_out = True
+                    ext.result = {
+                        'status': 'timed-out',
+                        'data': 'Extension script timed-out'
+                    }
+            if ext.result is not None:
+                ext_data[name] = ext.result
+        return ext_data
@@ -9,6 +9,8 @@ import pika
 import json
 from bbcommon import constants
 from bbcommon.amqp import dual_channel_io_loop
+from bbcommon.messages import encode_msg, decode_msg, choose_encoding, \
+    BINARY_ENCODING, CHUNKED_ENCODING
 from datagatherer import datagatherer
 from logging import Logger
 from six.moves.configparser import ConfigParser
@@ -18,22 +20,24 @@ from pf9app.app import RemoteApp
 from pf9app.algorithms import process_apps, process_agent_update
 from pf9app.exceptions import Pf9Exception
 from pf9app.pf9_app import _run_command as pf9_app_run_command
-import glob
-import subprocess
+import copy
 import datetime
+import hashlib
 import sys
+import time
 import logging
-import shlex
 import re
 from bbslave import certs
 from bbslave import util
 from socket import gethostname
 from bbslave.sysinfo import get_sysinfo, get_host_id
+from bbslave.extensions import ExtensionRunner
+from bbslave.session_worker import SessionWorker
 from bbcommon.utils import is_satisfied_by, get_ssl_options
 from os.path import exists, join
 from os import makedirs, rename, unlink, environ, listdir
 from pika.exceptions import AMQPConnectionError
-from six import iteritems
+from six import iteritems, reraise
 from six.moves import queue as Queue
 
 _host_id = get_host_id()
@@ -42,9 +46,24 @@ _support_file_location = None
 _common_config_path = None
 _hostagent_info = {}
 _pending_support_bundle = {'pending': False}
+# The support message of the bundle last sent in chunks
+_support_transfer = {}
 
 HYPERVISOR_INFO_FILE = '/var/opt/pf9/hypervisor_details'
 
+# Size of the chunks support bundles are sent in, to masters that accept them
+SUPPORT_CHUNK_SIZE = 1024 * 1024
+
+# Sections of the status message that are only sent when they changed when
+# sending status deltas. The other fields are part of every message.
+STATUS_DELTA_SECTIONS = ('info', 'hypervisor_info', 'apps', 'host_agent',
+                         'extensions', 'cert_info', 'desired_apps')
+
+# Extensions whose data changes with every status message, like the resource
+# usage and load average. In status deltas, their changes are only sent every
+# extension_metrics_period seconds.
+VOLATILE_EXTENSIONS = ('resource_usage', 'cpu_stats')
+
 
 def _handle_iaas_3166(log, disable_iaas_1366_handling, desired_config):
     """
@@ -147,25 +166,6 @@ def save_desired_config(log, desired_config):
         except Exception as e:
             log.error('Failed to save desired configuration: %s', e)
 
-def _run_command(command, log, run_env=environ):
-    """
-    Runs a command
-    :param str command: Command to be executed.
-    :return: a tuple representing (code, output), where code is the
-    return code of the command, output of the command
-    :rtype: tuple
-    """
-    try:
-        completed_proc = subprocess.run(shlex.split(command),
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
-                                        check=True)
-        # Command was successful, return code must be 0 with relevant output
-        return completed_proc.returncode, completed_proc.stdout, completed_proc.stderr
-    except subprocess.CalledProcessError as e:
-        log.error('%s command failed: %s', command, e)
-        return e.returncode, b'{"err_msg" : "' + e.output + b'"}', b''
-
 def start(config, log, app_db, agent_app_db, app_cache,
           remote_app_class, agent_app_class,
           channel_retry_period=10):
@@ -197,6 +197,27 @@ def start(config, log, app_db, agent_app_db, app_cache,
         config.has_option('hostagent', 'extensions_path') else '/opt/pf9/hostagent/extensions'
     disable_iaas_1366_handling = config.get('hostagent', 'disable_iaas_1366_handling') if \
         config.has_option('hostagent', 'disable_iaas_1366_handling') else False
+    # When enabled, status messages only carry the sections that changed
+    # since the previous one, with a full status every full_status_period
+    # seconds or when the master asks for one
+    status_deltas = config.getboolean('hostagent', 'status_deltas') if \
+        config.has_option('hostagent', 'status_deltas') else False
+    full_status_period = config.getint('hostagent', 'full_status_period') if \
+        config.has_option('hostagent', 'full_status_period') else 600
+    extension_metrics_period = \
+        config.getint('hostagent', 'extension_metrics_period') if \
+        config.has_option('hostagent', 'extension_metrics_period') else 300
+    # Number of app packages downloaded in parallel during convergence
+    download_workers = config.getint('hostagent', 'download_workers') if \
+        config.has_option('hostagent', 'download_workers') else 4
+    extension_runner = ExtensionRunner(
+        extensions_path, log,
+        max_workers=config.getint('hostagent', 'extensions_max_workers') if \
+            config.has_option('hostagent', 'extensions_max_workers') else 4,
+        wait_timeout=config.getfloat('hostagent', 'extensions_wait_timeout') if \
+            config.has_option('hostagent', 'extensions_wait_timeout') else 5,
+        refresh_interval=config.getint('hostagent', 'extensions_refresh_interval') if \
+            config.has_option('hostagent', 'extensions_refresh_interval') else 0)
     _load_host_agent_info(agent_app_db)
     _set_desired_config_basedir_path(config)
     _persist_host_id()
@@ -261,90 +282,17 @@ def start(config, log, app_db, agent_app_db, app_cache,
         match a certain filename pattern and are placed in the extensions
         directory
         """
-        ext_data = {}
-        # Files which need to be run should start with fetch_ or check_
-        # prefix.
-        file_types = ['fetch_', 'check_']
-        for ftype in file_types:
-            # Find files that match the pattern
-            file_pattern = os.path.join(extensions_path, '%s*' % ftype)
-            for fpath in glob.iglob(file_pattern):
-                fname, ext = os.path.splitext(os.path.basename(fpath))
-                # The script name (without the fetch_ or check_ prefix)
-                # is used as a key in the output dict
-                try:
-                    m = re.search('%s(.+)' % ftype, fname).group(1)
-                except AttributeError:
-                    # deal with the error here.
-                    log.error('File %s does not meet expected extension file '
-                              'naming convention', fname)
-                    continue
-
-                if not os.access(fpath, os.X_OK):
-                    # The file doesn't have execute permissions, skip it
-                    continue
-
-                # Run the command
-                try:
-                    #Timeout after 20s if the extension has failed to finish
-                    command = 'timeout 120 ' + fpath
-                    rcode, output, err = _run_command(command, log)
-                    if err:
-                        log.warn('Extension returned data in stderr : {}'.format(err))
-                except Exception as e:
-                    msg = 'Error running extension script: %s' % e
-                    log.error(msg)
-                    # Setting rcode to an invalid system exit code value here
-                    # just to ensure it is processed in below return structure.
-                    rcode = 256
-                    output = msg
-
-                if rcode:
-                    #Execution of command has timed-out.
-                    if rcode == 124:
-                        ext_result = {
-                            'status': 'timed-out',
-                            'data': 'Extension script timed-out'
-                        }
-                    else:
-                        # Running the extension failed
-                        # Check for blank output in byte format.
-                        if output == b'':
-                            data = ""
-                        else:
-                            data = json.loads(output.decode(), strict=False)
-
-                        ext_result = {
-                            'status': 'error',
-                            'data': data
-                        }
-                else:
-                    try:
-                        # Try to build result dict which is JSON serializable
-                        ext_result = {
-                            'status': 'ok',
-                            # Python3: JSON object cannot be 'bytes'. It has to be a string.
-                            'data': json.loads(output.decode(), strict=False)
-                        }
-                    except Exception as e:
-                        log.error('Extension data %s is not JSON serializable: %s',
-                                   output, e)
-                        ext_result = {
-                            'status': 'error',
-                            'data': 'Extension returned non JSON serializable data'
-                        }
-
-                ext_data.update({m: ext_result})
-
-        return ext_data
+        return extension_runner.get_data()
 
     def send_status(status, config, desired_config=None):
         """
-        Sends a message to the master.
+        Sends a status message to the master.
         :param str status: Status: 'ok', 'converging', 'retrying', 'failed'
         :param dict config: Current application configuration
         """
-        if 'channel' not in state:
+        # The I/O loop thread removes it when the channel closes
+        channel = state.get('channel')
+        if channel is None:
             log.warn('Not sending status message because channel is closed')
             return
         msg = {
@@ -367,13 +315,109 @@ def start(config, log, app_db, agent_app_db, app_cache,
         if desired_config is not None:
             msg['data']['desired_apps'] = desired_config
 
-        channel = state['channel']
         timestamp = datetime.datetime.utcnow().strftime('%Y-%m-%d '
                                                         '%H:%M:%S.%f')
         msg['data']['timestamp'] = timestamp
-        channel.basic_publish(exchange=constants.BBONE_EXCHANGE,
+        if status_deltas:
+            msg, sections = make_status_delta(msg)
+        publish_msg(channel, msg)
+        if status_deltas:
+            # Copies, since some sections are modified in place later
+            state['status_seq'] = msg['seq']
+            state['status_sections'] = copy.deepcopy(sections)
+
+    def publish_msg(channel, msg, payload=None):
+        """
+        Publishes a message to the master, compressed if the master
+        supports it.
+        :param channel: the send channel
+        :param dict msg: the message
+        :param bytes payload: binary payload, if the master accepts them
+        """
+        encoding = choose_encoding(state.get('master_encodings'))
+        body, properties = encode_msg(msg, encoding, payload)
+        # pika channels may only be used from the I/O loop thread
+        worker.run_in_io_loop(state.get('connection'), channel.basic_publish,
+                              exchange=constants.BBONE_EXCHANGE,
                               routing_key=constants.MASTER_TOPIC,
-                              body=json.dumps(msg))
+                              body=body,
+                              properties=properties)
+
+    def make_status_delta(msg):
+        """
+        Turns a full status message into a status_delta message that only
+        has the sections that changed since the previous status message,
+        unless a full status is due. Both carry a sequence number, which
+        lets the master detect a missed message and ask for a full status.
+        The extensions section of a status_delta only has the extensions
+        that changed, see diff_extensions().
+        :param dict msg: the full status message
+        :return: the message to send, and its sections as the master knows
+            them once it got the message
+        :rtype: tuple
+        """
+        seq = state.get('status_seq', 0) + 1
+        sent = state.get('status_sections')
+        data = msg['data']
+        sections = dict((k, v) for k, v in iteritems(data)
+                        if k in STATUS_DELTA_SECTIONS)
+        now = time.time()
+        if sent is None or state.get('full_status_needed') or \
+                now - state.get('full_status_time', 0) >= full_status_period:
+            state['full_status_needed'] = False
+            state['full_status_time'] = now
+            state['extension_metrics_time'] = now
+            msg['seq'] = seq
+            return msg, sections
+
+        delta = dict((k, v) for k, v in iteritems(data)
+                     if k not in STATUS_DELTA_SECTIONS or sent.get(k) != v)
+        delta_msg = {
+            'opcode': 'status_delta',
+            'seq': seq,
+            'data': delta,
+            'removed': [k for k in sent if k not in data]
+        }
+        if isinstance(sent.get('extensions'), dict) and \
+                isinstance(data.get('extensions'), dict):
+            changed, removed, sections['extensions'] = diff_extensions(
+                sent['extensions'], data['extensions'], now)
+            delta.pop('extensions', None)
+            if changed:
+                delta['extensions'] = changed
+            if removed:
+                delta_msg['removed_extensions'] = removed
+        return delta_msg, sections
+
+    def diff_extensions(sent, extensions, now):
+        """
+        Compares the extensions with the ones last sent, extension by
+        extension. The changes to the volatile extensions are left out until
+        extension_metrics_period elapsed since they were last sent.
+        :param dict sent: the extensions as the master knows them
+        :param dict extensions: the current extensions
+        :param float now: the current time
+        :return: the extensions to send, the names of the extensions that
+            were removed, and the extensions as the master knows them once
+            it got them
+        :rtype: tuple
+        """
+        metrics_due = now - state.get('extension_metrics_time', 0) >= \
+            extension_metrics_period
+        changed = {}
+        known = dict(sent)
+        for name, value in iteritems(extensions):
+            if sent.get(name) == value or (name in VOLATILE_EXTENSIONS and
+                                           name in sent and not metrics_due):
+                continue
+            changed[name] = value
+            known[name] = value
+        removed = [name for name in sent if name not in extensions]
+        for name in removed:
+            del known[name]
+        if metrics_due and any(name in changed for name in VOLATILE_EXTENSIONS):
+            state['extension_metrics_time'] = now
+        return changed, removed, known
 
     def valid_and_converged(current_config, desired_config):
         """
@@ -465,9 +509,11 @@ def start(config, log, app_db, agent_app_db, app_cache,
         Handle the request to generate the support bundle and send the file
         to the backbone master through rabbitmq broker.
         """
+        global _pending_support_bundle, _support_transfer
         _pending_support_bundle = {'upload': upload, 'label': label,
                                    'pending': True }
-        if 'channel' not in state:
+        channel = state.get('channel')
+        if channel is None:
             log.warn('Not sending support bundle because channel is closed')
             return
         msg = {
@@ -480,15 +526,29 @@ def start(config, log, app_db, agent_app_db, app_cache,
             }
         }
 
+        master_encodings = state.get('master_encodings') or []
+        chunked = CHUNKED_ENCODING in master_encodings
+        payload = None
         try:
             if not reupload or not os.path.exists(_support_file_location):
                 datagatherer.generate_support_bundle(_support_file_location, log)
-            with open(_support_file_location, 'rb') as f:
-                fingerprint = util.read_fingerprint()
-                msg['data']['fingerprint'] = fingerprint
-                # Choose base64 encoding to transfer binary content
-                contents_str_binary = base64.b64encode(f.read())
-                msg['data']['contents'] = contents_str_binary.decode()
+            fingerprint = util.read_fingerprint()
+            msg['data']['fingerprint'] = fingerprint
+            if chunked:
+                # The chunks follow this message, see send_support_chunks()
+                msg['data']['transfer'] = describe_support_transfer()
+                if reupload:
+                    # The master asks for the chunks it's missing
+                    msg['data']['resume'] = True
+            else:
+                with open(_support_file_location, 'rb') as f:
+                    if BINARY_ENCODING in master_encodings:
+                        # Sent as the raw message body
+                        payload = f.read()
+                    else:
+                        # Choose base64 encoding to transfer binary content
+                        contents_str_binary = base64.b64encode(f.read())
+                        msg['data']['contents'] = contents_str_binary.decode()
             msg['status'] = 'success'
             msg['error_message'] = ''
         except Exception as e:
@@ -496,13 +556,11 @@ def start(config, log, app_db, agent_app_db, app_cache,
             msg['status'] = 'error'
             msg['error_message'] = str(e)
             msg['data']['contents'] = ''
+            chunked = False
 
-        channel = state['channel']
         log.info('Publishing support bundle message to broker')
         try:
-            channel.basic_publish(exchange=constants.BBONE_EXCHANGE,
-                                  routing_key=constants.MASTER_TOPIC,
-                                  body=json.dumps(msg))
+            publish_msg(channel, msg, payload)
         except Exception:
             if reupload:
                 # If 'reupload' was set to True and we still could not publish
@@ -515,6 +573,85 @@ def start(config, log, app_db, agent_app_db, app_cache,
             raise
 
         _pending_support_bundle = {'pending': False}
+        if chunked:
+            _support_transfer = msg
+            # When the bundle is sent again after a reconnection, the master
+            # asks for the chunks it's missing in a support_resend message
+            if not reupload:
+                send_support_chunks(range(msg['data']['transfer']['chunks']))
+
+    def describe_support_transfer():
+        """
+        :return: the description of the support bundle sent in chunks: its
+            sha256, size, chunk size and number of chunks
+        :rtype: dict
+        """
+        sha = hashlib.sha256()
+        size = 0
+        with open(_support_file_location, 'rb') as f:
+            for block in iter(lambda: f.read(SUPPORT_CHUNK_SIZE), b''):
+                sha.update(block)
+                size += len(block)
+        return {
+            'sha256': sha.hexdigest(),
+            'size': size,
+            'chunk_size': SUPPORT_CHUNK_SIZE,
+            'chunks': max(1, -(-size // SUPPORT_CHUNK_SIZE))
+        }
+
+    def send_support_chunks(chunks):
+        """
+        Sends chunks of the last support bundle, one per I/O loop iteration
+        so that the bundle is never held in memory as a whole and heartbeats
+        go out in between.
+        :param list chunks: indexes of the chunks to send
+        """
+        chunks = list(chunks)
+        msg = _support_transfer
+        transfer = msg['data']['transfer']
+
+        def _send_next():
+            if not chunks:
+                log.info('Sent support bundle %s', transfer['sha256'])
+                return
+            if 'channel' not in state:
+                # The bundle is sent again once the channel is back up
+                log.warn('Channel closed while sending support bundle %s',
+                         transfer['sha256'])
+                return
+            index = chunks.pop(0)
+            chunk_msg = dict(msg, data=dict(msg['data'], chunk=index))
+            chunk_msg['data'].pop('resume', None)
+            with open(_support_file_location, 'rb') as f:
+                f.seek(index * transfer['chunk_size'])
+                payload = f.read(transfer['chunk_size'])
+            try:
+                publish_msg(state['channel'], chunk_msg, payload)
+            except Exception:
+                log.exception('Failed to send chunk %d of support bundle %s',
+                              index, transfer['sha256'])
+                global _pending_support_bundle
+                _pending_support_bundle = {'upload': msg['data']['upload'],
+                                           'label': msg['data']['label'],
+                                           'pending': True}
+                raise
+            state['connection'].add_timeout(0, _send_next)
+
+        # Started in the I/O loop, which schedules the next chunks
+        worker.run_in_io_loop(state.get('connection'), _send_next)
+
+    def resend_support_chunks(sha256, chunks):
+        """
+        Sends the chunks of the last support bundle the master is missing.
+        """
+        transfer = _support_transfer.get('data', {}).get('transfer', {})
+        if transfer.get('sha256') != sha256 or \
+                not os.path.exists(_support_file_location):
+            log.warn('Support bundle %s is no longer available', sha256)
+            return
+        log.info('Sending %d chunks of support bundle %s again',
+                 len(chunks), sha256)
+        send_support_chunks(chunks)
 
     def process_support_command(command):
         """
@@ -570,11 +707,13 @@ def start(config, log, app_db, agent_app_db, app_cache,
             data['status'] = 'error'
             data['error_message'] = str(e)
 
-        channel = state['channel']
+        channel = state.get('channel')
+        if channel is None:
+            log.warn('Not sending support command response because channel '
+                     'is closed')
+            return
         log.info('Publishing command request message to broker')
-        channel.basic_publish(exchange=constants.BBONE_EXCHANGE,
-                              routing_key=constants.MASTER_TOPIC,
-                              body=json.dumps(msg))
+        publish_msg(channel, msg)
 
     def handle_msg(msg):
         """
@@ -586,9 +725,14 @@ def start(config, log, app_db, agent_app_db, app_cache,
         try:
             if msg['opcode'] not in ('ping', 'heartbeat', 'set_config',
                                      'set_agent', 'exit', 'get_support',
-                                     'support_command', 'update_cert'):
+                                     'support_command', 'update_cert',
+                                     'resync', 'encodings',
+                                     'support_resend'):
                 log.error('Invalid opcode: %s', msg['opcode'])
                 return
+            if msg['opcode'] == 'encodings':
+                # Only announces the master's accept_encodings
+                return
             if msg['opcode'] == 'exit':
                 if allow_exit_opcode:
                     log.info('Exiting cleanly.')
@@ -601,6 +745,10 @@ def start(config, log, app_db, agent_app_db, app_cache,
                 log.info('Received get_support message')
                 process_support_request(msg['upload'], msg['label'])
                 return
+            if msg['opcode'] == 'support_resend':
+                log.info('Received support_resend message')
+                resend_support_chunks(msg['sha256'], msg['chunks'])
+                return
             if msg['opcode'] == 'support_command':
                 log.info('Received support_command message: %s' % msg['command'])
                 process_support_command(msg['command'])
@@ -629,6 +777,10 @@ def start(config, log, app_db, agent_app_db, app_cache,
             else:
                 if msg['opcode'] == 'ping':
                     log.info('Received ping message')
+                if msg['opcode'] == 'resync':
+                    # The master missed a status delta
+                    log.info('Received resync message')
+                    state['full_status_needed'] = True
                 if desired_config is None:
                     desired_config = current_config
             converged = valid_and_converged(current_config, desired_config)
@@ -673,7 +825,8 @@ def start(config, log, app_db, agent_app_db, app_cache,
             process_apps(app_db, app_cache, remote_app_class,
                          desired_config, log=log,
                          current_config=current_config,
-                         url_interpolations=url_interpolations)
+                         url_interpolations=url_interpolations,
+                         download_workers=download_workers)
         except Pf9Exception as e:
             log.error('Exception during apps processing: %s', type(e))
 
@@ -702,12 +855,18 @@ def start(config, log, app_db, agent_app_db, app_cache,
         send_status(status, current_config, desired_config)
 
     def consume_msg(ch, method, properties, body):
-        # Python3: JSON object cannot be 'bytes'. It has to be a string.
-        handle_msg(json.loads(body.decode()))
+        msg = decode_msg(properties, body)
+        # Encodings the master can decode, none for older masters
+        state['master_encodings'] = msg.get('accept_encodings')
+        if msg.get('opcode') == 'exit':
+            # Closes the connection, which only the I/O loop can do
+            handle_msg(msg)
+            return
+        worker.submit(msg.get('opcode'), handle_msg, msg)
 
     def connection_up_cb(connection):
         def _renew_timer():
-            heartbeat()
+            worker.submit('heartbeat', heartbeat)
             connection.add_timeout(heartbeat_period, _renew_timer)
 
         state['connection'] = connection
@@ -720,8 +879,10 @@ def start(config, log, app_db, agent_app_db, app_cache,
 
     def send_channel_up_cb(channel):
         state['channel'] = channel
+        # Status deltas sent before may not have reached the master
+        state['full_status_needed'] = True
         # Send one heartbeat now to announce ourselves to the bbmaster.
-        heartbeat()
+        worker.submit('heartbeat', heartbeat)
 
     def send_channel_down_cb(channel):
         del state['channel']
@@ -744,10 +905,26 @@ def start(config, log, app_db, agent_app_db, app_cache,
                                     _pending_support_bundle.get('label'),
                                     reupload=True)
 
-    # Process one heartbeat now to try to converge towards cached desired
-    # state, regardless of whether we can establish an AMQP connection. This is
-    # necessary to restart critical pf9apps like pf9-comms after a reboot.
-    heartbeat()
+    def work_failed(exc_info):
+        """
+        Raises the exception of work that failed in the I/O loop, which ends
+        the session like when the work ran in the I/O loop itself. Other
+        BaseExceptions than Exceptions, like SystemExit, are raised as a
+        RuntimeError, which ends the session but not the host agent.
+        """
+        connection = state.get('connection')
+        if connection is None:
+            log.error('Session work failed while disconnected',
+                      exc_info=exc_info)
+            return
+
+        def _raise():
+            if isinstance(exc_info[1], Exception):
+                reraise(*exc_info)
+            raise RuntimeError('Session work raised %r' % exc_info[1])
+
+        connection.add_callback_threadsafe(_raise)
+
     user = config.get('amqp', 'username') if config.has_option('amqp',
         'username') else 'bbslave'
     password = config.get('amqp', 'password') if config.has_option('amqp',
@@ -771,20 +948,33 @@ def start(config, log, app_db, agent_app_db, app_cache,
         if config.has_option('amqp', 'connect_timeout') else 2.5
     amqp_hb_itvl = int(config.get('amqp', 'amqp_heartbeat_interval')) \
         if config.has_option('amqp', 'amqp_heartbeat_interval') else 60
-    dual_channel_io_loop(log,
-                         host=amqp_host,
-                         credentials=credentials,
-                         queue_name=queue_name,
-                         retry_timeout=channel_retry_period,
-                         connection_up_cb=connection_up_cb,
-                         connection_down_cb=connection_down_cb,
-                         send_channel_up_cb=send_channel_up_cb,
-                         send_channel_down_cb=send_channel_down_cb,
-                         consume_cb=consume_msg,
-                         virtual_host=vhost,
-                         amqp_heartbeat_interval=amqp_hb_itvl,
-                         ssl_options=ssl_options,
-                         socket_timeout=socket_timeout)  # in secs
+    # Convergence, extension data and support bundles are handled by the
+    # worker, the I/O loop only keeps the connection alive and publishes
+    worker = SessionWorker(log, error_cb=work_failed)
+    worker.start()
+
+    # Process one heartbeat now to try to converge towards cached desired
+    # state, regardless of whether we can establish an AMQP connection. This is
+    # necessary to restart critical pf9apps like pf9-comms after a reboot.
+    worker.submit('heartbeat', heartbeat)
+    try:
+        dual_channel_io_loop(log,
+                             host=amqp_host,
+                             credentials=credentials,
+                             queue_name=queue_name,
+                             retry_timeout=channel_retry_period,
+                             connection_up_cb=connection_up_cb,
+                             connection_down_cb=connection_down_cb,
+                             send_channel_up_cb=send_channel_up_cb,
+                             send_channel_down_cb=send_channel_down_cb,
+                             consume_cb=consume_msg,
+                             virtual_host=vhost,
+                             amqp_heartbeat_interval=amqp_hb_itvl,
+                             ssl_options=ssl_options,
+                             socket_timeout=socket_timeout)  # in secs
+    finally:
+        # Lets the work in progress end before a new session starts
+        worker.stop()
 
     if 'connection_closed_unexpectedly' in state:
         log.error('Connection closed unexpectedly.')
@@ -0,0 +1,149 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Runs the work of a backbone session off the pika I/O loop.
+
+Converging the apps, collecting extension data and generating support
+bundles can take minutes. Done in the I/O loop callbacks, they keep the
+connection from sending AMQP heartbeats and the broker closes it. The
+session queues that work to a single worker thread instead, which runs it
+in order, while the I/O loop keeps the connection alive and publishes the
+messages the worker hands it.
+"""
+
+import collections
+import logging
+import sys
+import threading
+
+from pika.exceptions import AMQPConnectionError
+from six import reraise
+
+# Work items that do the same work: one already waiting to run makes the
+# next one redundant
+COALESCED_OPCODES = ('heartbeat', 'ping')
+
+
+class SessionWorker(object):
+    """
+    Serialized work queue of a session, run by a worker thread
+    """
+
+    def __init__(self, log=logging, error_cb=None):
+        """
+        :param Logger log: logger object
+        :param function error_cb: called on the worker thread with the
+            sys.exc_info() of a work item that raised, any BaseException
+        """
+        self.log = log
+        self._error_cb = error_cb
+        self._cond = threading.Condition()
+        # Tuples of (opcode, function, args)
+        self._queue = collections.deque()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the worker thread.
+        """
+        self._thread = threading.Thread(name='Session-Worker',
+                                        target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Drops the queued work and waits for the work in progress to return.
+        Calls to run_in_io_loop() waiting for the I/O loop fail.
+        """
+        with self._cond:
+            self._stopping = True
+            self._queue.clear()
+            self._cond.notify_all()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def in_worker(self):
+        """
+        :return: whether the caller runs on the worker thread
+        :rtype: bool
+        """
+        return threading.current_thread() is self._thread
+
+    def submit(self, opcode, fn, *args):
+        """
+        Queues a call to fn(*args). Heartbeats and pings are dropped when
+        one is already the last queued item, the queue never grows with
+        them while the worker is busy.
+        :param str opcode: opcode of the message the work is for
+        :param function fn: the work
+        :return: whether the work was queued
+        :rtype: bool
+        """
+        with self._cond:
+            if self._stopping:
+                return False
+            if opcode in COALESCED_OPCODES and self._queue and \
+                    self._queue[-1][0] in COALESCED_OPCODES:
+                self.log.debug('Coalesced %s with the queued %s', opcode,
+                               self._queue[-1][0])
+                return False
+            self._queue.append((opcode, fn, args))
+            self._cond.notify()
+            return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                opcode, fn, args = self._queue.popleft()
+            try:
+                fn(*args)
+            except BaseException:
+                # Like a SystemExit raised by an extension plugin: ending the
+                # thread would leave the session without its worker
+                exc_info = sys.exc_info()
+                if self._stopping:
+                    self.log.warn('Stopped %s work: %s', opcode, exc_info[1])
+                elif self._error_cb:
+                    self._error_cb(exc_info)
+                else:
+                    self.log.exception('Failed %s work', opcode)
+                del exc_info
+
+    def run_in_io_loop(self, connection, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) on the I/O loop thread of connection and
+        returns its result, for the calls that pika only allows there. Runs
+        it right away when called from the I/O loop itself.
+        :param connection: the pika connection, None if it is down
+        :raises AMQPConnectionError: if the connection is down or the worker
+            is stopped before the call ran
+        """
+        if not self.in_worker():
+            return fn(*args, **kwargs)
+        if connection is None:
+            raise AMQPConnectionError('Not connected to the broker')
+        done = threading.Event()
+        result = {}
+
+        def _call():
+            try:
+                result['value'] = fn(*args, **kwargs)
+            except Exception:
+                result['exc_info'] = sys.exc_info()
+            done.set()
+
+        connection.add_callback_threadsafe(_call)
+        # The I/O loop doesn't run the call once it stopped
+        while not done.wait(1):
+            if self._stopping:
+                raise AMQPConnectionError('The I/O loop stopped')
+        if 'exc_info' in result:
+            reraise(*result['exc_info'])
+        return result['value']
@@ -20,7 +20,7 @@ from bbcommon.customlogger import CustomLogger
 import threading
 from bbslave.cert_update_thread import cert_update_thread
 from bbslave.package_cleaner import clean_packages
-from bbslave.sysinfo import get_cpu_info
+from bbslave.sysinfo import get_cpu_info, get_host_facts
 
 """
 This function sets up the logging for given parameters.
@@ -102,6 +102,9 @@ def reconnect_loop(config):
         clean_packages(log)
     # Log cpu info
     log.info('Cpu info: %s' % get_cpu_info(log))
+    # Starts the lookup of the fully qualified host name in the background,
+    # the name looked up before the restart is reported until it completes
+    log.info('Host facts: %s' % get_host_facts(log))
     # Start the cert update thread.
     cert_thread = threading.Thread(
             name='Cert-Update-Thread',
@@ -114,12 +117,22 @@ def reconnect_loop(config):
     log.info('Platform9 host agent started at %s on thread %s',
              datetime.datetime.now(), threading.current_thread().ident)
 
-    app_db = AppDb(log)
+    app_db_kwargs = {}
+    if not use_mock and config.has_option('hostagent', 'current_config_max_age'):
+        app_db_kwargs['config_max_age'] = config.getint('hostagent',
+                                                        'current_config_max_age')
+    if not use_mock and config.has_option('hostagent', 'config_script_workers'):
+        app_db_kwargs['config_workers'] = config.getboolean(
+            'hostagent', 'config_script_workers')
+    app_db = AppDb(log, **app_db_kwargs)
     agent_app_db = Pf9AgentDb(log)
     ssl_options = get_ssl_options(config)
     app_cache_kwargs = ssl_options if ssl_options else {}
     app_cache_kwargs['cachelocation'] = config.get('hostagent', 'app_cache_dir')
     app_cache_kwargs['log'] = log
+    if not use_mock and config.has_option('hostagent', 'app_cache_max_size_mb'):
+        app_cache_kwargs['max_size'] = config.getint(
+            'hostagent', 'app_cache_max_size_mb') * 1024 * 1024
     app_cache = AppCache(**app_cache_kwargs)
 
     while True:
@@ -9,33 +9,151 @@ import os
 import re
 import socket
 import subprocess
+import threading
+import time
 import cpuinfo
 import psutil
-import distro
+
+from pf9app.pf9_app_cache import get_linux_distribution, OS_RELEASE_FILE
 
 
 CPU_INFO = None
 
+# Seconds after which the host facts are refreshed even if no change was
+# detected
+HOST_FACTS_TTL = 600
+
+# Cached host facts. Looking up the fully qualified host name can block on
+# DNS for seconds, so the facts are refreshed in a background thread.
+_host_facts = {
+    'key': None,
+    'time': 0,
+    'facts': None,
+    'refreshing': False
+}
+_host_facts_lock = threading.Lock()
+
+# Keeps the fully qualified host name across restarts of the host agent, to
+# report it before it is looked up again
+HOST_FQDN_FILE = 'host_fqdn.conf'
+
 def _get_os_info():
     """
     Get OS dist information
     """
-    dist = distro.linux_distribution()
+    dist = get_linux_distribution()
     return ' '.join(dist)
 
-def get_sysinfo(log):
+def _host_facts_key():
     """
-    Returns a dictionary describing the host and operating system.
-    :rtype: dict
+    Returns a value that changes when the host is renamed or its OS is
+    upgraded. Cheap to compute: no DNS lookup.
     """
+    try:
+        os_release_mtime = os.stat(OS_RELEASE_FILE).st_mtime
+    except OSError:
+        os_release_mtime = None
+    return socket.gethostname(), os_release_mtime
+
+def _read_host_facts(hostname):
     return {
-        'hostname': socket.getfqdn(),
+        'hostname': hostname,
         'os_info': _get_os_info(),
         'arch': platform.machine(),
-        'os_family': platform.system(),
-        'cpu_info': get_cpu_info(log)
+        'os_family': platform.system()
     }
 
+def _host_fqdn_file():
+    base_dir = os.environ.get('HOSTAGENT_HOST_ID_BASEDIR', '/etc/pf9')
+    return os.path.join(base_dir, HOST_FQDN_FILE)
+
+def _read_saved_fqdn(hostname):
+    """
+    :return: the fully qualified name last looked up for the host name, None
+        if it's not known
+    """
+    cfg = ConfigParser()
+    cfg.read([_host_fqdn_file()])
+    if cfg.has_option('hostagent', 'hostname') and \
+            cfg.has_option('hostagent', 'fqdn') and \
+            cfg.get('hostagent', 'hostname') == hostname:
+        return cfg.get('hostagent', 'fqdn')
+    return None
+
+def _save_fqdn(hostname, fqdn, log):
+    """
+    Saves the fully qualified name looked up for the host name.
+    """
+    if _read_saved_fqdn(hostname) == fqdn:
+        return
+    fqdn_file = _host_fqdn_file()
+    cfg = ConfigParser()
+    cfg.add_section('hostagent')
+    cfg.set('hostagent', 'hostname', hostname)
+    cfg.set('hostagent', 'fqdn', fqdn)
+    try:
+        with open(fqdn_file + '.tmp', 'w') as fp:
+            cfg.write(fp)
+        os.rename(fqdn_file + '.tmp', fqdn_file)
+    except (IOError, OSError) as e:
+        log.warn('Saving the host name to %s failed: %s', fqdn_file, e)
+
+def refresh_host_facts(log):
+    """
+    Reads the host facts and caches them.
+    :return: the host facts
+    :rtype: dict
+    """
+    key = _host_facts_key()
+    try:
+        fqdn = socket.getfqdn()
+        facts = _read_host_facts(fqdn)
+        _save_fqdn(key[0], fqdn, log)
+    except Exception:
+        log.exception('Refreshing the host facts failed')
+        facts = None
+    with _host_facts_lock:
+        if facts is not None:
+            _host_facts.update(key=key, time=time.time(), facts=facts)
+        _host_facts['refreshing'] = False
+        return _host_facts['facts']
+
+def get_host_facts(log):
+    """
+    Returns the cached host facts. If they are stale, they are refreshed in
+    a background thread, and the stale facts are returned in the meantime.
+    :rtype: dict
+    """
+    key = _host_facts_key()
+    with _host_facts_lock:
+        facts = _host_facts['facts']
+        stale = facts is None or _host_facts['key'] != key or \
+            time.time() - _host_facts['time'] >= HOST_FACTS_TTL
+        refresh = stale and not _host_facts['refreshing']
+        if refresh:
+            _host_facts['refreshing'] = True
+    if refresh:
+        log.debug('Refreshing the host facts')
+        thread = threading.Thread(name='Host-Facts-Refresh',
+                                  target=refresh_host_facts, args=(log,))
+        thread.daemon = True
+        thread.start()
+    if facts is None:
+        # Not known yet. The fully qualified name looked up before the host
+        # agent restarted, or else the host name, is used until the fully
+        # qualified name is looked up.
+        facts = _read_host_facts(_read_saved_fqdn(key[0]) or key[0])
+    return dict(facts)
+
+def get_sysinfo(log):
+    """
+    Returns a dictionary describing the host and operating system.
+    :rtype: dict
+    """
+    sysinfo = get_host_facts(log)
+    sysinfo['cpu_info'] = get_cpu_info(log)
+    return sysinfo
+
 
 def get_host_id(base_dir='/etc/pf9'):
     """
@@ -8,18 +8,23 @@ Module that builds a bundle of all support information from a host
 __author__ = 'Platform9'
 
 import glob
+import io
 import logging
 import os
 import re
 import json
 import yaml
 import tarfile
-import tempfile
+from collections import deque
+from concurrent import futures
 from subprocess import CalledProcessError, check_call
 import subprocess
 import gnupg
 import requests
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
 from bbslave.util import fingerprint_path
+from datagatherer.redaction import Redactor, RedactedReader
 
 """
 Want to be able to do the following eventually:
@@ -39,110 +44,94 @@ default_file_list = [
 support_logging_dir = '/var/log/pf9/support'
 support_script = '/opt/pf9/hostagent/bin/run_support_scripts.sh'
 
+# Number of threads reading and redacting the files of the support bundle
+SUPPORT_BUNDLE_WORKERS = 4
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
+def _redact_key(value):
+    """
+    Keeps the key of a key/value pair.
+    """
+    return _key_separator.split(value, 1)[0] + b'=REDACTED'
+
+def _redact_value(value):
+    """
+    Keeps the key of a key=value pair and the separator.
+    """
+    return _key_prefix.match(value).group() + b'REDACTED'
+
+def _redact_cert_request(value):
+    return (b'-----BEGIN CERTIFICATE REQUEST-----\nREDACTED\n'
+            b'-----END CERTIFICATE REQUEST-----')
+
+_key_separator = re.compile(rb'[:=]\s*')
+_key_prefix = re.compile(rb'[^=]*=\s*')
+
+# Redaction rules of the files other than JSON and YAML files, see
+# redaction.Redactor
 sensitive_patterns = [
-    re.compile(r'(password\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(password\s*=\s*\'.*?\')', re.IGNORECASE),
-    re.compile(r'(password\s*=\s*[^;\n]*)', re.IGNORECASE),
-    re.compile(r'(ca_chain\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(certificate\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(issuing_ca\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(service_account_key\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(client-certificate-data\s*:\s*".*?")', re.IGNORECASE),
-    re.compile(r'(client-key-data\s*:\s*".*?")', re.IGNORECASE),
-    re.compile(r'(certificate-authority-data\s*:\s*".*?")', re.IGNORECASE),
-    re.compile(r'(\bETCD_INITIAL_CLUSTER_TOKEN\b\s*[:=]\s*(?:"[^"]*"|\S+))', re.IGNORECASE),
-    re.compile(r'(DOCKERHUB_PASSWORD\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(OS_PASSWORD\s*=\s*".*?")', re.IGNORECASE),
-    re.compile(r'(VAULT_TOKEN\s*=\s*(?:"[^"]*"|[^;\n]*))', re.IGNORECASE),
-    re.compile(r'(CUSTOM_REGISTRY_PASSWORD\s*:\s*".*?")', re.IGNORECASE),
-    re.compile(r'(certificate-authority-data\s*:\s*[A-Za-z0-9+/=]+)', re.IGNORECASE),
-    re.compile(r'(client-certificate-data\s*:\s*[A-Za-z0-9+/=]+)', re.IGNORECASE),
-    re.compile(r'(client-key-data\s*:\s*[A-Za-z0-9+/=]+)', re.IGNORECASE),
-    re.compile(r'(hashed certificate data:\s*[A-Za-z0-9+/=]+)', re.IGNORECASE),
+    (rb'(?s-i:-----BEGIN CERTIFICATE REQUEST-----.*?-----END CERTIFICATE REQUEST-----)', _redact_cert_request),
+    (rb'ETCD_INITIAL_CLUSTER_TOKEN\s*=\s*[^\n\\]+', _redact_value),
+    (rb'password\s*=\s*(?:".*?"|' + rb"'.*?')?[^;\n]*", _redact_key),
+    (rb'ca_chain\s*=\s*".*?"', _redact_key),
+    (rb'certificate\s*=\s*".*?"', _redact_key),
+    (rb'issuing_ca\s*=\s*".*?"', _redact_key),
+    (rb'service_account_key\s*=\s*".*?"', _redact_key),
+    (rb'client-certificate-data\s*:\s*".*?"', _redact_key),
+    (rb'client-key-data\s*:\s*".*?"', _redact_key),
+    (rb'certificate-authority-data\s*:\s*".*?"', _redact_key),
+    (rb'\bETCD_INITIAL_CLUSTER_TOKEN\b\s*[:=]\s*(?:"[^"]*"|\S+)', _redact_key),
+    (rb'DOCKERHUB_PASSWORD\s*=\s*".*?"', _redact_key),
+    (rb'OS_PASSWORD\s*=\s*".*?"', _redact_key),
+    (rb'VAULT_TOKEN\s*=\s*(?:"[^"]*"|[^;\n]*)', _redact_key),
+    (rb'CUSTOM_REGISTRY_PASSWORD\s*:\s*".*?"', _redact_key),
+    (rb'certificate-authority-data\s*:\s*[A-Za-z0-9+/=]+', _redact_key),
+    (rb'client-certificate-data\s*:\s*[A-Za-z0-9+/=]+', _redact_key),
+    (rb'client-key-data\s*:\s*[A-Za-z0-9+/=]+', _redact_key),
+    (rb'hashed certificate data:\s*[A-Za-z0-9+/=]+', _redact_key),
 ]
 
-sensitive_patterns_for_yaml_json = [
-    re.compile(r'client-key-data', re.IGNORECASE),
-    re.compile(r'client-certificate-data', re.IGNORECASE),
-    re.compile(r'certificate-authority-data', re.IGNORECASE),
-
-    re.compile(r'ca_chain', re.IGNORECASE),
-    re.compile(r'certificate', re.IGNORECASE),
-    re.compile(r'issuing_ca', re.IGNORECASE),
-    re.compile(r'service_account_key', re.IGNORECASE),
-    re.compile(r'client-certificate-data', re.IGNORECASE),
-    re.compile(r'client-key-data', re.IGNORECASE),
-    re.compile(r'certificate-authority-data', re.IGNORECASE),
-
-    re.compile(r'VAULT_TOKEN', re.IGNORECASE),
-    re.compile(r'ETCD_INITIAL_CLUSTER_TOKEN', re.IGNORECASE),
+# Every match of sensitive_patterns starts with one of these, give or take
+# a prefix like "client-" or "-----BEGIN "
+sensitive_keywords = [
+    b'password',
+    b'ca_chain',
+    b'certificate',
+    b'issuing_ca',
+    b'service_account_key',
+    b'client-key-data',
+    b'etcd_initial_cluster_token',
+    b'vault_token',
 ]
 
-sensitive_keys_within_strings = {
-    "ETCD_INITIAL_CLUSTER_TOKEN": re.compile(r'(ETCD_INITIAL_CLUSTER_TOKEN\s*=\s*)[^\n\\]+', re.IGNORECASE)
-}
-
-def redact_cert_requests(log_file_path):
-    cert_request_pattern = re.compile(
-        r'(?P<begin>-----BEGIN CERTIFICATE REQUEST-----)(?P<content>.*?)(?P<end>-----END CERTIFICATE REQUEST-----)',
-        re.DOTALL
-    )
-    try:
-        with open(log_file_path, 'r') as file:
-            content = file.read()
+redactor = Redactor(sensitive_patterns, sensitive_keywords)
 
-        def redact_match(match):
-            return f"{match.group('begin')}\nREDACTED\n{match.group('end')}"
+# Keys of JSON and YAML documents whose values are redacted
+sensitive_patterns_for_yaml_json = [
+    'client-key-data',
+    'client-certificate-data',
+    'certificate-authority-data',
+    'ca_chain',
+    'certificate',
+    'issuing_ca',
+    'service_account_key',
+    'VAULT_TOKEN',
+    'ETCD_INITIAL_CLUSTER_TOKEN',
+]
 
-        redacted_content = cert_request_pattern.sub(redact_match, content)
-
-        if content != redacted_content:
-            redacted_file_path = f"{log_file_path}.redacted"
-            with open(redacted_file_path, 'w') as file:
-                file.write(redacted_content)
-            return redacted_file_path
-        else:
-            return None
-    except Exception as e:
-        return None
+sensitive_keys_pattern = re.compile(
+    '|'.join(re.escape(key) for key in sensitive_patterns_for_yaml_json),
+    re.IGNORECASE)
 
 def redact_sensitive_key_values(content):
     """
     Redact values of sensitive keys in the configuration file content.
     """
-    redacted_content = content
-    for pattern in sensitive_patterns:
-        redacted_content = pattern.sub(lambda m: re.split(r'[:=]\s*', m.group(1), maxsplit=1)[0] + '=REDACTED', redacted_content)
-
-    def redact_line(line):
-        for key, pattern in sensitive_keys_within_strings.items():
-            if pattern.search(line):
-                line = pattern.sub(r'\1REDACTED', line)
-        return line
-
-    redacted_lines = []
-    in_multiline_string = False
-    multiline_buffer = []
-
-    for line in redacted_content.split('\n'):
-        if '="' in line and not in_multiline_string:
-            in_multiline_string = True
-            multiline_buffer.append(line)
-        elif in_multiline_string:
-            multiline_buffer.append(line)
-            if line.endswith('"'):
-                in_multiline_string = False
-                multiline_content = '\n'.join(multiline_buffer)
-                redacted_multiline_content = redact_line(multiline_content)
-                redacted_lines.append(redacted_multiline_content)
-                multiline_buffer = []
-        else:
-            redacted_lines.append(redact_line(line))
-
-    return '\n'.join(redacted_lines)
+    redacted_content, _ = redactor.redact(content.encode('utf-8',
+                                                         'surrogateescape'))
+    return redacted_content.decode('utf-8', 'surrogateescape')
 
 def redact_yaml_content(content):
     """
@@ -157,43 +146,39 @@ def redact_yaml_content(content):
         redacted_docs.append(redacted_doc)
     return redacted_docs
 
-def redact_files(file, common_base_dir):
+def redact_file(file):
+    """
+    Redact sensitive information from a file.
+    :param str file: path of the file
+    :return: the redacted content of the file: a string for JSON and YAML
+        files, a RedactedReader for the other files. None if the file should
+        be added to the bundle as is.
+    """
     try:
-        if file.endswith('.log'):
-            redacted_file = redact_cert_requests(file)
-            if redacted_file:
-                return redacted_file
-
-        redacted_file = f"{file}.redacted"
-        sensitive_found = False
-
-        with open(file, 'r') as f:
-            if file.endswith('.json'):
+        if file.endswith('.json'):
+            with open(file, 'r') as f:
                 content = json.load(f)
-                redacted_content = redact_sensitive(content)
-                if redacted_content:
-                    sensitive_found = True
-                    with open(os.path.join(common_base_dir, redacted_file), 'w') as fw:
-                        json.dump(redacted_content, fw, indent=2)
-            elif file.endswith('.yaml') or file.endswith('.yml'):
-                content = f.read()
-                redacted_content = redact_yaml_content(content)
-                if redacted_content:
-                    sensitive_found = True
-                    with open(os.path.join(common_base_dir, redacted_file), 'w') as fw:
-                        yaml.safe_dump(redacted_content, fw, default_flow_style=False)
-            else:
+            redacted_content = redact_sensitive(content)
+            if redacted_content:
+                return json.dumps(redacted_content, indent=2)
+        elif file.endswith('.yaml') or file.endswith('.yml'):
+            with open(file, 'r') as f:
                 content = f.read()
-                redacted_content = redact_sensitive_key_values(content)
-                if redacted_content != content:
-                    sensitive_found = True
-                    with open(os.path.join(common_base_dir, redacted_file), 'w') as fw:
-                        fw.write(redacted_content)
-
-        if sensitive_found:
-            return redacted_file
+            redacted_content = redact_yaml_content(content)
+            if redacted_content:
+                return yaml.safe_dump(redacted_content,
+                                      default_flow_style=False)
         else:
-            return file
+            f = open(file, 'rb')
+            try:
+                edits, length = redactor.scan(f)
+            except Exception:
+                f.close()
+                raise
+            if edits:
+                return RedactedReader(f, edits, length)
+            f.close()
+        return None
     except Exception:
         return None
 
@@ -201,7 +186,7 @@ def redact_sensitive(content):
     if isinstance(content, dict):
         redacted_content = {}
         for key, value in content.items():
-            if any(pattern.search(key) for pattern in sensitive_patterns_for_yaml_json):
+            if sensitive_keys_pattern.search(key):
                 redacted_content[key] = 'REDACTED'
             else:
                 redacted_content[key] = redact_sensitive(value)
@@ -212,49 +197,54 @@ def redact_sensitive(content):
         lines = content.split('\n')
         redacted_lines = []
         for line in lines:
-            for pattern in sensitive_patterns_for_yaml_json:
-                if pattern.search(line):
-                    key, sep, val = line.partition('=')
-                    if sep:  # Ensure we have a key=value pair
-                        line = f"{key}=REDACTED"
+            if sensitive_keys_pattern.search(line):
+                key, sep, val = line.partition('=')
+                if sep:  # Ensure we have a key=value pair
+                    line = f"{key}=REDACTED"
             redacted_lines.append(line)
         return '\n'.join(redacted_lines)
     else:
         return content
 
-def extract_certificate_info(cert_path):
-    try:
-        # Extract the start date
-        start_date_command = ["openssl", "x509", "-in", cert_path, "-noout", "-startdate"]
-        start_date_output = subprocess.check_output(start_date_command, text=True)
-        start_date = start_date_output.strip().split('=')[1]
-
-        # Extract the end date
-        end_date_command = ["openssl", "x509", "-in", cert_path, "-noout", "-enddate"]
-        end_date_output = subprocess.check_output(end_date_command, text=True)
-        end_date = end_date_output.strip().split('=')[1]
-
-        # Extract the serial number
-        serial_number_command = ["openssl", "x509", "-in", cert_path, "-noout", "-serial"]
-        serial_number_output = subprocess.check_output(serial_number_command, text=True)
-        serial_number = serial_number_output.strip().split('=')[1]
+def _openssl_date(date):
+    """
+    Formats a certificate date the way 'openssl x509 -startdate' does.
+    """
+    return '%s %2d %s GMT' % (date.strftime('%b'), date.day,
+                              date.strftime('%H:%M:%S %Y'))
 
-        return start_date, end_date, serial_number
-    except subprocess.CalledProcessError:
-        return None, None
+def extract_certificate_info(cert_path):
+    """
+    :return: tuple of the start date, end date and serial number of a PEM
+        certificate, formatted like the openssl command line does
+    """
+    with open(cert_path, 'rb') as f:
+        cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+    start_date = getattr(cert, 'not_valid_before_utc', None) or \
+        cert.not_valid_before
+    end_date = getattr(cert, 'not_valid_after_utc', None) or \
+        cert.not_valid_after
+    serial_number = '%X' % cert.serial_number
+    if len(serial_number) % 2:
+        serial_number = '0' + serial_number
+    return _openssl_date(start_date), _openssl_date(end_date), serial_number
 
 def generate_cert_dates(cert_path):
+    """
+    :return: the validity dates and serial number of a certificate, which
+        are added to the bundle instead of the certificate. None if the
+        certificate can't be read.
+    :rtype: str
+    """
     try:
         start_date, end_date, serial_number = extract_certificate_info(cert_path)
-        cert_info = f"start_date={start_date}, end_date={end_date}, serial_number={serial_number}\n"
-        cert_info_file = f"{cert_path}.hash"
-
-        with open(cert_info_file, 'w') as f:
-            f.write(cert_info)
-
-        return cert_info_file
+        return f"start_date={start_date}, end_date={end_date}, serial_number={serial_number}\n"
     except Exception:
-        pass
+        return None
+
+def is_certificate(file):
+    return file.endswith('.crt') or file.startswith('cert.pem') or \
+        re.match(r'cert\.pem(\.\d+)?$', os.path.basename(file))
 
 def should_exclude(file):
     if os.path.isdir(file):
@@ -286,11 +276,13 @@ def should_exclude(file):
 
     return False
 
-def generate_support_bundle(out_tgz_file, logger=logging):
+def generate_support_bundle(out_tgz_file, logger=logging,
+                            max_workers=SUPPORT_BUNDLE_WORKERS):
     """
     Run the support scripts and generate a tgz file in
     /var/opt/pf9/hostagent. Overwrites the previously generated
-    tgz file if it exists.
+    tgz file if it exists. The files are read and redacted on max_workers
+    threads and streamed into the bundle, nothing is written next to them.
     """
     logger.info('Writing out support file %s', out_tgz_file)
     try:
@@ -309,47 +301,103 @@ def generate_support_bundle(out_tgz_file, logger=logging):
 
     try:
         with tarfile.open(out_tgz_file, 'w:gz') as tgzfile:
-            for pattern in default_file_list:
-                expanded_pattern = os.path.expandvars(os.path.expanduser(pattern))
-
-                for file in glob.iglob(expanded_pattern, recursive=True):
-                    if os.path.isfile(file) and (file.endswith('.crt') or file.startswith('cert.pem') or re.match(r'cert\.pem(\.\d+)?$', os.path.basename(file))):
-                        cert_info_file = generate_cert_dates(file)
-                        if cert_info_file:
-                            with tempfile.NamedTemporaryFile(delete=False) as temp_cert_file:
-                                temp_cert_filename = temp_cert_file.name
-                                with open(cert_info_file, 'r') as src, open(temp_cert_filename, 'w') as dst:
-                                    dst.write(src.read())
-                            os.remove(cert_info_file)
-                            tgzfile.add(temp_cert_filename, arcname=os.path.relpath(file, start='/'))
-                            os.remove(temp_cert_filename)
-
-                    if should_exclude(file):
-                        continue
+            for file, entries in _gather_bundle_entries(_find_bundle_files(),
+                                                        max_workers):
+                for arcname, content in entries:
                     try:
-                        if os.path.isfile(file):
-                            redacted_file = redact_files(file, '/')
-                            if redacted_file:
-                                with tempfile.NamedTemporaryFile(delete=False) as temp_redact_file:
-                                    temp_redact_filename = temp_redact_file.name
-                                    with open(redacted_file, 'r') as src, open(temp_redact_filename, 'w') as dst:
-                                        dst.write(src.read())
-                                tgzfile.add(temp_redact_filename, arcname=os.path.relpath(file, start='/'))
-                                os.remove(temp_redact_filename)
-                                if redacted_file != file:
-                                    os.remove(redacted_file)
-                            else:
-                                tgzfile.add(file, arcname=os.path.relpath(file, start='/'))
-
+                        if content is None:
+                            tgzfile.add(file, arcname=arcname)
+                        elif isinstance(content, RedactedReader):
+                            _add_redacted_file(tgzfile, file, arcname,
+                                               content)
+                        else:
+                            _add_content(tgzfile, file, arcname, content)
                     except (IOError, OSError) as e:
-                        pass
+                        logger.warning("Failed to add %s to the support "
+                                       "bundle: %s", file, e)
                     except Exception as e:
-                        pass
+                        logger.exception("Failed to add %s to the support "
+                                         "bundle: %s", file, e)
             logger.info(f"Support bundle created successfully: {out_tgz_file}")
 
     except Exception as e:
         logger.exception(f"Failed to generate support bundle: {e}")
 
+def _find_bundle_files():
+    """
+    Yields the files matching default_file_list, each one once.
+    """
+    seen = set()
+    for pattern in default_file_list:
+        expanded_pattern = os.path.expandvars(os.path.expanduser(pattern))
+        for file in glob.iglob(expanded_pattern, recursive=True):
+            if file not in seen:
+                seen.add(file)
+                yield file
+
+def _bundle_entries(file):
+    """
+    Reads and redacts a file for the support bundle. Run by the worker
+    threads.
+    :return: list of (name in the bundle, content) tuples. The content is
+        None when the file is added as is.
+    :rtype: list
+    """
+    entries = []
+    if not os.path.isfile(file):
+        return entries
+    arcname = os.path.relpath(file, start='/')
+    if is_certificate(file):
+        cert_info = generate_cert_dates(file)
+        if cert_info:
+            entries.append((arcname, cert_info))
+    if not should_exclude(file):
+        entries.append((arcname, redact_file(file)))
+    return entries
+
+def _gather_bundle_entries(files, max_workers):
+    """
+    Runs _bundle_entries() for the files on a pool of threads. Only a few
+    files are processed ahead of the one being written to the bundle, which
+    bounds the memory used by the redacted content.
+    :return: iterator over (file, entries) tuples, in the order of the files
+    """
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file in files:
+            pending.append((file, executor.submit(_bundle_entries, file)))
+            if len(pending) >= 2 * max_workers:
+                file, future = pending.popleft()
+                yield file, future.result()
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result()
+
+def _file_tarinfo(file, arcname, size):
+    st = os.stat(file)
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mtime = st.st_mtime
+    info.mode = st.st_mode & 0o7777
+    return info
+
+def _add_content(tgzfile, file, arcname, content):
+    """
+    Adds content generated from a file to the bundle, with the file's
+    metadata.
+    """
+    data = content.encode()
+    tgzfile.addfile(_file_tarinfo(file, arcname, len(data)), io.BytesIO(data))
+
+def _add_redacted_file(tgzfile, file, arcname, reader):
+    """
+    Streams a redacted file into the bundle.
+    """
+    try:
+        tgzfile.addfile(_file_tarinfo(file, arcname, reader.size), reader)
+    finally:
+        reader.close()
+
 def write_fingerprint(fingerprint_file_path, fingerprint):
     with open(fingerprint_file_path, 'w') as f:
         f.write(fingerprint)
@@ -0,0 +1,196 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Redaction engine for the support bundle. The redaction rules are compiled
+into a single regular expression, so that a file is scanned once whatever
+the number of rules. Files are scanned as byte streams, one block at a time,
+and are never held in memory as a whole.
+
+The regular expression is only tried next to the keywords of the rules:
+those are found with bytes.find(), which is much faster than letting the
+regular expression engine look for a match at every position.
+"""
+
+import re
+from collections import deque
+
+# Size of the blocks files are scanned in
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Longest match of the rules that is guaranteed to be found when it crosses
+# the boundary of two blocks
+MAX_MATCH_LENGTH = 64 * 1024
+
+
+class Redactor(object):
+    """
+    Applies a set of redaction rules in a single pass.
+    """
+
+    def __init__(self, rules, keywords, keyword_offset=32):
+        """
+        :param list rules: (pattern, replace) tuples. pattern is a bytes
+            regular expression without capturing groups, matched ignoring
+            case. replace is a function returning the replacement of the
+            bytes the pattern matched. When several rules match at the same
+            position, the first one wins.
+        :param list keywords: lowercase bytes. Every match of the rules
+            has one of them in its first keyword_offset bytes.
+        :param int keyword_offset: see keywords
+        """
+        self._replacements = [replace for _, replace in rules]
+        self._pattern = re.compile(
+            b'|'.join(b'(' + pattern + b')' for pattern, _ in rules),
+            re.IGNORECASE)
+        if self._pattern.groups != len(rules):
+            raise ValueError('Redaction rules cannot have capturing groups')
+        self._keywords = keywords
+        self._keyword_offset = keyword_offset
+
+    def _replace(self, match):
+        return self._replacements[match.lastindex - 1](match.group())
+
+    def _find(self, buf, lower_buf, pos, limit):
+        """
+        Finds the matches of the rules starting between pos and limit,
+        like finditer() would.
+        """
+        # Positions the matches can start at
+        starts = set()
+        end = min(len(buf), limit + self._keyword_offset)
+        for keyword in self._keywords:
+            i = lower_buf.find(keyword, pos, end + len(keyword))
+            while i >= 0:
+                starts.update(range(max(pos, i - self._keyword_offset),
+                                    min(limit, i + 1)))
+                i = lower_buf.find(keyword, i + 1, end + len(keyword))
+        free = pos
+        for start in sorted(starts):
+            if start < free:
+                continue
+            match = self._pattern.match(buf, start)
+            if match and match.end() > start:
+                yield match
+                free = match.end()
+
+    def redact(self, data):
+        """
+        :param bytes data: the data to redact
+        :return: tuple of the redacted data and the number of redactions
+        :rtype: tuple
+        """
+        chunks = []
+        pos = 0
+        count = 0
+        for match in self._find(data, data.lower(), 0, len(data)):
+            chunks.append(data[pos:match.start()])
+            chunks.append(self._replace(match))
+            pos = match.end()
+            count += 1
+        chunks.append(data[pos:])
+        return b''.join(chunks), count
+
+    def scan(self, f, block_size=BLOCK_SIZE):
+        """
+        Finds what to redact in a file.
+        :param f: the file, open in binary mode at its start
+        :param int block_size: size of the blocks the file is read in
+        :return: tuple of the sorted list of (start, end, replacement) edits
+            and the number of bytes scanned
+        :rtype: tuple
+        """
+        edits = []
+        buf = b''
+        # Offset of buf in the file, and position in buf up to which the
+        # scan is done
+        base = 0
+        pos = 0
+        eof = False
+        while not eof:
+            block = f.read(block_size)
+            eof = not block
+            buf += block
+            # Matches starting further could go on in the next block
+            limit = len(buf) if eof else len(buf) - MAX_MATCH_LENGTH
+            if limit <= pos:
+                continue
+            next_pos = limit
+            for match in self._find(buf, buf.lower(), pos, limit):
+                if not eof and match.end() == len(buf):
+                    next_pos = match.start()
+                    break
+                edits.append((base + match.start(), base + match.end(),
+                              self._replace(match)))
+                next_pos = max(limit, match.end())
+            # Keep the byte before the scan position for word boundaries
+            keep = max(0, next_pos - 1)
+            buf = buf[keep:]
+            base += keep
+            pos = next_pos - keep
+        return edits, base + len(buf)
+
+
+class RedactedReader(object):
+    """
+    Reads a file with the edits found by Redactor.scan() applied. Only the
+    bytes that were scanned are read. A file that shrank since it was
+    scanned, like a log truncated in place by logrotate, is padded with
+    zero bytes, so that exactly size bytes are read.
+    """
+
+    def __init__(self, f, edits, length):
+        """
+        :param f: the file, open in binary mode
+        :param list edits: the edits returned by Redactor.scan()
+        :param int length: the number of bytes scanned
+        """
+        self._f = f
+        self._edits = deque(edits)
+        self._length = length
+        self._offset = 0
+        self._pending = b''
+        # Bytes read so far, and zero bytes left to read in place of the
+        # end of a file that shrank
+        self._read = 0
+        self._padding = 0
+        # Size of the redacted file
+        self.size = length + sum(len(replacement) - (end - start)
+                                 for start, end, replacement in edits)
+        f.seek(0)
+
+    def read(self, size=-1):
+        chunks = []
+        total = 0
+        while size < 0 or total < size:
+            want = size - total if size >= 0 else BLOCK_SIZE
+            if self._pending:
+                data = self._pending[:want]
+                self._pending = self._pending[want:]
+            elif self._padding:
+                data = b'\0' * min(want, self._padding)
+                self._padding -= len(data)
+            elif self._edits and self._offset == self._edits[0][0]:
+                _, end, self._pending = self._edits.popleft()
+                self._f.seek(end)
+                self._offset = end
+                continue
+            else:
+                stop = self._edits[0][0] if self._edits else self._length
+                data = self._f.read(min(want, stop - self._offset))
+                if not data:
+                    if self._offset >= stop:
+                        break
+                    # The file shrank
+                    self._edits.clear()
+                    self._offset = self._length
+                    self._padding = self.size - self._read - total
+                    continue
+                self._offset += len(data)
+            chunks.append(data)
+            total += len(data)
+        self._read += total
+        return b''.join(chunks)
+
+    def close(self):
+        self._f.close()
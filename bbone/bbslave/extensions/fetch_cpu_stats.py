@@ -3,6 +3,8 @@
 # Copyright 2016 Platform9 Systems Inc.
 # All Rights Reserved.
 
+# extension_api: plugin
+
 import json
 import sys
 import subprocess
@@ -87,8 +89,11 @@ def get_load_average():
         pass
     return res
 
-if __name__ == '__main__':
+def get_data():
     process_list = load_process_list()
     out = get_process_cpu_utilization(process_list)
     out['load_average'] = get_load_average()
-    sys.stdout.write(json.dumps(out))
+    return out
+
+if __name__ == '__main__':
+    sys.stdout.write(json.dumps(get_data()))
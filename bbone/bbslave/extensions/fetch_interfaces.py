@@ -3,6 +3,8 @@
 # Copyright 2016 Platform9 Systems Inc.
 # All Rights Reserved.
 
+# extension_api: plugin
+
 
 import json
 import netifaces
@@ -63,6 +65,8 @@ def get_addresses_and_names():
 
     return {'iface_ip': interface_ips, 'ovs_bridges': ovs_list, 'iface_info': interface_info}
 
+def get_data():
+    return get_addresses_and_names()
+
 if __name__ == '__main__':
-    out = get_addresses_and_names()
-    sys.stdout.write(json.dumps(out))
+    sys.stdout.write(json.dumps(get_data()))
@@ -3,6 +3,8 @@
 # Copyright 2015 Platform9 Systems Inc.
 # All Rights Reserved.
 
+# extension_api: plugin
+
 
 import json
 import netifaces
@@ -43,6 +45,8 @@ def get_addresses():
     return list(nonlocal_ips)
 
 
+def get_data():
+    return get_addresses()
+
 if __name__ == '__main__':
-    out = get_addresses()
-    sys.stdout.write(json.dumps(out))
+    sys.stdout.write(json.dumps(get_data()))
@@ -1,10 +1,15 @@
 #!/opt/pf9/hostagent/bin/python
 
+# extension_api: plugin
+
 import json
 
 import cpuinfo
 import psutil
 
+# Read once: py-cpuinfo runs a python subprocess for every query
+CLOCK_RATE = cpuinfo.get_cpu_info()['hz_actual'][0]
+
 
 def get_disk_usage():
     usage = psutil.disk_usage('/')
@@ -18,18 +23,20 @@ def get_disk_usage():
     }
 
 
-def get_cpu_usage():
-    cpu_info = cpuinfo.get_cpu_info()
-    cpu_percent = psutil.cpu_percent(0.5)
-    clock_rate = cpu_info['hz_actual'][0]
+def get_cpu_usage(interval=None):
+    """
+    :param float interval: seconds to measure the cpu usage over. If None,
+        the usage since the previous call is returned.
+    """
+    cpu_percent = psutil.cpu_percent(interval)
     return {
         'percent': cpu_percent,
-        'total': clock_rate,
-        'used': clock_rate * cpu_percent / 100
+        'total': CLOCK_RATE,
+        'used': CLOCK_RATE * cpu_percent / 100
     }
 
 
-def main():
+def get_data(cpu_interval=None):
     mem = psutil.virtual_memory()
 
     usage = {
@@ -39,10 +46,18 @@ def main():
             'total': mem.total,
             'available': mem.available
         },
-        'cpu': get_cpu_usage()
+        'cpu': get_cpu_usage(cpu_interval)
     }
-    print(json.dumps(usage, indent=3))
+    return usage
+
+
+def main():
+    print(json.dumps(get_data(0.5), indent=3))
 
 
 if __name__ == '__main__':
     main()
+else:
+    # Loaded as a plugin: the cpu usage is measured between the calls to
+    # get_data() instead of blocking in each one, start the first interval
+    psutil.cpu_percent(None)
@@ -3,6 +3,9 @@
 # Copyright 2015 Platform9 Systems Inc.
 # All Rights Reserved.
 
+# refresh_interval: 300
+# extension_api: plugin
+
 import json
 import sys
 import subprocess
@@ -36,6 +39,8 @@ def get_volumes_list():
             process_lines = True
     return required_data
 
+def get_data():
+    return get_volumes_list()
+
 if __name__ == '__main__':
-    out = get_volumes_list()
-    sys.stdout.write(json.dumps(out))
+    sys.stdout.write(json.dumps(get_data()))
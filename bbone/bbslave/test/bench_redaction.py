@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Benchmarks the support bundle redaction on a generated log file.
+Compares the single pass redaction engine with applying the same rules one
+after the other over the whole file content, as it was done before.
+
+Usage: bench_redaction.py [size in MB, default 1024] [log file]
+"""
+
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+from datagatherer import datagatherer
+
+LINES = [
+    b'2018-06-01 10:%02d:%02d,123 - INFO - kubelet: Successfully probed '
+    b'container "etcd" in pod "etcd-node-%d" (readiness)\n',
+    b'2018-06-01 10:%02d:%02d,456 - DEBUG - hostagent: heartbeat sent, '
+    b'%d bytes, status ok\n',
+    b'I0601 10:%02d:%02d.000 kube-proxy iptables sync took %dms\n',
+]
+SENSITIVE_LINES = [
+    b'2018-06-01 10:%02d:%02d,789 - DEBUG - config: password = "hunter%d"\n',
+    b'2018-06-01 10:%02d:%02d,789 - DEBUG - env: VAULT_TOKEN=s.%d\n',
+    b'-----BEGIN CERTIFICATE REQUEST-----\nMIIC%02d%02d%d\n'
+    b'-----END CERTIFICATE REQUEST-----\n',
+]
+
+
+def generate_log(path, size):
+    rand = random.Random(0)
+    written = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            block = []
+            for _ in range(1000):
+                lines = SENSITIVE_LINES if rand.random() < 0.001 else LINES
+                block.append(rand.choice(lines) % (rand.randrange(60),
+                                                   rand.randrange(60),
+                                                   rand.randrange(1000)))
+            data = b''.join(block)
+            f.write(data)
+            written += len(data)
+
+
+def redact_per_rule(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+    for pattern, replace in datagatherer.sensitive_patterns:
+        content = re.sub(pattern, lambda m: replace(m.group()), content,
+                         flags=re.IGNORECASE)
+    return content
+
+
+def redact_single_pass(path):
+    with open(path, 'rb') as f:
+        edits, length = datagatherer.redactor.scan(f)
+        reader = datagatherer.RedactedReader(f, edits, length)
+        while reader.read(1024 * 1024):
+            pass
+    return edits
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+    else:
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+    try:
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            generate_log(path, size * 1024 * 1024)
+        mb = os.path.getsize(path) / (1024.0 * 1024)
+        for name, func in [('single pass', redact_single_pass),
+                           ('per rule', redact_per_rule)]:
+            start = time.time()
+            func(path)
+            elapsed = time.time() - start
+            print('%-12s %8.1f MB in %6.2fs: %7.1f MB/s'
+                  % (name, mb, elapsed, mb / elapsed))
+    finally:
+        if len(sys.argv) <= 2:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
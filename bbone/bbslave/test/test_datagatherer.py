@@ -0,0 +1,213 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests the support bundle generation with files in a temporary directory.
+"""
+
+import datetime
+import logging as log
+import os
+import re
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from datagatherer import datagatherer, redaction
+
+
+def _write_cert(fpath):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048,
+                                   backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u'test')])
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(0xabcdef1) \
+        .not_valid_before(datetime.datetime(2020, 3, 5, 12, 0, 0)) \
+        .not_valid_after(datetime.datetime(2030, 11, 25, 8, 30, 0)) \
+        .sign(key, hashes.SHA256(), default_backend())
+    with open(fpath, 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+def test_extract_certificate_info():
+    dirname = tempfile.mkdtemp()
+    try:
+        cert = os.path.join(dirname, 'ca.crt')
+        _write_cert(cert)
+        info = datagatherer.extract_certificate_info(cert)
+        assert info == ('Mar  5 12:00:00 2020 GMT',
+                        'Nov 25 08:30:00 2030 GMT', '0ABCDEF1')
+        if shutil.which('openssl'):
+            # Same output as the openssl command line
+            expected = tuple(
+                subprocess.check_output(
+                    ['openssl', 'x509', '-in', cert, '-noout', option],
+                    text=True).strip().split('=')[1]
+                for option in ['-startdate', '-enddate', '-serial'])
+            assert info == expected
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_generate_support_bundle():
+    dirname = tempfile.mkdtemp()
+    old_file_list = datagatherer.default_file_list
+    old_logging_dir = datagatherer.support_logging_dir
+    try:
+        etc = os.path.join(dirname, 'etc')
+        os.makedirs(os.path.join(etc, 'sub'))
+        files = {
+            'plain.txt': 'nothing to see\n',
+            'hostagent.conf': 'user = foo\npassword = secret\n',
+            'sub/agent.log': 'csr -----BEGIN CERTIFICATE REQUEST-----\n'
+                             'MIIB\n-----END CERTIFICATE REQUEST-----\n',
+            'config.json': '{"vault": {"VAULT_TOKEN": "abc"}, "x": 1}',
+            'key.pem': 'private key',
+        }
+        for name, content in files.items():
+            with open(os.path.join(etc, name), 'w') as f:
+                f.write(content)
+        _write_cert(os.path.join(etc, 'sub', 'ca.crt'))
+
+        datagatherer.default_file_list = [etc + '/**', etc + '/plain.txt']
+        datagatherer.support_logging_dir = os.path.join(dirname, 'support')
+        out_file = os.path.join(dirname, 'bundle.tgz')
+        datagatherer.generate_support_bundle(out_file, log, max_workers=2)
+
+        with tarfile.open(out_file) as tgz:
+            names = tgz.getnames()
+            contents = dict((name, tgz.extractfile(name).read().decode())
+                            for name in names)
+        prefix = os.path.relpath(etc, '/') + '/'
+        assert sorted(names) == sorted(prefix + name for name in
+                                       ['plain.txt', 'hostagent.conf',
+                                        'sub/agent.log', 'config.json',
+                                        'sub/ca.crt'])
+        assert contents[prefix + 'plain.txt'] == 'nothing to see\n'
+        assert 'secret' not in contents[prefix + 'hostagent.conf']
+        assert 'REDACTED' in contents[prefix + 'sub/agent.log']
+        assert 'MIIB' not in contents[prefix + 'sub/agent.log']
+        assert '"VAULT_TOKEN": "REDACTED"' in contents[prefix + 'config.json']
+        assert contents[prefix + 'sub/ca.crt'].startswith(
+            'start_date=Mar  5 12:00:00 2020 GMT, ')
+        # Nothing is written next to the files
+        assert sorted(os.listdir(etc)) == sorted(['sub', 'plain.txt',
+                                                  'hostagent.conf',
+                                                  'config.json', 'key.pem'])
+        assert sorted(os.listdir(os.path.join(etc, 'sub'))) == \
+            ['agent.log', 'ca.crt']
+    finally:
+        datagatherer.default_file_list = old_file_list
+        datagatherer.support_logging_dir = old_logging_dir
+        shutil.rmtree(dirname)
+
+
+REDACTION_SAMPLES = [
+    (b'nothing to see', b'nothing to see'),
+    (b'db_password = secret; port = 5432', b'db_password =REDACTED; port = 5432'),
+    (b'password="a;b" tail\n', b'password=REDACTED\n'),
+    (b"Password = 'x' ; next\n", b'Password =REDACTED; next\n'),
+    (b'export OS_PASSWORD="secret"', b'export OS_PASSWORD=REDACTED'),
+    (b'VAULT_TOKEN=s.abc123; x=1', b'VAULT_TOKEN=REDACTED; x=1'),
+    (b'    client-key-data: LS0tLS1CRUdJTg==\n',
+     b'    client-key-data=REDACTED\n'),
+    (b'certificate-authority-data:\n  LS0tLS1CRUdJTg==\n',
+     b'certificate-authority-data=REDACTED\n'),
+    (b'ETCD_INITIAL_CLUSTER_TOKEN=abc other\\n',
+     b'ETCD_INITIAL_CLUSTER_TOKEN=REDACTED\\n'),
+    (b'ETCD_INITIAL_CLUSTER_TOKEN: abc', b'ETCD_INITIAL_CLUSTER_TOKEN=REDACTED'),
+    (b'csr: -----BEGIN CERTIFICATE REQUEST-----\nMIIB\nabc\n'
+     b'-----END CERTIFICATE REQUEST----- done',
+     b'csr: -----BEGIN CERTIFICATE REQUEST-----\nREDACTED\n'
+     b'-----END CERTIFICATE REQUEST----- done'),
+    # Not valid UTF-8
+    (b'\xff\xfe password = secret\n', b'\xff\xfe password =REDACTED\n'),
+]
+
+
+def _redact_everywhere(content):
+    """
+    Applies the redaction rules at every position, without looking for
+    their keywords first.
+    """
+    rules = datagatherer.sensitive_patterns
+    pattern = re.compile(b'|'.join(b'(' + p + b')' for p, _ in rules),
+                         re.IGNORECASE)
+    return pattern.sub(lambda m: rules[m.lastindex - 1][1](m.group()),
+                       content)
+
+
+def test_redaction_rules():
+    for content, expected in REDACTION_SAMPLES:
+        redacted, _ = datagatherer.redactor.redact(content)
+        assert redacted == expected, content
+        assert redacted == _redact_everywhere(content), content
+    assert datagatherer.redact_sensitive_key_values('password = x') == \
+        'password =REDACTED'
+
+
+def test_redaction_stream():
+    # Matches across the boundaries of the blocks are redacted
+    content = b''.join(b'%06d filler line\n' % i + sample
+                       for i in range(2000)
+                       for sample, _ in REDACTION_SAMPLES)
+    expected, _ = datagatherer.redactor.redact(content)
+    assert expected == _redact_everywhere(content)
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        for block_size in [1000, 4096, 100000]:
+            f = open(path, 'rb')
+            edits, length = datagatherer.redactor.scan(f, block_size)
+            assert length == len(content)
+            reader = redaction.RedactedReader(f, edits, length)
+            redacted = b''
+            while True:
+                data = reader.read(777)
+                if not data:
+                    break
+                redacted += data
+            reader.close()
+            assert reader.size == len(expected)
+            assert redacted == expected
+    finally:
+        os.unlink(path)
+
+
+def test_redaction_stream_truncated():
+    # Truncated in place after the scan, like by logrotate's copytruncate
+    content = b''.join(b'%06d filler line\n' % i + sample
+                       for i in range(200)
+                       for sample, _ in REDACTION_SAMPLES)
+    expected, _ = datagatherer.redactor.redact(content)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'app.log')
+        with open(path, 'wb') as f:
+            f.write(content)
+        f = open(path, 'rb')
+        edits, length = datagatherer.redactor.scan(f)
+        reader = redaction.RedactedReader(f, edits, length)
+        os.truncate(path, len(content) // 2)
+        tgz = os.path.join(tmpdir, 'bundle.tgz')
+        with tarfile.open(tgz, 'w:gz') as tgzfile:
+            datagatherer._add_redacted_file(tgzfile, path, 'app.log', reader)
+            datagatherer._add_content(tgzfile, path, 'next.log', 'next')
+        with tarfile.open(tgz, 'r:gz') as tgzfile:
+            redacted = tgzfile.extractfile('app.log').read()
+            assert tgzfile.extractfile('next.log').read() == b'next'
+        assert len(redacted) == len(expected)
+        kept = redacted.rstrip(b'\0')
+        assert expected.startswith(kept)
+        assert len(kept) >= len(content) // 4
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,160 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests the host agent extension runner with scripts in a temporary
+extensions directory.
+"""
+
+import logging as log
+import os
+import shutil
+import tempfile
+import time
+
+from bbslave import extensions
+from bbslave.extensions import ExtensionRunner
+
+SCRIPT = '''#!/bin/sh
+# refresh_interval: %(interval)d
+sleep %(sleep)s
+echo "{\\"count\\": $(cat %(counter)s | wc -l)}"
+echo x >> %(counter)s
+'''
+
+
+def _write_script(dirname, name, interval=0, sleep=0):
+    counter = os.path.join(dirname, name + '.count')
+    open(counter, 'w').close()
+    fpath = os.path.join(dirname, name)
+    with open(fpath, 'w') as f:
+        f.write(SCRIPT % {'interval': interval, 'sleep': sleep,
+                          'counter': counter})
+    os.chmod(fpath, 0o755)
+
+
+def test_extension_runner():
+    dirname = tempfile.mkdtemp()
+    try:
+        _write_script(dirname, 'fetch_fast')
+        _write_script(dirname, 'fetch_slow', sleep=1)
+        _write_script(dirname, 'check_cached', interval=300)
+        # Not executable
+        open(os.path.join(dirname, 'fetch_other'), 'w').close()
+
+        runner = ExtensionRunner(dirname, log, wait_timeout=0.5)
+        data = runner.get_data()
+        assert data == {
+            'fast': {'status': 'ok', 'data': {'count': 0}},
+            'cached': {'status': 'ok', 'data': {'count': 0}}
+        }
+
+        # The slow extension completed in the background and is reported
+        # while its next run is in progress
+        time.sleep(1)
+        data = runner.get_data()
+        assert data == {
+            'fast': {'status': 'ok', 'data': {'count': 1}},
+            'slow': {'status': 'ok', 'data': {'count': 0}},
+            'cached': {'status': 'ok', 'data': {'count': 0}}
+        }
+
+        os.unlink(os.path.join(dirname, 'fetch_fast'))
+        time.sleep(1)
+        data = runner.get_data()
+        assert data == {
+            'slow': {'status': 'ok', 'data': {'count': 1}},
+            'cached': {'status': 'ok', 'data': {'count': 0}}
+        }
+    finally:
+        shutil.rmtree(dirname)
+
+
+PLUGIN = '''#!/usr/bin/env python
+# extension_api: plugin
+import json
+calls = []
+
+def get_data():
+    calls.append(1)
+    if %(fail)s:
+        raise ValueError('failed')
+    return {'calls': len(calls)}
+
+if __name__ == '__main__':
+    print(json.dumps({'calls': 'script'}))
+'''
+
+
+def _write_plugin(dirname, name, fail=False):
+    fpath = os.path.join(dirname, name)
+    with open(fpath, 'w') as f:
+        f.write(PLUGIN % {'fail': fail})
+    os.chmod(fpath, 0o755)
+    return fpath
+
+
+def test_extension_plugins():
+    dirname = tempfile.mkdtemp()
+    try:
+        _write_plugin(dirname, 'fetch_plugin')
+        _write_plugin(dirname, 'fetch_failing', fail=True)
+        # A plugin without get_data() is run as a script
+        with open(_write_plugin(dirname, 'fetch_script'), 'a') as f:
+            f.write('del get_data\n')
+
+        runner = ExtensionRunner(dirname, log)
+        data = runner.get_data()
+        assert data['plugin'] == {'status': 'ok', 'data': {'calls': 1}}
+        assert data['failing']['status'] == 'error'
+        assert data['script'] == {'status': 'ok', 'data': {'calls': 'script'}}
+
+        # The plugin is imported once
+        data = runner.get_data()
+        assert data['plugin'] == {'status': 'ok', 'data': {'calls': 2}}
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_extension_plugins_contained(monkeypatch):
+    monkeypatch.setattr(extensions, 'EXTENSION_TIMEOUT', 0)
+    dirname = tempfile.mkdtemp()
+    try:
+        with open(_write_plugin(dirname, 'fetch_exiting'), 'a') as f:
+            f.write('def get_data():\n'
+                    '    import sys\n'
+                    '    sys.exit(1)\n')
+        with open(_write_plugin(dirname, 'fetch_hanging'), 'a') as f:
+            f.write('def get_data():\n'
+                    '    import time\n'
+                    '    calls.append(1)\n'
+                    '    time.sleep(1)\n'
+                    '    return {"calls": len(calls)}\n')
+        _write_script(dirname, 'fetch_script')
+
+        # A hanging plugin doesn't hold up the scripts
+        runner = ExtensionRunner(dirname, log, max_workers=1,
+                                 wait_timeout=0.5)
+        data = runner.get_data()
+        assert data['exiting']['status'] == 'error'
+        assert data['hanging']['status'] == 'timed-out'
+        assert data['script'] == {'status': 'ok', 'data': {'count': 0}}
+
+        # and isn't run again
+        time.sleep(1)
+        runner.get_data()
+        data = runner.get_data()
+        assert data['hanging'] == {'status': 'ok', 'data': {'calls': 1}}
+        assert data['script']['status'] == 'ok'
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_shipped_extensions():
+    extensions_path = os.path.join(os.path.dirname(__file__), '..',
+                                   'extensions')
+    runner = ExtensionRunner(extensions_path, log, wait_timeout=30)
+    data = runner.get_data()
+    for name in ['cpu_stats', 'interfaces', 'ip_address', 'resource_usage']:
+        assert data[name]['status'] == 'ok', data[name]
+        assert runner._extensions[name].module is not None
@@ -0,0 +1,130 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests the worker that runs the session work off the pika I/O loop.
+"""
+
+import logging as log
+import threading
+
+from pika.adapters.select_connection import IOLoop
+from pika.exceptions import AMQPConnectionError
+
+from bbslave.session_worker import SessionWorker
+
+
+def test_serialized_and_coalesced():
+    done = []
+    errors = []
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def _work(name):
+        if name == 'first':
+            blocked.set()
+            release.wait()
+        if name == 'bad':
+            raise ValueError(name)
+        done.append(name)
+
+    worker = SessionWorker(log, error_cb=errors.append)
+    worker.start()
+    try:
+        assert worker.submit('set_config', _work, 'first')
+        blocked.wait()
+        # Queued while the worker is busy
+        assert worker.submit('heartbeat', _work, 'hb1')
+        assert not worker.submit('heartbeat', _work, 'hb2')
+        assert not worker.submit('ping', _work, 'ping1')
+        assert worker.submit('set_config', _work, 'set_config')
+        assert worker.submit('ping', _work, 'ping2')
+        assert not worker.submit('heartbeat', _work, 'hb3')
+        assert worker.submit('get_support', _work, 'bad')
+        assert worker.submit('heartbeat', _work, 'hb4')
+        release.set()
+        finished = threading.Event()
+        worker.submit('exit', finished.set)
+        assert finished.wait(10)
+    finally:
+        worker.stop()
+    assert done == ['first', 'hb1', 'set_config', 'ping2', 'hb4']
+    assert len(errors) == 1 and isinstance(errors[0][1], ValueError)
+    assert not worker.submit('heartbeat', _work, 'hb5')
+
+
+def test_run_in_io_loop():
+    loop = IOLoop()
+    loop_thread = threading.Thread(target=loop.start)
+    results = []
+
+    def _fail():
+        raise KeyError('x')
+
+    def _work():
+        assert worker.in_worker()
+        results.append(worker.run_in_io_loop(
+            loop, lambda n: (n, threading.current_thread()), 1))
+        try:
+            worker.run_in_io_loop(loop, _fail)
+        except KeyError as e:
+            results.append(e)
+        loop.add_callback_threadsafe(loop.stop)
+
+    worker = SessionWorker(log)
+    worker.start()
+    loop_thread.start()
+    try:
+        worker.submit('heartbeat', _work)
+        loop_thread.join(10)
+        assert not loop_thread.is_alive()
+    finally:
+        worker.stop()
+    assert results[0] == (1, loop_thread)
+    assert isinstance(results[1], KeyError)
+    # Called right away outside of the worker
+    assert worker.run_in_io_loop(None, lambda: 2) == 2
+
+
+def test_stop_while_waiting_for_io_loop():
+    # Never started, like after the connection closed
+    loop = IOLoop()
+    waiting = threading.Event()
+    results = []
+    errors = []
+
+    def _work():
+        waiting.set()
+        try:
+            worker.run_in_io_loop(loop, lambda: 1)
+        except AMQPConnectionError as e:
+            results.append(e)
+            raise
+
+    worker = SessionWorker(log, error_cb=errors.append)
+    worker.start()
+    worker.submit('heartbeat', _work)
+    waiting.wait()
+    worker.stop()
+    assert len(results) == 1
+    # Failures of stopped work don't end the next session
+    assert errors == []
+
+
+def test_base_exception():
+    errors = []
+    done = threading.Event()
+
+    def _exit():
+        raise SystemExit(1)
+
+    worker = SessionWorker(log, error_cb=errors.append)
+    worker.start()
+    try:
+        worker.submit('set_config', _exit)
+        # The worker keeps running the work
+        worker.submit('heartbeat', done.set)
+        assert done.wait(10)
+    finally:
+        worker.stop()
+    assert len(errors) == 1 and isinstance(errors[0][1], SystemExit)
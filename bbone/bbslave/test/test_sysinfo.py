@@ -0,0 +1,74 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests that the host facts are cached and refreshed in the background.
+"""
+
+import logging as log
+import threading
+import time
+
+from bbslave import sysinfo
+
+
+def _wait_refreshed():
+    for _ in range(100):
+        if not sysinfo._host_facts['refreshing']:
+            return
+        time.sleep(0.05)
+    assert False
+
+
+def test_host_facts(monkeypatch, tmp_path):
+    lookups = []
+    lookup_done = threading.Event()
+
+    def getfqdn():
+        lookups.append(sysinfo.socket.gethostname())
+        lookup_done.wait(5)
+        return lookups[-1] + '.example.com'
+
+    hostname = ['host1']
+    monkeypatch.setenv('HOSTAGENT_HOST_ID_BASEDIR', str(tmp_path))
+    monkeypatch.setattr(sysinfo.socket, 'getfqdn', getfqdn)
+    monkeypatch.setattr(sysinfo.socket, 'gethostname', lambda: hostname[0])
+    monkeypatch.setattr(sysinfo, 'CPU_INFO', {'cpu_cores': 1})
+    monkeypatch.setattr(sysinfo, '_host_facts', dict(sysinfo._host_facts,
+                                                     facts=None, key=None))
+
+    # The DNS lookup doesn't block the first call
+    info = sysinfo.get_sysinfo(log)
+    assert info['hostname'] == 'host1'
+    assert info['cpu_info'] == {'cpu_cores': 1}
+    lookup_done.set()
+    _wait_refreshed()
+    assert sysinfo.get_sysinfo(log)['hostname'] == 'host1.example.com'
+    assert sysinfo.get_sysinfo(log)['hostname'] == 'host1.example.com'
+    assert lookups == ['host1']
+
+    # Renaming the host triggers a refresh
+    hostname[0] = 'host2'
+    lookup_done.clear()
+    assert sysinfo.get_sysinfo(log)['hostname'] == 'host1.example.com'
+    lookup_done.set()
+    _wait_refreshed()
+    assert sysinfo.get_sysinfo(log)['hostname'] == 'host2.example.com'
+    assert lookups == ['host1', 'host2']
+
+    # So does the TTL
+    sysinfo._host_facts['time'] -= sysinfo.HOST_FACTS_TTL
+    sysinfo.get_sysinfo(log)
+    _wait_refreshed()
+    assert lookups == ['host1', 'host2', 'host2']
+
+    # After a restart, the name looked up before is used until the lookup
+    # completes, unless the host was renamed
+    lookup_done.clear()
+    sysinfo._host_facts.update(facts=None, key=None)
+    assert sysinfo.get_sysinfo(log)['hostname'] == 'host2.example.com'
+    hostname[0] = 'host3'
+    sysinfo._host_facts.update(facts=None, key=None)
+    assert sysinfo.get_sysinfo(log)['hostname'] == 'host3'
+    lookup_done.set()
+    _wait_refreshed()
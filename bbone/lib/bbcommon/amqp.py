@@ -18,7 +18,8 @@ def io_loop(log,
             consume_cb=None,
             virtual_host=None,
             ssl_options=None,
-            channel_close_cb=None):
+            channel_close_cb=None,
+            auto_delete=False):
     """
     Connects to AMQP broker and enters message processing loop
     :param str host: The broker host name or IP
@@ -35,6 +36,8 @@ def io_loop(log,
     :param dict ssl_options: SSL options if SSL is enabled (optional)
     :param function channel_close_cb: Called when channel is closed, with
            the AMQP reply_text as parameter
+    :param bool auto_delete: Whether the broker deletes the receive queue
+           once its last consumer is gone (optional)
     """
 
     def add_on_connection_close_callback():
@@ -84,7 +87,8 @@ def io_loop(log,
             return
         state['channel'].queue_declare(queue=queue_name,
                                        callback=on_queue_declare,
-                                       exclusive=False)
+                                       exclusive=False,
+                                       auto_delete=auto_delete)
 
     def on_queue_declare(method_frame):
         # This method would be called back multiple times if there are multiple
@@ -0,0 +1,116 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Encoding of the backbone messages on the wire. Messages are JSON documents,
+sent as plain JSON unless the receiver advertised that it understands one of
+the compressed encodings. A message can also carry a binary payload (e.g. a
+support bundle) as the raw message body, with the JSON document in a header.
+
+The sender of a message lists the encodings it understands in the message's
+'accept_encodings' field. Receivers decode whatever they get based on the
+AMQP content type and encoding properties, so plain JSON from older senders
+keeps working.
+"""
+
+import gzip
+import json
+import zlib
+
+import pika
+
+JSON_CONTENT_TYPE = 'application/json'
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+
+# Compressed encodings, in order of preference
+COMPRESSED_ENCODINGS = ['zlib', 'gzip']
+# Pseudo encoding for messages with a binary payload
+BINARY_ENCODING = 'binary'
+# Pseudo encoding for support bundles sent as a series of binary messages
+CHUNKED_ENCODING = 'chunked'
+SUPPORTED_ENCODINGS = COMPRESSED_ENCODINGS + [BINARY_ENCODING,
+                                              CHUNKED_ENCODING]
+
+# Header holding the JSON document of a message with a binary payload
+MSG_HEADER = 'bbone-msg'
+
+# Smaller messages aren't worth compressing
+MIN_COMPRESS_SIZE = 512
+
+
+def choose_encoding(accepted):
+    """
+    :param list accepted: the encodings the receiver understands, or None
+    :return: the compressed encoding to use, or None for plain JSON
+    """
+    for encoding in COMPRESSED_ENCODINGS:
+        if accepted and encoding in accepted:
+            return encoding
+    return None
+
+
+def encode_msg(msg, encoding=None, payload=None):
+    """
+    Encodes a message. Advertises the supported encodings in the message.
+    :param dict msg: the message
+    :param str encoding: compressed encoding to use, None for plain JSON
+    :param bytes payload: binary payload. Only for receivers that accept
+        BINARY_ENCODING.
+    :return: tuple of the message body and the AMQP properties to send it
+        with
+    :rtype: tuple
+    """
+    msg['accept_encodings'] = SUPPORTED_ENCODINGS
+    if payload is not None:
+        # The payload is sent as is, it's usually compressed already
+        properties = pika.BasicProperties(
+            content_type=BINARY_CONTENT_TYPE,
+            headers={MSG_HEADER: json.dumps(msg)})
+        return payload, properties
+
+    body = json.dumps(msg).encode()
+    if encoding is not None and len(body) < MIN_COMPRESS_SIZE:
+        encoding = None
+    if encoding == 'zlib':
+        body = zlib.compress(body)
+    elif encoding == 'gzip':
+        body = gzip.compress(body)
+    elif encoding is not None:
+        raise ValueError('Unsupported content encoding %s' % encoding)
+    properties = pika.BasicProperties(content_type=JSON_CONTENT_TYPE,
+                                      content_encoding=encoding)
+    return body, properties
+
+
+def decode_msg(properties, body):
+    """
+    Decodes a message received with the given AMQP properties.
+    :param pika.BasicProperties properties: properties of the message, None
+        if not known
+    :param bytes body: the message body
+    :return: the message. The binary payload, if any, is in its 'payload'
+        field.
+    :rtype: dict
+    :raises ValueError: if the message is malformed
+    """
+    content_type = getattr(properties, 'content_type', None)
+    encoding = getattr(properties, 'content_encoding', None)
+    if content_type == BINARY_CONTENT_TYPE:
+        headers = getattr(properties, 'headers', None) or {}
+        if MSG_HEADER not in headers:
+            raise ValueError('Binary message without a %s header' % MSG_HEADER)
+        msg = json.loads(headers[MSG_HEADER])
+        msg['payload'] = body
+        return msg
+
+    try:
+        if encoding == 'zlib':
+            body = zlib.decompress(body)
+        elif encoding == 'gzip':
+            body = gzip.decompress(body)
+        elif encoding not in (None, '', 'identity'):
+            raise ValueError('Unsupported content encoding %s' % encoding)
+    except (zlib.error, EOFError, OSError) as e:
+        raise ValueError('Corrupt %s message: %s' % (encoding, e))
+    # Python3: JSON object cannot be 'bytes'. It has to be a string.
+    return json.loads(body.decode())
@@ -3,9 +3,10 @@
 
 __author__ = 'leb'
 
+import itertools
 import logging
 import re
-import distro
+from concurrent import futures
 from logging import Logger
 
 from pf9app.app import App, RemoteApp
@@ -14,12 +15,16 @@ from pf9app.app_cache import AppCache
 from configutils.configutils import is_dict_subset
 from pf9app.exceptions import InvalidSupportedDistro, UrlNotSpecified,\
     PackageFileNameNotSpecified
-from pf9app.pf9_app_cache import get_supported_distro
+from pf9app.pf9_app_cache import get_supported_distro, get_linux_distribution
+
+# Number of apps downloaded at a time
+DOWNLOAD_WORKERS = 4
 
 def process_apps(app_db, app_cache, remote_app_class, new_config,
                  non_destructive=False, probe_only=False, log=logging,
                  current_config=None,
-                 url_interpolations=None):
+                 url_interpolations=None,
+                 download_workers=DOWNLOAD_WORKERS):
     """
     Processes the transition from a current to a new application configuration.
 
@@ -41,6 +46,9 @@ def process_apps(app_db, app_cache, remote_app_class, new_config,
      if not specified, the function will obtain the current state from the appdb
     :param dict url_interpolations: An optional dictionary containing
      string substitutions for the url property of a pf9 application
+    :param int download_workers: number of apps downloaded at a time. All
+     the apps to install or upgrade are downloaded before the first one is
+     installed.
     :return: the number of application changes
     :rtype: int
     """
@@ -73,7 +81,7 @@ def process_apps(app_db, app_cache, remote_app_class, new_config,
 
     def get_os_name():
         supported_distro = get_supported_distro(log)
-        version = distro.linux_distribution()[1].lower()
+        version = get_linux_distribution()[1].lower()
         if supported_distro.startswith('centos'):
             supported_distro = 'centos'
 
@@ -118,14 +126,49 @@ def process_apps(app_db, app_cache, remote_app_class, new_config,
         return url, change_extension
 
     ## Install dependencies: libcgroup-tools
-    new_app = remote_app_class(name="libcgroup-tools",
-                               version=None,
-                               url=None,
-                               change_extension=None,
-                               app_db=app_db,
-                               app_cache=app_cache,
-                               log=log)
-    new_app.install_dep()
+    if not probe_only:
+        new_app = remote_app_class(name="libcgroup-tools",
+                                   version=None,
+                                   url=None,
+                                   change_extension=None,
+                                   app_db=app_db,
+                                   app_cache=app_cache,
+                                   log=log)
+        new_app.install_dep()
+
+    remote_apps = {}
+
+    def make_remote_app(app_name):
+        """
+        Return the remote app object of an app to install or upgrade.
+        """
+        if app_name not in remote_apps:
+            new_app_spec = new_config[app_name]
+            url, change_extension = url_from_app_spec(new_app_spec)
+            remote_apps[app_name] = remote_app_class(
+                name=app_name,
+                version=new_app_spec['version'],
+                url=url,
+                change_extension=change_extension,
+                app_db=app_db,
+                app_cache=app_cache,
+                log=log)
+        return remote_apps[app_name]
+
+    if not probe_only:
+        # Download all the apps to install or upgrade first, concurrently.
+        # They are still installed in rank order.
+        prefetched_apps = []
+        for app_name in identical_app_names + new_app_names:
+            if app_name in installed_apps and installed_apps[app_name].version \
+                    == new_config[app_name]['version']:
+                continue
+            try:
+                prefetched_apps.append(make_remote_app(app_name))
+            except Exception as e:
+                # Reported when the app is processed below
+                log.debug('Not prefetching %s: %s', app_name, e)
+        prefetch_apps(prefetched_apps, log, download_workers)
 
     for app_name in identical_app_names:
         app = installed_apps[app_name]
@@ -135,14 +178,7 @@ def process_apps(app_db, app_cache, remote_app_class, new_config,
         new_app_config = new_app_spec['config']
         if app.version != new_app_spec['version']:
             if not probe_only:
-                url, change_extension = url_from_app_spec(new_app_spec)
-                new_app = remote_app_class(name=app_name,
-                                           version=new_app_spec['version'],
-                                           url=url,
-                                           change_extension=change_extension,
-                                           app_db=app_db,
-                                           app_cache=app_cache,
-                                           log=log)
+                new_app = make_remote_app(app_name)
                 assert isinstance(new_app, RemoteApp)
                 new_app.download()
                 app.uninstall()
@@ -172,27 +208,25 @@ def process_apps(app_db, app_cache, remote_app_class, new_config,
                 if not probe_only:
                     app.set_desired_service_states(services)
                 changes += 1
-    for app_name in new_app_names:
+    # Apps of the same rank can be installed in any order, they are installed
+    # together
+    for rank, app_names in itertools.groupby(
+            new_app_names, key=lambda app_name: get_app_rank(app_name,
+                                                             new_config)):
+        app_names = list(app_names)
         if not probe_only:
-            new_app_spec = new_config[app_name]
-            new_app_config = new_app_spec['config']
-            services = new_app_spec.get('service_states')
-            url, change_extension = url_from_app_spec(new_app_spec)
-            new_app = remote_app_class(name=app_name,
-                                       version=new_app_spec['version'],
-                                       url=url,
-                                       change_extension=change_extension,
-                                       app_db=app_db,
-                                       app_cache=app_cache,
-                                       log=log)
-            assert isinstance(new_app, RemoteApp)
-            new_app.download()
-            new_app.install()
-            new_app.set_config(new_app_config)
-            if services is None:
-                services = { app_name : new_app_spec['running'] }
-            new_app.set_desired_service_states(services)
-        changes += 1
+            new_apps = [make_remote_app(app_name) for app_name in app_names]
+            for new_app in new_apps:
+                assert isinstance(new_app, RemoteApp)
+            remote_app_class.install_all(new_apps)
+            for app_name, new_app in zip(app_names, new_apps):
+                new_app_spec = new_config[app_name]
+                services = new_app_spec.get('service_states')
+                new_app.set_config(new_app_spec['config'])
+                if services is None:
+                    services = { app_name : new_app_spec['running'] }
+                new_app.set_desired_service_states(services)
+        changes += len(app_names)
     return changes
 
 def process_agent_update(agent_config, app_db, app_cache, agent_app_class, log):
@@ -226,10 +260,35 @@ def process_agent_update(agent_config, app_db, app_cache, agent_app_class, log):
     new_agent.update()
 
 
+def prefetch_apps(apps, log, max_workers=DOWNLOAD_WORKERS):
+    """
+    Downloads apps into the app cache concurrently. Download errors are only
+    logged: they are raised again when the app is downloaded for its
+    installation.
+    :param list apps: the RemoteApp objects to download
+    :param Logger log: log object
+    :param int max_workers: number of apps downloaded at a time
+    """
+    if not apps:
+        return
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloads = dict((executor.submit(app.download), app) for app in apps)
+        for future in futures.as_completed(downloads):
+            app = downloads[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.warn('Prefetching %s.%s failed: %s', app.name,
+                         app.version, e)
+
+
+def get_app_rank(app_name, app_config):
+    return float(app_config[app_name].get('rank', 0.0))
+
+
 def get_app_ordering(apps_to_order, app_config, log):
     """
     Given a list of apps to order and the config dict, return an ordered list
     of apps based on the app ranks
     """
-    return sorted(apps_to_order, key=lambda t:
-                                 float(app_config[t].get('rank', 0.0)))
+    return sorted(apps_to_order, key=lambda t: get_app_rank(t, app_config))
@@ -128,4 +128,15 @@ class RemoteApp(App):
         """
         pass
 
+    @classmethod
+    def install_all(cls, apps):
+        """
+        Installs several apps, downloading them first if needed. The apps
+        are installed in no particular order.
+        :param list apps: the apps, instances of this class
+        """
+        for app in apps:
+            app.download()
+            app.install()
+
 
@@ -36,6 +36,13 @@ class AppDb(object):
         """
         pass
 
+    def app_config_changed(self, app):
+        """
+        Notify the AppDb that the configuration of an app was changed.
+        :param App app: the app
+        """
+        pass
+
     def install_package(self, path):
         """
         Installs the app represented by the path
@@ -43,6 +50,15 @@ class AppDb(object):
         """
         pass
 
+    def install_packages(self, paths):
+        """
+        Installs several apps, in a single transaction when the package
+        manager allows it
+        :param list paths: Local paths to the app packages
+        """
+        for path in paths:
+            self.install_package(path)
+
     def remove_package(self, app_name):
         """
         Removes a particular app from the host
@@ -0,0 +1,344 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Long-lived workers for the config scripts of pf9 apps.
+
+Running a config script means starting a Python interpreter and importing
+the app's Python stack, for every --get-config, --set-config or
+--get-services call. A worker runs the config script of an app in a single
+interpreter instead, for as long as the app version and the config script
+are unchanged: the modules imported by the script are only imported once.
+
+The host agent talks to the worker over its stdin and stdout, one JSON
+object per line, in the style of JSON-RPC:
+
+    -> {"jsonrpc": "2.0", "id": 1, "method": "run",
+        "params": {"args": ["--get-config"]}}
+    <- {"jsonrpc": "2.0", "id": 1,
+        "result": {"code": 0, "out": "{...}", "err": ""}}
+
+The result of the "run" method is the exit code and output the script would
+have had when run as a command with the same arguments. The worker sends
+{"jsonrpc": "2.0", "id": null, "result": "ready"} once it is started.
+
+Any worker failure makes the host agent fall back to running the config
+script as a command.
+"""
+
+import json
+import logging
+import os
+import runpy
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+# Seconds to wait for a worker to start
+START_TIMEOUT = 30
+
+# Seconds to wait for the result of a request
+REQUEST_TIMEOUT = 300
+
+# JSON-RPC error code of unknown methods
+METHOD_NOT_FOUND = -32601
+
+
+class WorkerError(Exception):
+    pass
+
+
+class ConfigScriptWorker(object):
+    """
+    Host agent side of the worker of a config script
+    """
+
+    def __init__(self, script, log=logging):
+        """
+        :param str script: path of the config script
+        :param Logger log: logger object
+        """
+        self.script = script
+        self.log = log
+        self._proc = None
+        self._buffer = b''
+        self._next_id = 1
+
+    def _read_line(self, timeout):
+        """
+        Reads a line from the worker's stdout.
+        :raises WorkerError: if the worker exited or did not answer in time
+        """
+        deadline = time.time() + timeout
+        fd = self._proc.stdout.fileno()
+        while b'\n' not in self._buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise WorkerError('Timed out waiting for the worker of %s' %
+                                  self.script)
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise WorkerError('The worker of %s exited' % self.script)
+                self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        try:
+            return json.loads(line.decode())
+        except ValueError:
+            raise WorkerError('Invalid message from the worker of %s: %r' %
+                              (self.script, line))
+
+    def start(self):
+        """
+        Starts the worker.
+        :raises WorkerError: if the worker did not start
+        """
+        try:
+            with open(os.devnull, 'w') as devnull:
+                self._proc = subprocess.Popen(
+                    [sys.executable, '-m', 'pf9app.config_worker',
+                     self.script],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=devnull,
+                    env=os.environ)
+        except OSError as e:
+            raise WorkerError('Could not start the worker of %s: %s' %
+                              (self.script, e))
+        try:
+            message = self._read_line(START_TIMEOUT)
+        except WorkerError:
+            self.stop()
+            raise
+        if message.get('result') != 'ready':
+            self.stop()
+            raise WorkerError('Unexpected message from the worker of %s: %s' %
+                              (self.script, message))
+        self.log.debug('Started the worker of %s, pid %d', self.script,
+                       self._proc.pid)
+
+    def stop(self):
+        """
+        Stops the worker, if it is running.
+        """
+        proc, self._proc = self._proc, None
+        self._buffer = b''
+        if proc is None:
+            return
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+    def run(self, args, timeout=REQUEST_TIMEOUT):
+        """
+        Runs the config script in the worker, starting it if needed.
+        :param list args: arguments of the config script
+        :param int timeout: seconds to wait for the result
+        :return: a tuple representing (code, stdout, stderr), like
+            pf9_app._run_command()
+        :rtype: tuple
+        :raises WorkerError: if the worker failed. It is stopped.
+        """
+        if self._proc is None:
+            self.start()
+        request_id = self._next_id
+        self._next_id += 1
+        request = {
+            'jsonrpc': '2.0',
+            'id': request_id,
+            'method': 'run',
+            'params': {'args': args}
+        }
+        try:
+            self._proc.stdin.write(json.dumps(request).encode() + b'\n')
+            self._proc.stdin.flush()
+            response = self._read_line(timeout)
+            if response.get('id') != request_id or 'result' not in response:
+                raise WorkerError('Unexpected response from the worker of '
+                                  '%s: %s' % (self.script, response))
+            result = response['result']
+            return result['code'], result['out'], result['err']
+        except (IOError, OSError, KeyError, TypeError) as e:
+            self.stop()
+            raise WorkerError('Request to the worker of %s failed: %s' %
+                              (self.script, e))
+        except WorkerError:
+            self.stop()
+            raise
+
+
+class ConfigScriptWorkers(object):
+    """
+    The config script workers of the installed apps
+    """
+
+    def __init__(self, log=logging):
+        self.log = log
+        self._lock = threading.Lock()
+        # App name to (key, worker, lock) tuples
+        self._workers = {}
+        # App name to the key for which the worker failed
+        self._failed = {}
+
+    def run(self, app_name, script, key, args):
+        """
+        Runs the config script of an app in its worker.
+        :param str app_name: name of the app
+        :param str script: path of the config script
+        :param key: identifies the app version and config script. The worker
+            is restarted when it changes.
+        :param list args: arguments of the config script
+        :return: a tuple representing (code, stdout, stderr), or None if the
+            worker is not available and the config script must be run as a
+            command
+        :rtype: tuple
+        """
+        stale_entry = None
+        with self._lock:
+            if self._failed.get(app_name) == key:
+                return None
+            entry = self._workers.get(app_name)
+            if entry and entry[0] != key:
+                stale_entry, entry = entry, None
+            if entry is None:
+                entry = (key, ConfigScriptWorker(script, self.log),
+                         threading.Lock())
+                self._workers[app_name] = entry
+        if stale_entry:
+            with stale_entry[2]:
+                stale_entry[1].stop()
+        _, worker, worker_lock = entry
+        with worker_lock:
+            try:
+                return worker.run(args)
+            except WorkerError as e:
+                self.log.warn('Not using a worker for the config script of '
+                              '%s: %s', app_name, e)
+        with self._lock:
+            if self._workers.get(app_name) is entry:
+                del self._workers[app_name]
+            # Until the app or its config script change
+            self._failed[app_name] = key
+        return None
+
+    def stop(self, app_name=None):
+        """
+        Stops the worker of an app, or all the workers.
+        :param str app_name: name of the app, None for all the apps
+        """
+        with self._lock:
+            if app_name is None:
+                entries = list(self._workers.values())
+                self._workers = {}
+            else:
+                entry = self._workers.pop(app_name, None)
+                entries = [entry] if entry else []
+        for _, worker, worker_lock in entries:
+            with worker_lock:
+                worker.stop()
+
+
+def _exit_code(code):
+    """
+    Returns the exit code of SystemExit(code), like the interpreter does.
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write('%s\n' % code)
+    return 1
+
+
+def _run_script(script, args):
+    """
+    Runs the config script as if it was started as a command, capturing its
+    output.
+    :return: tuple of the exit code, stdout and stderr
+    """
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        saved_fds = [os.dup(1), os.dup(2)]
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Also captures the output of the subprocesses of the script
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        sys.argv = [script] + list(args)
+        try:
+            try:
+                runpy.run_path(script, run_name='__main__')
+                code = 0
+            except SystemExit as e:
+                code = _exit_code(e.code)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            for fd in saved_fds:
+                os.close(fd)
+        out.seek(0)
+        err.seek(0)
+        return (code, out.read().decode('utf-8', 'replace'),
+                err.read().decode('utf-8', 'replace'))
+
+
+def _respond(proto_out, request_id, result=None, error=None):
+    response = {'jsonrpc': '2.0', 'id': request_id}
+    if error is None:
+        response['result'] = result
+    else:
+        response['error'] = error
+    proto_out.write(json.dumps(response) + '\n')
+    proto_out.flush()
+
+
+def main():
+    """
+    Worker side: serves the requests for the config script given as the
+    only argument.
+    """
+    script = os.path.abspath(sys.argv[1])
+    # The protocol gets its own file descriptors, the script can't read the
+    # requests or write to the responses
+    proto_in = os.fdopen(os.dup(0), 'r')
+    proto_out = os.fdopen(os.dup(1), 'w')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    os.close(devnull)
+    # Like when the script is run as a command
+    sys.path[0] = os.path.dirname(script)
+
+    _respond(proto_out, None, 'ready')
+    for line in proto_in:
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+        except ValueError:
+            continue
+        if request.get('method') != 'run':
+            _respond(proto_out, request_id, error={
+                'code': METHOD_NOT_FOUND,
+                'message': 'Method not found'
+            })
+            continue
+        code, out, err = _run_script(script, request['params']['args'])
+        _respond(proto_out, request_id, {'code': code, 'out': out,
+                                         'err': err})
+
+
+if __name__ == '__main__':
+    main()
@@ -10,14 +10,24 @@ import os
 import subprocess
 import sys
 
-from pf9app.exceptions import ServiceCtrlError, ConfigOperationError
+from pf9app.exceptions import ServiceCtrlError, ConfigOperationError, \
+    InstallOperationFailed
 from pf9app.app import App, RemoteApp
 from six import iteritems
 
-CFGSCRIPTCMD = "%s /opt/pf9/%s/config"
+CFGSCRIPTPATH = "/opt/pf9/%s/config"
+CFGSCRIPTCMD = "%s " + CFGSCRIPTPATH
 SVC_COMMAND = "sudo /etc/init.d/%s %s"
 SYSTEMCTL_COMMAND = "sudo systemctl %s %s"
 
+# States printed by systemctl is-active for a running unit
+SYSTEMD_RUNNING_STATES = set(['active', 'reloading'])
+
+# Output of the config scripts' --get-services option by app name, as
+# (key, value) tuples. Reused while the app version and config script are
+# unchanged.
+_services_cache = {}
+
 def prune_pf9_python_path():
     """
     Removes the Platform9 specific python path if it exists in the environment
@@ -95,6 +105,56 @@ def service_status_command(svc_name):
     return cmd
 
 
+def _query_service_state(svc_name, log):
+    cmd = service_status_command(svc_name)
+    code, out, err = _run_command(cmd)
+    log.debug("Command %s, code=%d stdout=%s stderr=%s",
+              cmd, code, out, err)
+    # Refer to LSB specification for the codes. If code is 0, then service is
+    # assumed to be running.
+    return code == 0
+
+
+def query_service_states(services, log=logging):
+    """
+    Returns the running state of services. The state of all the systemd
+    services is queried with a single systemctl command, init.d services are
+    queried one at a time.
+    :param list services: names of the services
+    :return: a dictionary mapping the service names to whether they are
+        running
+    :rtype: dict
+    """
+    states = {}
+    systemd_services = set()
+    for svc_name in services:
+        if svc_name in states or svc_name in systemd_services:
+            continue
+        if is_init_service(svc_name):
+            states[svc_name] = _query_service_state(svc_name, log)
+        else:
+            systemd_services.add(svc_name)
+    if not systemd_services:
+        return states
+
+    # sudo only allows the command if the first unit is a pf9 service
+    systemd_services = sorted(systemd_services,
+                              key=lambda svc: (not svc.startswith('pf9-'), svc))
+    cmd = SYSTEMCTL_COMMAND % ("is-active", ' '.join(systemd_services))
+    code, out, err = _run_command(cmd)
+    log.debug("Command %s, code=%d stdout=%s stderr=%s",
+              cmd, code, out, err)
+    # One line per unit, the exit code is not 0 if any unit is not active
+    unit_states = out.split()
+    if len(unit_states) == len(systemd_services):
+        for svc_name, unit_state in zip(systemd_services, unit_states):
+            states[svc_name] = unit_state in SYSTEMD_RUNNING_STATES
+    else:
+        for svc_name in systemd_services:
+            states[svc_name] = _query_service_state(svc_name, log)
+    return states
+
+
 def service_start_command(svc_name):
     if is_init_service(svc_name):
         cmd = SVC_COMMAND % (svc_name, "start")
@@ -145,13 +205,7 @@ class Pf9App(App):
         Whether the app is running.
         :rtype: bool
         """
-        cmd = service_status_command(self.app_name)
-        code, out, err = _run_command(cmd)
-        self.log.debug("Command %s, code=%d stdout=%s stderr=%s",
-                       cmd, code, out, err)
-        # Refer to LSB specification for the codes. If code is 0, then service is
-        # assumed to be running.
-        return code == 0
+        return _query_service_state(self.app_name, self.log)
 
     @property
     def version(self):
@@ -167,21 +221,28 @@ class Pf9App(App):
         The first element is boolean flag which tells us whether the config script
             implements the '--get-services' option.
         The second element is a list of services to manage.
+        The result is memoized while the app version and its config script are
+        unchanged.
         :rtype: (bool, list)
         """
-        cfgscript = self._get_config_script()
+        key = self._config_script_key()
+        entry = _services_cache.get(self.app_name)
+        if entry and entry[0] == key:
+            implements_service_states, services = entry[1]
+            return implements_service_states, list(services)
 
         # The script shall return a non zero return code in case of an error
-        code, out, err = _run_command("%s --get-services" % cfgscript)
+        code, out, err = self._run_config_script("--get-services")
         if code:
             self.log.debug("%s does not implement the --get-services option. Falling back to compatibility mode",
                 self.app_name)
-            return False, []
-
-        if len(out) > 0:
-            return True, out.split(' ')
+            result = (False, [])
+        elif len(out) > 0:
+            result = (True, out.split(' '))
         else:
-            return True, []
+            result = (True, [])
+        _services_cache[self.app_name] = (key, result)
+        return result[0], list(result[1])
 
     @property
     def services(self):
@@ -217,8 +278,9 @@ class Pf9App(App):
         :rtype: bool
         """
         self.log.debug("has_desired_service_states for %s begin" % self.name)
-        if self.implements_service_states:
-            current_state = self.get_service_states()
+        implements_service_states, services = self._get_services()
+        if implements_service_states:
+            current_state = self.get_service_states(services)
         else:
             current_state = { self.app_name: self.running }
         self.log.debug("has_desired_service_states for %s end" % self.name)
@@ -243,9 +305,11 @@ class Pf9App(App):
                 self.log.warn('Failed to set service %s to state %s' %
                               (name, run_state))
 
-    def get_service_states(self):
+    def get_service_states(self, services=None):
         """
         Returns a dictionary of services along with their running states.
+        :param list services: the app's services, if already known. Queried
+            from the config script if not specified.
         :rtype: dict
 
         {
@@ -254,17 +318,9 @@ class Pf9App(App):
         }
         """
         self.log.debug('get_service_states for %s begin' % self.name)
-        services_dict = {}
-        for service_name in self.services:
-
-            cmd = service_status_command(service_name)
-            code, out, err = _run_command(cmd)
-            self.log.debug("Command %s, code=%d stdout=%s stderr=%s",
-                cmd, code, out, err)
-
-            # Refer to LSB specification for the codes. If code is 0, then service is
-            # assumed to be running.
-            services_dict[service_name] = code == 0
+        if services is None:
+            services = self.services
+        services_dict = query_service_states(services, self.log)
         self.log.debug('get_service_states for %s end' % self.name)
         return services_dict
 
@@ -295,6 +351,46 @@ class Pf9App(App):
         """
         return CFGSCRIPTCMD % (sys.executable, self.app_name)
 
+    @property
+    def config_script_path(self):
+        """
+        Path of the app's config script
+        :rtype: str
+        """
+        return CFGSCRIPTPATH % self.app_name
+
+    def _config_script_key(self):
+        """
+        Returns a value that changes with the app version and config script
+        """
+        try:
+            script_mtime = os.stat(self.config_script_path).st_mtime
+        except OSError:
+            script_mtime = None
+        return (self.app_version, script_mtime)
+
+    def _run_config_script(self, option, value=None):
+        """
+        Runs the config script with an option. The config script runs in a
+        long-lived worker if the app db has config script workers, and as a
+        command otherwise or if the worker failed.
+        :param str option: the option, e.g. '--get-config'
+        :param str value: the value of the option, if any
+        :return: a tuple representing (code, stdout, stderr)
+        :rtype: tuple
+        """
+        workers = getattr(self.app_db, 'config_workers', None)
+        if workers:
+            args = [option] if value is None else [option, value]
+            result = workers.run(self.app_name, self.config_script_path,
+                                 self._config_script_key(), args)
+            if result is not None:
+                return result
+        cfgscript = self._get_config_script()
+        if value is None:
+            return _run_command("%s %s" % (cfgscript, option))
+        return _run_command("%s %s '%s'" % (cfgscript, option, value))
+
     def get_config(self):
         """
         Returns the app's current configuration.
@@ -302,10 +398,8 @@ class Pf9App(App):
         :rtype: dict
         :raises ConfigOperationError: if getting the config failed
         """
-        cfgscript = self._get_config_script()
-
         # The script shall return a non zero return code in case of an error
-        code, out, err = _run_command("%s --get-config" % cfgscript)
+        code, out, err = self._run_config_script("--get-config")
         if code:
             self.log.error("%s:get_config failed: %s %s", self.app_name, out, err)
             raise ConfigOperationError()
@@ -333,7 +427,10 @@ class Pf9App(App):
 
         # The script shall return a non zero return code in case of an error
         self.log.info("Setting config for %s.%s", self.name, self.version)
-        code, out, err = _run_command("%s --set-config '%s'" % (cfgscript, json.dumps(config)))
+        code, out, err = self._run_config_script("--set-config",
+                                                 json.dumps(config))
+        # Even a failed set-config may have changed part of the config
+        self.app_db.app_config_changed(self)
         if code:
             self.log.error(("%s:set_config failed:\nout: %s\nerr: %s\ncommand: "
                                 "%s --set-config '%s'"),
@@ -350,8 +447,9 @@ class Pf9App(App):
         """
         self.log.info("Removing %s.%s", self.name, self.version)
         # Stop the running service(s) first
-        if self.implements_service_states:
-            services = self.get_service_states()
+        implements_service_states, services = self._get_services()
+        if implements_service_states:
+            services = self.get_service_states(services)
         else:
             services = { self.app_name: self.running }
         self.set_desired_service_states(services, stop_all=True)
@@ -396,7 +494,30 @@ class Pf9RemoteApp(Pf9App, RemoteApp):
         localpath = self.download()
         self.app_db.install_package(localpath)
         self.log.info("%s.%s installed successfully", self.name, self.version)
-    
+
+    @classmethod
+    def install_all(cls, apps):
+        """
+        Installs several apps in a single package manager transaction. If
+        that fails, they are installed one at a time.
+        :param list apps: the apps, which share the same app db
+        :raises DownloadFailed: if the download of an app failed
+        :raises InstallOperationFailed: if the install of an app failed
+        """
+        if len(apps) < 2:
+            return super(Pf9RemoteApp, cls).install_all(apps)
+        log = apps[0].log
+        names = ', '.join('%s.%s' % (app.name, app.version) for app in apps)
+        log.info("Installing %s", names)
+        localpaths = [app.download() for app in apps]
+        try:
+            apps[0].app_db.install_packages(localpaths)
+        except InstallOperationFailed:
+            log.warn("Installing %s together failed, installing them one at "
+                     "a time", names)
+            return super(Pf9RemoteApp, cls).install_all(apps)
+        log.info("%s installed successfully", names)
+
     def install_dep(self):
         """
         Installs dependencies needed for pf9-kube
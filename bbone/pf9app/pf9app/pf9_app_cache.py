@@ -4,8 +4,13 @@
 __author__ = 'Platform9'
 
 import contextlib
+import errno
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
 from six.moves.urllib.parse import urlparse
 from six.moves.urllib.parse import urlsplit
 from pf9app.app_cache import AppCache
@@ -16,16 +21,48 @@ import distro
 
 DOWNLOAD_CHUNK_SIZE = 512 * 1024
 
+# Name of the index of the cache, in the cache directory
+INDEX_FILE_NAME = 'index.json'
+
+# Packages used less than this many seconds ago are not evicted, even if the
+# cache is over its size budget: they are likely about to be installed
+EVICTION_MIN_AGE = 3600
+
 SUPPORTED_DEBIAN_DISTROS = set(['debian', 'ubuntu'])
 SUPPORTED_REDHAT_DISTROS = set(['redhat', 'centos',
                                 'centos linux', 'scientific linux', 'rocky linux'])
 
+# The distro is read again when this file changes, e.g. on OS upgrades
+OS_RELEASE_FILE = '/etc/os-release'
+
+# (stamp of OS_RELEASE_FILE, distro) tuple
+_linux_distribution = {}
+
+def get_linux_distribution():
+    """
+    Returns the (name, version, codename) tuple of the distro, like
+    distro.linux_distribution(). It is cached while /etc/os-release is
+    unchanged.
+    :rtype: tuple
+    """
+    try:
+        st = os.stat(OS_RELEASE_FILE)
+        stamp = (st.st_mtime, st.st_size)
+    except OSError:
+        stamp = None
+    entry = _linux_distribution.get('entry')
+    if entry is None or entry[0] != stamp:
+        # distro's module level functions never read the files again
+        entry = (stamp, distro.LinuxDistribution().linux_distribution())
+        _linux_distribution['entry'] = entry
+    return entry[1]
+
 def get_supported_distro(log=None):
     """
     Returns 'redhat' or 'debian' depending on the supported distro detected.
     If no supported distro can be detected, returns 'redhat' and logs the error.
     """
-    dist_name = distro.linux_distribution()[0].lower()
+    dist_name = get_linux_distribution()[0].lower()
     if dist_name in SUPPORTED_DEBIAN_DISTROS.union(SUPPORTED_REDHAT_DISTROS):
         return dist_name
     else:
@@ -34,11 +71,20 @@ def get_supported_distro(log=None):
         return 'redhat'
 
 class Pf9AppCache(AppCache):
-    """Class that implements the AppCache interface"""
+    """
+    Class that implements the AppCache interface.
+
+    Downloaded packages are stored under cachelocation/<name>/<version>/ and
+    recorded in an index, persisted in the cache directory, along with their
+    size and SHA-256 checksum. A cached package is verified against its
+    checksum before being used for the first time. Interrupted downloads are
+    resumed with HTTP range requests, and the least recently used packages
+    are evicted when the cache grows over its size budget.
+    """
 
     def __init__(self, cachelocation,
                  certfile=None, keyfile=None, ca_certs=False,
-                 cert_reqs=None,
+                 cert_reqs=None, max_size=None,
                  log=logging):
         """
         Constructs a package downloader and caching object.
@@ -48,24 +94,91 @@ class Pf9AppCache(AppCache):
         :param str keyfile: Client private key file for SSL
         :param str ca_certs: Certificates file for verifying server identity
         :param int cert_reqs: Whether server verification is required (not used)
+        :param int max_size: Size budget of the cache in bytes, unlimited if
+                             None
         """
-        # TODO: Maintaining the cache in a dict. Need to figure out how this will
-        # persist across restarts of the backbone service
-        self.downloads = {}
         self.cache_location = cachelocation
         self.log = log
         self.certfile = certfile
         self.keyfile = keyfile
         self.ca_certs = ca_certs
+        self.max_size = max_size
+        self._index_path = os.path.join(cachelocation, INDEX_FILE_NAME)
+        # Protects the index, apps can be downloaded concurrently
+        self._lock = threading.Lock()
+        # Keys of the entries verified since the cache was loaded
+        self._verified = set()
+        self._index = self._load_index()
+
+    @staticmethod
+    def _key(name, version):
+        return '%s/%s' % (name, version)
+
+    def _load_index(self):
+        """
+        Reads the index of the cache from disk.
+        :return: the entries of the index, by key
+        :rtype: dict
+        """
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)['entries']
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                self.log.warn("Could not read app cache index %s: %s",
+                              self._index_path, e)
+        except (ValueError, KeyError, TypeError) as e:
+            self.log.warn("Ignoring invalid app cache index %s: %s",
+                          self._index_path, e)
+        return {}
+
+    def _save_index(self):
+        """
+        Writes the index of the cache to disk. Must be called with the lock
+        held.
+        """
+        if not os.path.isdir(self.cache_location):
+            os.makedirs(self.cache_location)
+        tmp_path = self._index_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'entries': self._index}, f, indent=1,
+                          sort_keys=True)
+            os.rename(tmp_path, self._index_path)
+        except (IOError, OSError) as e:
+            # The cache still works, it is only forgotten on restart
+            self.log.warn("Could not write app cache index %s: %s",
+                          self._index_path, e)
+
+    def _update_entry(self, key, entry):
+        with self._lock:
+            if entry is None:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = entry
+            self._save_index()
+
+    @staticmethod
+    def _file_checksum(path, hasher=None):
+        """
+        Returns the SHA-256 hash object of a file.
+        :param str path: Path to the file
+        :param hasher: Hash object to update, a new one if None
+        """
+        hasher = hasher or hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+        return hasher
 
     def _file_sizes_match(self, path, expected_size):
         """
         Checks if the file is of expected size. Returns False if it is not.
         Returns True otherwise.
         :param str path: Path to the file
-        :param str expected_size: Expected file size
+        :param int expected_size: Expected file size
         """
-        file_size = str(os.stat(path).st_size)
+        file_size = os.stat(path).st_size
         if file_size != expected_size:
             self.log.error("Expected file %s to be of size %s, but size was %s",
                            path, expected_size, file_size)
@@ -73,43 +186,147 @@ class Pf9AppCache(AppCache):
 
         return True
 
-    def _download_file(self, srcurl, destfile):
+    def _remove_file(self, path):
+        """
+        Removes a file of the cache and its app and version directories if
+        they are left empty.
+        """
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.log.warn("Could not remove %s: %s", path, e)
+                return
+        dirname = os.path.dirname(path)
+        for _ in range(2):
+            if os.path.abspath(dirname) == os.path.abspath(self.cache_location):
+                break
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                break
+            dirname = os.path.dirname(dirname)
+
+    def _check_entry(self, key, entry, localdest, checksum):
+        """
+        Checks that a cached package can be used.
+        :param str key: Key of the package in the index
+        :param dict entry: Index entry of the package
+        :param str localdest: Path the package is expected at
+        :param str checksum: Expected SHA-256 checksum, if known
+        :return: True if the package can be used
+        :rtype: bool
+        """
+        if not entry.get('complete') or entry['path'] != localdest:
+            return False
+        if checksum and entry['sha256'] != checksum:
+            self.log.info("Cached file %s does not have the expected "
+                          "checksum", localdest)
+            return False
+        try:
+            st = os.stat(localdest)
+        except OSError:
+            # e.g. removed by the cleanup of old packages
+            return False
+        if key in self._verified and st.st_size == entry['size'] and \
+                st.st_mtime == entry['mtime']:
+            return True
+        if st.st_size != entry['size'] or \
+                self._file_checksum(localdest).hexdigest() != entry['sha256']:
+            self.log.warn("Cached file %s is corrupted, downloading it again",
+                          localdest)
+            self._remove_file(localdest)
+            return False
+        entry['mtime'] = st.st_mtime
+        self._verified.add(key)
+        return True
+
+    def _download_file(self, srcurl, destfile, key, checksum=None):
         """
-        Utility method to download contents from the provided URL to a local file
+        Utility method to download contents from the provided URL to a local file.
+        The content is written to a .incomplete file first, which is renamed
+        to the local file once the download is complete and verified. If a
+        previous download of the same package was interrupted, it is resumed.
         :param str srcurl: URL of the source to get content from
         :param str destfile: Local file to be which the content is to be written. It
         will override previous contents, if the file already exists.
+        :param str key: Key of the package in the index
+        :param str checksum: Expected SHA-256 checksum, if known
+        :return: the index entry of the downloaded file
+        :rtype: dict
         :raises DownloadFailed: when downloading the file fails
         """
         self.log.info("Downloading file %s to %s", srcurl, destfile)
         originaldir, originalfilename = os.path.split(os.path.abspath(destfile))
         tmp_file_name = originalfilename + ".incomplete"
-        self.log.info("Writing to the .incomplete file %s. "
-                      "This will be renamed back to original "
-                      "file once the download is successfully complete " % (tmp_file_name))
         #create a .incomplete file to write the contents. This will be renamed
         #to original file once the download is successfully complete
         tmpdst = os.path.join(originaldir, tmp_file_name)
-        content_length = None
+
+        headers = {}
+        offset = 0
+        partial = self._index.get(key)
+        if partial and not partial.get('complete') and \
+                partial['path'] == tmpdst and partial['url'] == srcurl and \
+                os.path.isfile(tmpdst):
+            validator = partial.get('etag') or partial.get('last_modified')
+            offset = os.stat(tmpdst).st_size
+            if validator and offset:
+                self.log.info("Resuming the download of %s at byte %d",
+                              srcurl, offset)
+                headers['Range'] = 'bytes=%d-' % offset
+                # The server sends the whole file if it changed
+                headers['If-Range'] = validator
+            else:
+                offset = 0
+
         try:
             with contextlib.closing(requests.get(srcurl,
                                                  verify=self.ca_certs,
                                                  cert=(self.certfile,
                                                        self.keyfile),
+                                                 headers=headers,
                                                  stream=True)) as response:
-                # Raise HTTPError if status is not 200
+                # Raise HTTPError if status is not 200 or 206
                 response.raise_for_status()
                 content_length = response.headers.get('content-length', None)
                 if content_length is None:
                     msg = 'Could not determine the size of the file being downloaded.'
                     self.log.error(msg)
                     raise DownloadFailed(msg)
+                if response.status_code != 206:
+                    # Not resumed
+                    offset = 0
+                elif not response.headers.get('content-range', '').startswith(
+                        'bytes %d-' % offset):
+                    self._remove_file(tmpdst)
+                    self._update_entry(key, None)
+                    raise DownloadFailed("Unexpected range in the response "
+                                         "of %s" % srcurl)
+                expected_size = offset + int(content_length)
                 self.log.debug("Size (bytes) of content to be written: %s", content_length)
-                with open(tmpdst, "wb") as wf:
+                self._update_entry(key, {
+                    'path': tmpdst,
+                    'url': srcurl,
+                    'complete': False,
+                    'etag': response.headers.get('etag'),
+                    'last_modified': response.headers.get('last-modified'),
+                    'last_used': time.time()
+                })
+                if offset:
+                    hasher = self._file_checksum(tmpdst)
+                    mode = "r+b"
+                else:
+                    hasher = hashlib.sha256()
+                    mode = "wb"
+                with open(tmpdst, mode) as wf:
+                    wf.seek(offset)
+                    wf.truncate()
                     # Python3: Cannot write bytes without opening the file in wb mode.
                     # Source files (rpms) could be huge,download them in chunks
                     for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
                         wf.write(chunk)
+                        hasher.update(chunk)
                     # Flush the buffers to the disk. This is required in a case where the
                     # the system is slow. We ensure that the file is written to the disk before referred.
                     wf.flush()
@@ -118,15 +335,60 @@ class Pf9AppCache(AppCache):
             self.log.error("Downloading %s failed: %s", srcurl, e)
             raise DownloadFailed(str(e))
 
-        if not self._file_sizes_match(tmpdst, content_length):
+        if not self._file_sizes_match(tmpdst, expected_size):
             raise DownloadFailed("Downloaded file doesn't match expected size.")
+        sha256 = hasher.hexdigest()
+        if checksum and sha256 != checksum:
+            self.log.error("Expected file %s to have checksum %s, but it was "
+                           "%s", tmpdst, checksum, sha256)
+            self._remove_file(tmpdst)
+            self._update_entry(key, None)
+            raise DownloadFailed("Downloaded file doesn't match expected checksum.")
         #rename the .incomplete file
         self.log.info("Renaming %s to %s" % (tmp_file_name, originalfilename))
         os.rename(tmpdst, destfile)
         self.log.info("Downloaded file %s to %s", srcurl, destfile)
+        return {
+            'path': destfile,
+            'url': srcurl,
+            'complete': True,
+            'size': expected_size,
+            'mtime': os.stat(destfile).st_mtime,
+            'sha256': sha256
+        }
 
+    def _evict(self, keep):
+        """
+        Removes the least recently used packages until the cache fits in its
+        size budget. Must be called with the lock held.
+        :param str keep: Key of a package that must not be evicted
+        """
+        if self.max_size is None:
+            return
+        sizes = {}
+        for key, entry in self._index.items():
+            try:
+                sizes[key] = os.stat(entry['path']).st_size
+            except OSError:
+                sizes[key] = 0
+        total = sum(sizes.values())
+        now = time.time()
+        for key, entry in sorted(self._index.items(),
+                                 key=lambda item: item[1]['last_used']):
+            if total <= self.max_size:
+                break
+            if key == keep or now - entry['last_used'] < EVICTION_MIN_AGE:
+                continue
+            self.log.info("Evicting %s from the app cache", entry['path'])
+            self._remove_file(entry['path'])
+            del self._index[key]
+            self._verified.discard(key)
+            total -= sizes[key]
+        if total > self.max_size:
+            self.log.warn("App cache size %d is over its budget of %d bytes",
+                          total, self.max_size)
 
-    def download(self, name, version, url, change_extension):
+    def download(self, name, version, url, change_extension, checksum=None):
         """
         Downloads an application package if not in the cache.
 
@@ -135,30 +397,73 @@ class Pf9AppCache(AppCache):
         :param str url: Url to download it from, if not in the cache
         :param bool change_extension: Change the url extension to .deb
                                       if a Debian OS is detected
+        :param str checksum: Expected SHA-256 checksum of the package, if
+                             known. A cached package with a different
+                             checksum is downloaded again.
         :return: the path of the locally downloaded package file
         :rtype: str
         :raises DownloadFailed: when downloading the file fails
         """
-        key = (name, version)
-        if key not in self.downloads:
+        key = self._key(name, version)
+        with self._lock:
+            entry = self._index.get(key)
+            entry = dict(entry) if entry else None
+        if url is None:
+            # Only the cache can provide the package
+            if not entry or not entry.get('complete'):
+                raise DownloadFailed("%s.%s is not in the cache and has no "
+                                     "url" % (name, version))
+            localdest = entry['path']
+        else:
             filename = urlsplit(url).path.split('/')[-1]
             localdir = os.path.join(self.cache_location, name, version)
-            # If dir path doesn't exist, then create it
-            if not os.path.exists(localdir):
-                os.makedirs(localdir)
             localdest = os.path.join(localdir, filename)
-            self.log.info("Downloading %s.%s", name, version)
-
             if change_extension and get_supported_distro(self.log) in \
                 SUPPORTED_DEBIAN_DISTROS:
                 url = "".join(os.path.splitext(url)[:-1]) + ".deb"
                 localdest = "".join(os.path.splitext(localdest)[:-1]) + ".deb"
 
-            if os.path.isfile(localdest):
-                self.log.info("Using previously cached file %s", localdest)
-            else:
-                self._download_file(url, localdest)
-            self.downloads[key] = localdest
+        if entry and self._check_entry(key, entry, localdest, checksum):
+            self.log.info("Using previously cached file %s", localdest)
+        elif not entry and os.path.isfile(localdest):
+            # Downloaded before the cache had an index
+            self.log.info("Adding previously cached file %s to the index",
+                          localdest)
+            st = os.stat(localdest)
+            entry = {
+                'path': localdest,
+                'url': url,
+                'complete': True,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'sha256': self._file_checksum(localdest).hexdigest()
+            }
+            self._verified.add(key)
+            if not self._check_entry(key, entry, localdest, checksum):
+                self._remove_file(localdest)
+                entry = None
+        else:
+            entry = None
+
+        if entry is None:
+            if url is None:
+                raise DownloadFailed("Cached file %s is not valid and %s.%s "
+                                     "has no url" % (localdest, name, version))
+            localdir = os.path.dirname(localdest)
+            # If dir path doesn't exist, then create it
+            if not os.path.exists(localdir):
+                os.makedirs(localdir)
+            self.log.info("Downloading %s.%s", name, version)
+            entry = self._download_file(url, localdest, key, checksum)
+            self._verified.add(key)
 
-        self.log.debug("App cache state: %s", str(self.downloads))
-        return self.downloads[key]
+        entry['last_used'] = time.time()
+        with self._lock:
+            old_entry = self._index.get(key)
+            if old_entry and old_entry['path'] != localdest:
+                self._remove_file(old_entry['path'])
+            self._index[key] = entry
+            self._evict(keep=key)
+            self._save_index()
+            self.log.debug("App cache state: %s", sorted(self._index))
+        return localdest
@@ -3,18 +3,23 @@
 
 __author__ = 'Platform9'
 
+import copy
 import errno
 import logging
 import os
 import platform
 import subprocess
+import threading
 import time
-import distro
-from six import iteritems
+from abc import ABCMeta, abstractmethod
+from six import add_metaclass, iteritems
 
 from pf9app.app_db import AppDb
-from pf9app.pf9_app_cache import get_supported_distro, SUPPORTED_DEBIAN_DISTROS
-from pf9app.pf9_app import Pf9App, _run_command_with_custom_pythonpath, _run_command
+from pf9app.config_worker import ConfigScriptWorkers
+from pf9app.pf9_app_cache import get_supported_distro, get_linux_distribution, \
+    SUPPORTED_DEBIAN_DISTROS
+from pf9app.pf9_app import Pf9App, _run_command_with_custom_pythonpath, _run_command, \
+    query_service_states
 from pf9app.exceptions import NotInstalled, UpdateOperationFailed, \
     RemoveOperationFailed, InstallOperationFailed, Pf9Exception
 
@@ -22,18 +27,113 @@ if get_supported_distro() in SUPPORTED_DEBIAN_DISTROS:
     import apt
     import apt.debfile
 
+# Files that change whenever a package is installed, updated or removed
+DPKG_DB_FILES = ['/var/lib/dpkg/status']
+RPM_DB_FILES = ['/var/lib/rpm/Packages',
+                '/var/lib/rpm/rpmdb.sqlite',
+                '/var/lib/rpm/rpmdb.sqlite-wal']
 
-class AptPkgMgr(object):
-    """Class that interacts with APT"""
+# Seconds after which cached app state is recomputed even if no change was
+# detected, to pick up config changes made behind the host agent's back
+CONFIG_MAX_AGE = 300
 
-    def __init__(self, log = logging):
+
+def _files_stamp(paths):
+    """
+    Returns a value that changes when any of the files is modified.
+    :param list paths: paths of the files, missing files are ignored
+    :return: tuple of (path, mtime, size), None if none of the files exist
+    """
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stamp.append((path, st.st_mtime, st.st_size))
+    return tuple(stamp) or None
+
+
+class PackageInventory(object):
+    """
+    Snapshot of the installed packages
+    """
+
+    def __init__(self, apps, lookup):
+        """
+        :param dict apps: pf9 apps mapped to their details (name, version)
+        :param lookup: function returning the list of the installed versions
+            of a package, given its name
+        """
+        self.apps = apps
+        self._lookup = lookup
+        self._versions = {}
+
+    def versions(self, name):
+        """
+        :return: the installed versions of a package
+        :rtype: list
+        """
+        if name not in self._versions:
+            self._versions[name] = self._lookup(name)
+        return list(self._versions[name])
+
+
+@add_metaclass(ABCMeta)
+class PkgMgr(object):
+    """
+    Base class of the package managers. Queries about the installed packages
+    are answered from a PackageInventory, read again from the package
+    database only when it changes.
+    """
+
+    def __init__(self, log=logging):
         self.log = log
-        self.apt_rootwrap_path = '/opt/pf9/hostagent/bin/pf9-apt'
-        # To install packages noninteractively, we change the environment
-        # variables. There may be additional steps needed in the pf9app
-        # post-install scripts to take this into account.
-        os.environ.update(DEBIAN_FRONTEND='noninteractive')
-        self.cache = apt.cache.Cache()
+        self._inventory_lock = threading.Lock()
+        self._inventory_stamp = None
+        self._inventory_cache = None
+
+    def db_stamp(self):
+        """
+        :return: a value that changes when the installed packages change, or
+            None if it can't be determined
+        """
+        return None
+
+    def invalidate_inventory(self):
+        """
+        Drops the inventory, the next query reads the package database again.
+        """
+        with self._inventory_lock:
+            self._inventory_stamp = None
+            self._inventory_cache = None
+
+    @abstractmethod
+    def _read_inventory(self):
+        """
+        Reads the package database.
+        :return: the inventory, or None if reading it failed
+        :rtype: PackageInventory
+        """
+        pass
+
+    def inventory(self):
+        """
+        :return: the inventory of the installed packages
+        :rtype: PackageInventory
+        """
+        with self._inventory_lock:
+            # Taken first, so that changes made while reading the database
+            # are picked up by the next call
+            stamp = self.db_stamp()
+            if stamp is None or stamp != self._inventory_stamp:
+                inventory = self._read_inventory()
+                if inventory is None:
+                    # Not cached, the next call tries again
+                    return PackageInventory({}, lambda name: [])
+                self._inventory_stamp = stamp
+                self._inventory_cache = inventory
+            return self._inventory_cache
 
     def query_pf9_apps(self):
         """
@@ -43,12 +143,33 @@ class AptPkgMgr(object):
         :return: dict of pf9 apps mapped to its details (name, version)
         :rtype: dict
         """
+        return dict(self.inventory().apps)
+
+
+class AptPkgMgr(PkgMgr):
+    """Class that interacts with APT"""
+
+    def __init__(self, log = logging):
+        PkgMgr.__init__(self, log)
+        self.apt_rootwrap_path = '/opt/pf9/hostagent/bin/pf9-apt'
+        # To install packages noninteractively, we change the environment
+        # variables. There may be additional steps needed in the pf9app
+        # post-install scripts to take this into account.
+        os.environ.update(DEBIAN_FRONTEND='noninteractive')
+        # Loaded with the first inventory
+        self.cache = None
+
+    def _read_inventory(self):
+        """
+        Loads the apt cache. A new cache is loaded for each inventory, so that
+        an older inventory still in use isn't modified.
+        """
         self.log.debug('-- query_pf9_apps begin --')
-        self.cache.open()
+        cache = apt.cache.Cache()
         out = {}
         items = 0
         pkgs = 0
-        for pkg in self.cache.get_providing_packages('pf9app'):
+        for pkg in cache.get_providing_packages('pf9app'):
             pkgs += 1
             for version in pkg.versions:
                 items += 1
@@ -58,7 +179,20 @@ class AptPkgMgr(object):
                 }
         self.log.debug('-- query_pf9_apps end with %d pkgs and %d items --' %
                        (pkgs, items))
-        return out
+        self.cache = cache
+
+        def lookup(name):
+            if not cache.has_key(name):
+                return []
+            return [version.source_version for version in cache[name].versions]
+        return PackageInventory(out, lookup)
+
+    def db_stamp(self):
+        """
+        :return: a value that changes when the installed packages change, or
+            None if it can't be determined
+        """
+        return _files_stamp(DPKG_DB_FILES)
 
     def query_pf9_agent(self):
         """
@@ -66,13 +200,14 @@ class AptPkgMgr(object):
         :return: dictionary of agent name and version
         :rtype: dict
         """
-        self.cache.open()
-        pkg = self.cache["pf9-hostagent"]
-        versions = pkg.versions
+        versions = self.inventory().versions('pf9-hostagent')
+        if not versions:
+            self.log.error('Could not determine the agent version')
+            raise Pf9Exception('Querying pf9 agent version failed.')
         # Returns the first hostagent version for now
         return {
-            'name': pkg.name,
-            'version': versions[0].source_version
+            'name': 'pf9-hostagent',
+            'version': versions[0]
         }
 
     def remove_package(self, appname):
@@ -82,8 +217,7 @@ class AptPkgMgr(object):
         :raises NotInstalled: if the app is not found/installed
         :raises RemoveOperationFailed: if the remove operation failed.
         """
-        self.cache.open()
-        if not self.cache.has_key(appname):
+        if not self.inventory().versions(appname):
             raise NotInstalled()
         erase_cmd = 'sudo %s erase %s' % (self.apt_rootwrap_path, appname)
         code, out, err = _run_command_with_custom_pythonpath(erase_cmd)
@@ -99,7 +233,17 @@ class AptPkgMgr(object):
         :param pkg_path: path to the package to be installed
         :raises InstallOperationFailed: if the install operation failed
         """
-        install_cmd = 'sudo %s install %s' % (self.apt_rootwrap_path, pkg_path)
+        self.install_from_files([pkg_path])
+
+    def install_from_files(self, pkg_paths):
+        """
+        Installs apps from the specified local paths, with a single update
+        of the apt cache and a single transaction for their dependencies
+        :param list pkg_paths: paths to the packages to be installed
+        :raises InstallOperationFailed: if the install operation failed
+        """
+        install_cmd = 'sudo %s install %s' % (self.apt_rootwrap_path,
+                                              ' '.join(pkg_paths))
         code, out, err = _run_command_with_custom_pythonpath(install_cmd)
         if code:
             self.log.error('Install command failed: %s. Return code: %d, '
@@ -122,45 +266,47 @@ class AptPkgMgr(object):
         self.install_from_file(pkg_path)
 
 
-class YumPkgMgr(object):
+class YumPkgMgr(PkgMgr):
     """Class that interacts with the YUM package manager"""
 
-    # TODO: Consider building a package manager interface to denote all the methods
-    # that need to be implemented as part of the package manager.
-
     def __init__(self, log = logging):
-        self.log = log
+        PkgMgr.__init__(self, log)
         self.yum_rootwrap_path = '/opt/pf9/hostagent/bin/pf9-yum'
-        # Dummy time string to insert in rpm commands
-        dummy_time = time.time()
-        self.dummy_time_str = str(dummy_time)
 
-    def query_pf9_apps(self):
+    def _read_inventory(self):
         """
-        Query the installed packages on the machine that are pf9 apps. Packages
-        that provide "pf9app" are considered as pf9 apps
-
-        :return: dict of pf9 apps mapped to its details (name, version)
-        :rtype: dict
+        Lists all the installed packages, with their versions and what they
+        provide, with a single rpm query.
         """
-        out = {}
-
-        query_cmd = "rpm -q --whatprovides pf9app --queryformat '%{NAME}" + self.dummy_time_str + "%{VERSION}-%{RELEASE}\n'"
+        query_cmd = "rpm -qa --queryformat " \
+                    "'%{NAME}\\t%{VERSION}-%{RELEASE}\\t[%{PROVIDENAME} ]\\n'"
         code, response, err = _run_command_with_custom_pythonpath(query_cmd)
         if code:
             self.log.error('RPM query command failed : %s. Return code: %d, '
                            'stdout: %s, stderr: %s', query_cmd, code, response, err)
-            # Return empty dict in case of error.
-            return out
+            return None
 
+        apps = {}
+        packages = {}
         for line in response.splitlines():
-            name, version = line.split(self.dummy_time_str, 1)
-            out[name] = {
-                'name': name,
-                'version': version
-            }
+            fields = line.split('\t')
+            if len(fields) != 3:
+                continue
+            name, version, provides = fields
+            packages.setdefault(name, []).append(version)
+            if 'pf9app' in provides.split():
+                apps[name] = {
+                    'name': name,
+                    'version': version
+                }
+        return PackageInventory(apps, lambda name: packages.get(name, []))
 
-        return out
+    def db_stamp(self):
+        """
+        :return: a value that changes when the installed packages change, or
+            None if it can't be determined
+        """
+        return _files_stamp(RPM_DB_FILES)
 
     def query_pf9_agent(self):
         """
@@ -189,22 +335,7 @@ class YumPkgMgr(object):
         :return: Version of the appname
         :rtype: list
         """
-        version = []
-        version_cmd = 'rpm -q %s --queryformat ' %(appname)
-        version_cmd = version_cmd + "%{VERSION}-%{RELEASE}\n"
-
-        code, response, err = _run_command_with_custom_pythonpath(version_cmd)
-        if code:
-            self.log.error('RPM version query command failed : %s. Return code: %d, '
-                           'stdout: %s, stderr: %s', version_cmd, code, response, err)
-            # In case of failure, empty version list is returned.
-            return version
-
-        # Strip trailing newline characters if any, from the response string.
-        response = response.rstrip()
-        # Convert the response string to the version list.
-        version = response.split("\n")
-        return version
+        return self.inventory().versions(appname)
 
     def remove_package(self, appname):
         """
@@ -237,7 +368,17 @@ class YumPkgMgr(object):
         :param pkg_path: local path to the app to be installed
         :raises InstallOperationFailed: if the install operation failed
         """
-        install_cmd = 'sudo %s install %s' % (self.yum_rootwrap_path, pkg_path)
+        self.install_from_files([pkg_path])
+
+    def install_from_files(self, pkg_paths):
+        """
+        Installs apps from the specified local paths in a single yum
+        transaction
+        :param list pkg_paths: local paths to the apps to be installed
+        :raises InstallOperationFailed: if the install operation failed
+        """
+        install_cmd = 'sudo %s install %s' % (self.yum_rootwrap_path,
+                                              ' '.join(pkg_paths))
         code, out, err = _run_command_with_custom_pythonpath(install_cmd)
         if code:
             self.log.error('Install command failed : %s. Return code: %d, '
@@ -249,13 +390,11 @@ class YumPkgMgr(object):
         Installs dependency for pf9-kube
         """
         if name == "libcgroup-tools":
-            version = distro.version().split('.')[0]
+            version = get_linux_distribution()[1].split('.')[0]
             version_number = int(version)
 
             if version_number < 9:
-                check_command = 'rpm -q %s' % (name)
-                code, out, err = _run_command(check_command)
-                if code:
+                if not self._find_installed_pkg_version(name):
                     self.log.info('Installing %s', name)
                     install_cmd = 'sudo yum install -y %s' % (name)
                     code, out, err = _run_command(install_cmd)
@@ -283,14 +422,29 @@ class YumPkgMgr(object):
 class Pf9AppDb(AppDb):
     """ Class that implements the AppDb model interface"""
 
-    def __init__(self, log=logging):
+    def __init__(self, log=logging, config_max_age=CONFIG_MAX_AGE,
+                 config_workers=False):
         """
         Constructor
         :param Logger log: logger object for logging
+        :param int config_max_age: seconds after which the cached config of
+            the apps is recomputed even if no change was detected
+        :param bool config_workers: run the config scripts of the apps in
+            long-lived workers rather than as a command for every call
         """
         self.apps = {}
         self.log = log
+        self.config_max_age = config_max_age
+        self.config_workers = ConfigScriptWorkers(log) if config_workers \
+            else None
         self._get_package_manager()
+        # The config of each app is cached between calls, since querying it
+        # means running a subprocess per app. The installed apps are cached
+        # by the package manager. Entries are (key, time, value), reused
+        # while key is unchanged.
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0
+        self._app_state_cache = {}
 
     def _get_package_manager(self):
         """
@@ -304,6 +458,50 @@ class Pf9AppDb(AppDb):
     def make_app(self, name, version):
         return Pf9App(name, version, self, log=self.log)
 
+    def _cache_lookup(self, entry, key):
+        """
+        :return: value of the cache entry if it is still valid for key
+        """
+        if entry and entry[0] == key and \
+                time.time() - entry[1] < self.config_max_age:
+            return entry[2]
+        return None
+
+    def _invalidate_cache(self):
+        """
+        Drops the cached state. Values computed before this call are not
+        cached once they complete.
+        """
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._app_state_cache = {}
+        self.pkgmgr.invalidate_inventory()
+
+    def _get_app_state(self, app):
+        """
+        Returns the output of the app's config script, cached while the app
+        version and the config script are unchanged.
+        :return: tuple of the app config, whether the app implements service
+            states and the list of its services
+        :rtype: tuple
+        :raises ConfigOperationError: if getting the config failed
+        """
+        generation = self._cache_generation
+        try:
+            script_mtime = os.stat(app.config_script_path).st_mtime
+        except OSError:
+            script_mtime = None
+        key = (app.version, script_mtime)
+        state = self._cache_lookup(self._app_state_cache.get(app.name), key)
+        if state is None:
+            implements_service_states, services = app._get_services()
+            state = (app.get_config(), implements_service_states, services)
+            with self._cache_lock:
+                if generation == self._cache_generation:
+                    self._app_state_cache[app.name] = (key, time.time(), state)
+        # The caller may modify the config
+        return copy.deepcopy(state)
+
     def query_installed_apps(self):
         """
         Returns a dictionary representing installed applications.
@@ -317,19 +515,72 @@ class Pf9AppDb(AppDb):
             appMap[app] = self.make_app(app, val['version'])
         return appMap
 
+    def _query_service_states(self, services):
+        """
+        Returns whether services are running, see query_service_states()
+        """
+        return query_service_states(services, self.log)
+
+    def get_current_config(self):
+        """
+        Computes the current application configuration. The app configs are
+        cached, the running state of the services is always probed, with a
+        single query for the services of all the apps.
+        :return: a dictionary representing the aggregate app configuration.
+        :rtype: dict
+        """
+        apps = self.query_installed_apps()
+        app_states = {}
+        all_services = []
+        for app_name, app in iteritems(apps):
+            app_states[app_name] = self._get_app_state(app)
+            app_config, implements_service_states, services = \
+                app_states[app_name]
+            # Apps that don't implement service states have a single service
+            # named after the app
+            all_services.extend(services if implements_service_states
+                                else [app_name])
+        running = self._query_service_states(all_services)
+
+        config = {}
+        for app_name, app in iteritems(apps):
+            app_config, implements_service_states, services = \
+                app_states[app_name]
+            if implements_service_states:
+                config[app_name] = {
+                    'version': app.version,
+                    'config': app_config,
+                    'service_states': dict((svc, running[svc])
+                                           for svc in services)
+                }
+            else:
+                config[app_name] = {
+                    'version': app.version,
+                    'running': running[app_name],
+                    'config': app_config
+                }
+        return config
+
     def app_installed(self, app):
         """
         Notify the AppDb that an app was installed.
         :param App app: the app
         """
-        pass
+        self._invalidate_cache()
 
     def app_uninstalled(self, app):
         """
         Notify the AppDb that an app was uninstalled.
         :param App app: the app
         """
-        pass
+        self._invalidate_cache()
+
+    def app_config_changed(self, app):
+        """
+        Notify the AppDb that the configuration of an app was changed.
+        :param App app: the app
+        """
+        self._invalidate_cache()
 
     def install_package(self, path):
         """
@@ -337,7 +588,21 @@ class Pf9AppDb(AppDb):
         :param str path: Path to the app to be installed
         :raises OSError: if the file provided by path is not found
         """
-        self.pkgmgr.install_from_file(path)
+        try:
+            self.pkgmgr.install_from_file(path)
+        finally:
+            self._invalidate_cache()
+
+    def install_packages(self, paths):
+        """
+        Installs several apps in a single package manager transaction
+        :param list paths: Paths to the apps to be installed
+        :raises InstallOperationFailed: if the install operation failed
+        """
+        try:
+            self.pkgmgr.install_from_files(paths)
+        finally:
+            self._invalidate_cache()
 
     def install_dep(self, name):
         """
@@ -351,7 +616,12 @@ class Pf9AppDb(AppDb):
         :param str app_name: Name of the app to be removed
         :raises NotInstalled: if the app is not installed
         """
-        self.pkgmgr.remove_package(app_name)
+        if self.config_workers:
+            self.config_workers.stop(app_name)
+        try:
+            self.pkgmgr.remove_package(app_name)
+        finally:
+            self._invalidate_cache()
 
 
 class Pf9AgentDb(Pf9AppDb):
@@ -373,7 +643,10 @@ class Pf9AgentDb(Pf9AppDb):
         :param str path: Path to the app to be installed
         :raises OSError: if the file provided by path is not found
         """
-        self.pkgmgr.update_from_file(path)
+        try:
+            self.pkgmgr.update_from_file(path)
+        finally:
+            self._invalidate_cache()
 
     def query_installed_agent(self):
         """
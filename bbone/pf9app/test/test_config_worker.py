@@ -0,0 +1,159 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests running config scripts in long-lived workers.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from pf9app import pf9_app
+from pf9app.config_worker import ConfigScriptWorkers
+from pf9app.pf9_app import Pf9App
+
+# The config script imports this module, which records its imports
+HELPER = '''
+import os
+IMPORTS_FILE = os.path.join(os.path.dirname(__file__), 'imports')
+with open(IMPORTS_FILE, 'a') as f:
+    f.write('%d\\n' % os.getpid())
+'''
+
+CONFIG_SCRIPT = '''
+import json
+import optparse
+import os
+import sys
+
+import helper
+
+CONFIG_FILE = os.path.join(os.path.dirname(helper.__file__), 'config.json')
+
+
+def get_config(option, opt_str, value, parser):
+    with open(CONFIG_FILE) as f:
+        sys.stdout.write(f.read())
+    sys.exit(0)
+
+
+def set_config(option, opt_str, value, parser):
+    json.loads(value)
+    with open(CONFIG_FILE, 'w') as f:
+        f.write(value)
+    sys.exit(0)
+
+
+def fail(option, opt_str, value, parser):
+    os.system('echo from a subprocess')
+    raise RuntimeError('failed')
+
+
+parser = optparse.OptionParser()
+parser.add_option('--get-config', action='callback', callback=get_config)
+parser.add_option('--set-config', type='string', action='callback',
+                  callback=set_config)
+parser.add_option('--fail', action='callback', callback=fail)
+parser.parse_args()
+'''
+
+
+class ScriptApp(Pf9App):
+    script_dir = None
+
+    @property
+    def config_script_path(self):
+        return os.path.join(self.script_dir, 'config')
+
+    def _get_config_script(self):
+        return '%s %s' % (sys.executable, self.config_script_path)
+
+
+class WorkersAppDb(object):
+    def __init__(self, config_workers):
+        self.config_workers = config_workers
+
+    def app_config_changed(self, app):
+        pass
+
+
+class TestConfigWorker(object):
+
+    def setup_method(self, method):
+        self.dirname = tempfile.mkdtemp()
+        ScriptApp.script_dir = self.dirname
+        for name, content in [('helper.py', HELPER),
+                              ('config', CONFIG_SCRIPT),
+                              ('config.json', '{"x": 1}')]:
+            with open(os.path.join(self.dirname, name), 'w') as f:
+                f.write(content)
+        self.workers = ConfigScriptWorkers()
+        self.app_db = WorkersAppDb(self.workers)
+        # The worker imports pf9app like the host agent does
+        self.old_pythonpath = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.path.dirname(
+            os.path.dirname(os.path.abspath(pf9_app.__file__)))
+
+    def teardown_method(self, method):
+        self.workers.stop()
+        if self.old_pythonpath is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self.old_pythonpath
+        shutil.rmtree(self.dirname)
+
+    def _imports(self):
+        with open(os.path.join(self.dirname, 'imports')) as f:
+            return f.read().split()
+
+    def test_worker(self):
+        app = ScriptApp('app', '1.0', self.app_db)
+        assert app.get_config() == {'x': 1}
+        app.set_config({'x': 2})
+        assert app.get_config() == {'x': 2}
+        # The app's modules were imported once, in the worker
+        imports = self._imports()
+        assert len(imports) == 1
+        assert int(imports[0]) != os.getpid()
+
+        # Same output as the config script run as a command
+        code, out, err = app._run_config_script('--fail')
+        assert code == 1
+        assert out == 'from a subprocess\n'
+        assert 'RuntimeError: failed' in err
+        one_shot = subprocess.Popen(
+            [sys.executable, app.config_script_path, '--fail'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert one_shot.communicate()[0].decode() == out
+        assert one_shot.returncode == code
+
+        # A new app version gets a new worker
+        app = ScriptApp('app', '2.0', self.app_db)
+        assert app.get_config() == {'x': 2}
+        assert len(self._imports()) == 3
+
+    def test_fallback(self):
+        app = ScriptApp('app', '1.0', self.app_db)
+        app.get_config()
+        key = app._config_script_key()
+        worker = self.workers._workers['app'][1]
+        worker._proc.kill()
+        worker._proc.wait()
+        # Run as a command, without a worker until the app changes
+        assert app.get_config() == {'x': 1}
+        assert app.get_config() == {'x': 1}
+        assert self.workers._failed['app'] == key
+        assert 'app' not in self.workers._workers
+        assert len(self._imports()) == 3
+
+    def test_without_workers(self):
+        app = ScriptApp('app', '1.0', WorkersAppDb(None))
+        app.set_config({'x': 3})
+        assert app.get_config() == {'x': 3}
+        with open(os.path.join(self.dirname, 'config.json')) as f:
+            assert json.load(f) == {'x': 3}
+        assert len(self._imports()) == 2
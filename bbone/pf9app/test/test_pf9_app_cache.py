@@ -0,0 +1,172 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests the app cache against a local HTTP server that supports range
+requests.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from pf9app.exceptions import DownloadFailed
+from pf9app.pf9_app_cache import Pf9AppCache, INDEX_FILE_NAME
+
+
+class PackageHandler(BaseHTTPRequestHandler):
+    packages = {}
+    requests = []
+    # Number of bytes sent before the connection is cut, if not None
+    cut_after = None
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        data = self.packages[self.path]
+        etag = '"%s"' % hashlib.sha256(data).hexdigest()[:16]
+        self.requests.append(dict(self.headers))
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' %
+                             (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        body = data[start:]
+        if self.cut_after is not None:
+            body = body[:self.cut_after]
+        self.wfile.write(body)
+
+
+class TestPf9AppCache(object):
+
+    def setup_method(self, method):
+        self.cache_dir = tempfile.mkdtemp()
+        PackageHandler.packages = {
+            '/foo-1.0.rpm': os.urandom(2000000),
+            '/foo-1.1.rpm': os.urandom(100000),
+            '/bar-1.0.rpm': os.urandom(100000),
+        }
+        PackageHandler.requests = []
+        PackageHandler.cut_after = None
+        self.server = HTTPServer(('127.0.0.1', 0), PackageHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def teardown_method(self, method):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def _download(self, cache, name, version, **kwargs):
+        url = '%s/%s-%s.rpm' % (self.base_url, name, version)
+        return cache.download(name, version, url, False, **kwargs)
+
+    def _content(self, name, version):
+        return PackageHandler.packages['/%s-%s.rpm' % (name, version)]
+
+    def test_persistent_index(self):
+        cache = Pf9AppCache(self.cache_dir)
+        path = self._download(cache, 'foo', '1.0')
+        with open(path, 'rb') as f:
+            assert f.read() == self._content('foo', '1.0')
+        assert len(PackageHandler.requests) == 1
+
+        # After a restart, the package is verified and not downloaded again
+        cache = Pf9AppCache(self.cache_dir)
+        assert self._download(cache, 'foo', '1.0') == path
+        assert cache.download('foo', '1.0', None, False) == path
+        assert len(PackageHandler.requests) == 1
+        with open(os.path.join(self.cache_dir, INDEX_FILE_NAME)) as f:
+            entry = json.load(f)['entries']['foo/1.0']
+        assert entry['sha256'] == \
+            hashlib.sha256(self._content('foo', '1.0')).hexdigest()
+
+        # A corrupted package is downloaded again
+        with open(path, 'r+b') as f:
+            f.write(b'x')
+        cache = Pf9AppCache(self.cache_dir)
+        assert self._download(cache, 'foo', '1.0') == path
+        assert len(PackageHandler.requests) == 2
+        with open(path, 'rb') as f:
+            assert f.read() == self._content('foo', '1.0')
+
+    def test_checksum(self):
+        cache = Pf9AppCache(self.cache_dir)
+        sha256 = hashlib.sha256(self._content('foo', '1.0')).hexdigest()
+        self._download(cache, 'foo', '1.0', checksum=sha256)
+        # A package with a different checksum is downloaded again
+        try:
+            self._download(cache, 'foo', '1.0', checksum='0' * 64)
+            assert False
+        except DownloadFailed:
+            pass
+        assert len(PackageHandler.requests) == 2
+        assert os.listdir(os.path.join(self.cache_dir, 'foo', '1.0')) == \
+            ['foo-1.0.rpm']
+
+    def test_resume(self):
+        cache = Pf9AppCache(self.cache_dir)
+        PackageHandler.cut_after = 1500000
+        try:
+            self._download(cache, 'foo', '1.0')
+            assert False
+        except DownloadFailed:
+            pass
+        tmp_path = os.path.join(self.cache_dir, 'foo', '1.0',
+                                'foo-1.0.rpm.incomplete')
+        offset = os.path.getsize(tmp_path)
+        assert 0 < offset <= 1500000
+
+        PackageHandler.cut_after = None
+        cache = Pf9AppCache(self.cache_dir)
+        path = self._download(cache, 'foo', '1.0')
+        assert PackageHandler.requests[-1]['Range'] == 'bytes=%d-' % offset
+        with open(path, 'rb') as f:
+            assert f.read() == self._content('foo', '1.0')
+        assert not os.path.exists(tmp_path)
+
+        # The server ignores the range when the package changed
+        PackageHandler.packages['/bar-1.0.rpm'] = os.urandom(2000000)
+        PackageHandler.cut_after = 1500000
+        try:
+            self._download(cache, 'bar', '1.0')
+            assert False
+        except DownloadFailed:
+            pass
+        PackageHandler.cut_after = None
+        PackageHandler.packages['/bar-1.0.rpm'] = os.urandom(50000)
+        path = self._download(cache, 'bar', '1.0')
+        assert PackageHandler.requests[-1]['Range']
+        with open(path, 'rb') as f:
+            assert f.read() == self._content('bar', '1.0')
+
+    def test_eviction(self):
+        PackageHandler.packages['/foo-1.0.rpm'] = os.urandom(100000)
+        cache = Pf9AppCache(self.cache_dir, max_size=250000)
+        for version in ['1.0', '1.1']:
+            self._download(cache, 'foo', version)
+        self._download(cache, 'bar', '1.0')
+        # Recently used packages are kept
+        assert len(os.listdir(os.path.join(self.cache_dir, 'foo'))) == 2
+
+        cache._index['foo/1.0']['last_used'] -= 7200
+        cache._index['foo/1.1']['last_used'] -= 3600 * 3
+        cache._save_index()
+        cache = Pf9AppCache(self.cache_dir, max_size=250000)
+        self._download(cache, 'bar', '1.0')
+        assert os.listdir(os.path.join(self.cache_dir, 'foo')) == ['1.0']
+        assert sorted(cache._index) == ['bar/1.0', 'foo/1.0']
@@ -0,0 +1,201 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+__author__ = 'Platform9'
+
+import pytest
+
+from pf9app import pf9_app, pf9_app_db
+from pf9app.pf9_app import Pf9App
+from pf9app.pf9_app_db import PackageInventory, Pf9AppDb, PkgMgr
+
+
+class FakePkgMgr(PkgMgr):
+    def __init__(self):
+        PkgMgr.__init__(self)
+        self.stamp = 1
+        self.queries = 0
+        self.apps = {'foo': {'name': 'foo', 'version': '1.0'}}
+
+    def db_stamp(self):
+        return self.stamp
+
+    def _read_inventory(self):
+        self.queries += 1
+        apps = dict((name, dict(app)) for name, app in self.apps.items())
+        return PackageInventory(apps, lambda name: [])
+
+
+class FakeApp(Pf9App):
+    calls = []
+
+    @property
+    def config_script_path(self):
+        return '/nonexistent/%s/config' % self.app_name
+
+    def _get_services(self):
+        self.calls.append('get_services')
+        return True, ['foo-svc']
+
+    def get_config(self):
+        self.calls.append('get_config')
+        return {'default': {'x': 1}}
+
+    def get_service_states(self, services=None):
+        self.calls.append('get_service_states')
+        return dict((svc, True) for svc in services)
+
+
+class FakeAppDb(Pf9AppDb):
+    def _get_package_manager(self):
+        self.pkgmgr = FakePkgMgr()
+
+    def make_app(self, name, version):
+        return FakeApp(name, version, self, log=self.log)
+
+    def _query_service_states(self, services):
+        FakeApp.calls.append('query_service_states')
+        return dict((svc, True) for svc in services)
+
+
+def test_current_config_cache():
+    app_db = FakeAppDb()
+    FakeApp.calls = []
+    expected = {
+        'foo': {
+            'version': '1.0',
+            'config': {'default': {'x': 1}},
+            'service_states': {'foo-svc': True}
+        }
+    }
+    config = app_db.get_current_config()
+    assert config == expected
+    assert app_db.pkgmgr.queries == 1
+    assert FakeApp.calls == ['get_services', 'get_config',
+                             'query_service_states']
+
+    # Only the service states are probed again, and the cached config
+    # can't be modified by the caller
+    config['foo']['config']['default']['x'] = 2
+    FakeApp.calls = []
+    assert app_db.get_current_config() == expected
+    assert app_db.pkgmgr.queries == 1
+    assert FakeApp.calls == ['query_service_states']
+
+    # Changes to the config by the host agent
+    app_db.app_config_changed(app_db.make_app('foo', '1.0'))
+    FakeApp.calls = []
+    app_db.get_current_config()
+    assert app_db.pkgmgr.queries == 2
+    assert FakeApp.calls == ['get_services', 'get_config',
+                             'query_service_states']
+
+    # Changes to the package database
+    app_db.pkgmgr.stamp = 2
+    app_db.pkgmgr.apps['foo']['version'] = '2.0'
+    FakeApp.calls = []
+    assert app_db.get_current_config()['foo']['version'] == '2.0'
+    assert app_db.pkgmgr.queries == 3
+    assert FakeApp.calls == ['get_services', 'get_config',
+                             'query_service_states']
+
+    # Expired entries, the package database is unchanged
+    app_db.config_max_age = 0
+    FakeApp.calls = []
+    app_db.get_current_config()
+    assert app_db.pkgmgr.queries == 3
+    assert FakeApp.calls == ['get_services', 'get_config',
+                             'query_service_states']
+
+
+def test_query_service_states(monkeypatch):
+    commands = []
+
+    def run_command(cmd):
+        commands.append(cmd)
+        if cmd.startswith('sudo systemctl'):
+            return 3, 'active\ninactive\nreloading\n', ''
+        return 0, '', ''
+
+    monkeypatch.setattr(pf9_app, '_run_command', run_command)
+    monkeypatch.setattr(pf9_app, 'is_init_service',
+                        lambda svc: svc == 'pf9-old')
+    states = pf9_app.query_service_states(['pf9-b', 'other', 'pf9-a',
+                                           'pf9-old', 'pf9-a'])
+    assert states == {'pf9-a': True, 'pf9-b': False, 'other': True,
+                      'pf9-old': True}
+    # A single command for all the systemd services, starting with the pf9
+    # ones for sudo
+    assert commands == ['sudo /etc/init.d/pf9-old status',
+                        'sudo systemctl is-active pf9-a pf9-b other']
+
+
+def test_get_current_config_batched(monkeypatch):
+    app_db = FakeAppDb()
+    app_db.pkgmgr.apps['bar'] = {'name': 'bar', 'version': '1.0'}
+    queries = []
+
+    def query_service_states(services):
+        queries.append(sorted(services))
+        return dict((svc, svc != 'bar') for svc in services)
+
+    monkeypatch.setattr(FakeApp, '_get_services',
+                        lambda self: (self.app_name == 'foo', ['foo-svc']))
+    monkeypatch.setattr(app_db, '_query_service_states', query_service_states)
+    config = app_db.get_current_config()
+    assert queries == [['bar', 'foo-svc']]
+    assert config['foo']['service_states'] == {'foo-svc': True}
+    assert config['bar']['running'] is False
+
+
+def test_services_memoized(monkeypatch):
+    commands = []
+
+    def run_command(cmd):
+        commands.append(cmd)
+        return 0, 'svc-a svc-b', ''
+
+    monkeypatch.setattr(pf9_app, '_run_command', run_command)
+    monkeypatch.setattr(pf9_app, '_services_cache', {})
+    for version in ['1.0', '1.0', '2.0']:
+        app = Pf9App('memo', version, None)
+        assert app.implements_service_states
+        assert app.services == ['svc-a', 'svc-b']
+    # Once per app version
+    assert len(commands) == 2
+
+
+def test_yum_inventory(monkeypatch):
+    commands = []
+
+    def run_command(cmd):
+        commands.append(cmd)
+        return 0, ('pf9-hostagent\t3.0-1\tpf9-hostagent \n'
+                   'pf9-foo\t1.0-2\tpf9-foo pf9app \n'
+                   'kernel\t5.0-1\tkernel \n'
+                   'kernel\t5.1-1\tkernel \n'), ''
+
+    monkeypatch.setattr(pf9_app_db, '_run_command_with_custom_pythonpath',
+                        run_command)
+    pkgmgr = pf9_app_db.YumPkgMgr()
+    stamp = [1]
+    monkeypatch.setattr(pkgmgr, 'db_stamp', lambda: stamp[0])
+    assert pkgmgr.query_pf9_apps() == {
+        'pf9-foo': {'name': 'pf9-foo', 'version': '1.0-2'}}
+    assert pkgmgr.query_pf9_agent() == {'name': 'pf9-hostagent',
+                                        'version': '3.0-1'}
+    assert pkgmgr._find_installed_pkg_version('kernel') == ['5.0-1', '5.1-1']
+    assert pkgmgr._find_installed_pkg_version('pf9-bar') == []
+    # A single query while the package database is unchanged
+    assert len(commands) == 1
+    stamp[0] = 2
+    pkgmgr.query_pf9_apps()
+    assert len(commands) == 2
+
+
+def test_incomplete_pkg_mgr():
+    class IncompletePkgMgr(PkgMgr):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompletePkgMgr()
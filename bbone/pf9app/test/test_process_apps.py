@@ -0,0 +1,84 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Tests the concurrent downloads and the batched installs of process_apps.
+"""
+
+import logging
+import threading
+import time
+
+from pf9app.algorithms import process_apps
+from pf9app.mock_app import MockRemoteApp
+from pf9app.mock_app_cache import MockAppCache
+from pf9app.mock_app_db import MockAppDb
+
+
+class RecordingRemoteApp(MockRemoteApp):
+    events = []
+    lock = threading.Lock()
+    active_downloads = 0
+    max_active_downloads = 0
+
+    def download(self):
+        cls = RecordingRemoteApp
+        with cls.lock:
+            cls.active_downloads += 1
+            cls.max_active_downloads = max(cls.max_active_downloads,
+                                           cls.active_downloads)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.active_downloads -= 1
+            if not self.local_path:
+                cls.events.append(('download', self.name))
+        super(RecordingRemoteApp, self).download()
+
+    @classmethod
+    def install_all(cls, apps):
+        cls.events.append(('install', sorted(app.name for app in apps)))
+        super(RecordingRemoteApp, cls).install_all(apps)
+
+
+def _app_spec(name, version, rank):
+    return {
+        'version': version,
+        'url': 'http://%s-%s.rpm' % (name, version),
+        'running': True,
+        'rank': rank,
+        'config': {}
+    }
+
+
+def test_process_apps():
+    RecordingRemoteApp.events = []
+    app_db = MockAppDb()
+    app_cache = MockAppCache('/tmp/cache', logging)
+    new_config = {
+        'foo': _app_spec('foo', '1.0', 1),
+        'bar': _app_spec('bar', '1.0', 2),
+        'baz': _app_spec('baz', '1.0', 1),
+        'qux': _app_spec('qux', '1.0', 0),
+    }
+    changes = process_apps(app_db, app_cache, RecordingRemoteApp, new_config,
+                           download_workers=4)
+    assert changes == 4
+    assert sorted(app_db.query_installed_apps()) == ['bar', 'baz', 'foo',
+                                                     'qux']
+    assert RecordingRemoteApp.max_active_downloads > 1
+
+    # All the downloads happen before the installs, which follow the ranks
+    events = RecordingRemoteApp.events
+    assert sorted(events[:4]) == [('download', name) for name in
+                                  ['bar', 'baz', 'foo', 'qux']]
+    assert events[4:] == [('install', ['qux']),
+                          ('install', ['baz', 'foo']),
+                          ('install', ['bar'])]
+
+    # Probing neither downloads nor installs
+    RecordingRemoteApp.events = []
+    new_config['quux'] = _app_spec('quux', '1.0', 0)
+    changes = process_apps(app_db, app_cache, RecordingRemoteApp, new_config,
+                           probe_only=True)
+    assert changes == 1
+    assert RecordingRemoteApp.events == []
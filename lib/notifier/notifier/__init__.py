@@ -18,6 +18,22 @@ _pending_msgs = []
 _lock = threading.Lock()
 
 
+def _connection_params(config):
+    """
+    Reads the broker connection parameters from the amqp section of config.
+    :return: tuple of host, credentials, virtual host and ssl options
+    """
+    username = config.get('amqp', 'username') \
+        if config.has_option('amqp', 'username') else 'guest'
+    password = config.get('amqp', 'password') \
+        if config.has_option('amqp', 'password') else 'm1llenn1umFalc0n'
+    credentials = pika.PlainCredentials(username=username, password=password)
+    host = config.get('amqp', 'host')
+    virt_host = config.get('amqp', 'virtual_host') if \
+             config.has_option('amqp', 'virtual_host') else None
+    return host, credentials, virt_host, get_ssl_options(config)
+
+
 def _io_thread(log, config):
 
     def _before_processing_messages():
@@ -53,15 +69,7 @@ def _io_thread(log, config):
         publish_notification('heartbeat', 'none', 'none')
         state['connection'].add_timeout(_HEARTBEAT_PERIOD, _heartbeat)
 
-    username = config.get('amqp', 'username') \
-        if config.has_option('amqp', 'username') else 'guest'
-    password = config.get('amqp', 'password') \
-        if config.has_option('amqp', 'password') else 'm1llenn1umFalc0n'
-    credentials = pika.PlainCredentials(username=username, password=password)
-    host = config.get('amqp', 'host')
-    virt_host = config.get('amqp', 'virtual_host') if \
-             config.has_option('amqp', 'virtual_host') else None
-    ssl_options = get_ssl_options(config)
+    host, credentials, virt_host, ssl_options = _connection_params(config)
 
     while True:
         state = {}
@@ -84,6 +92,59 @@ def _io_thread(log, config):
                            e, _CONNECTION_RETRY_PERIOD)
             time.sleep(_CONNECTION_RETRY_PERIOD)
 
+def _subscriber_thread(log, config, queue_name, binding_keys, callback):
+
+    def _consume_msg(ch, method, properties, body):
+        try:
+            msg = json.loads(body)
+        except ValueError:
+            log.error('Malformed change message: %s', body)
+            return
+        try:
+            callback(msg)
+        except:
+            log.exception('Change message callback failed for %s', msg)
+
+    host, credentials, virt_host, ssl_options = _connection_params(config)
+
+    while True:
+        state = {}
+        try:
+            log.info("Setting up change subscriber io loop, vhost=%s, keys=%s",
+                     virt_host, binding_keys)
+            io_loop(log=log,
+                    queue_name=queue_name,
+                    host=host,
+                    credentials=credentials,
+                    exch_name=_EXCH_NAME,
+                    state=state,
+                    before_processing_msgs_cb=None,
+                    exch_type='topic',
+                    # io_loop consumes the list as it binds the keys
+                    recv_keys=list(binding_keys),
+                    consume_cb=_consume_msg,
+                    virtual_host=virt_host,
+                    ssl_options=ssl_options,
+                    # Change records don't pile up while the subscriber is
+                    # down, it has to catch up on its own anyway
+                    auto_delete=True
+                    )
+
+        except pika.exceptions.AMQPConnectionError as e:
+            log.error('AMQP connection error "%s". Retrying in %d seconds.',
+                           e, _CONNECTION_RETRY_PERIOD)
+        except Exception:
+            log.exception('Unexpected exception in change subscriber io '
+                          'loop. Retrying in %d seconds.',
+                          _CONNECTION_RETRY_PERIOD)
+        try:
+            # Close the connection in case it was not closed properly
+            if 'connection' in state:
+                state['connection'].close()
+        except Exception:
+            log.warn('Failed to clean up change subscriber connection')
+        time.sleep(_CONNECTION_RETRY_PERIOD)
+
 def init(log, config):
     """
     Initializes the change publisher by starting its I/O thread.
@@ -108,3 +169,19 @@ def publish_notification(change_type, obj_type, obj_id):
     with _lock:
         _pending_msgs.append((routing_key, body))
 
+
+def subscribe(log, config, queue_name, binding_keys, callback):
+    """
+    Starts an I/O thread consuming change records from the message broker.
+    :param Logger log: The logger object
+    :param ConfigParser config: config object
+    :param str queue_name: Name of the queue bound to the changes exchange
+    :param list binding_keys: Routing key patterns to bind the queue with,
+        e.g. 'change.host.*'
+    :param function callback: Called with each change record (a dict with
+        change_type, obj_type and obj_id) from the I/O thread
+    """
+    t = threading.Thread(target=_subscriber_thread,
+                         args=(log, config, queue_name, binding_keys, callback))
+    t.daemon = True
+    t.start()
@@ -141,6 +141,7 @@ class ConsulRoles(object):
             LOG.info('Config section %s already exists', rolename)
         value = value.decode()
         self._config.set(rolename, param_name, value)
+        self._db.bump_config_generation()
 
         # The new param may make it possible to save a role that failed to
         # validate earlier. Let's try to save the pending adds again. If one
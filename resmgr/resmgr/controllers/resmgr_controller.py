@@ -11,11 +11,14 @@ This module will work in conjunction with bbone to manage pf9 software
 configuration on approved hosts.
 """
 
+import hashlib
 import logging
 import pecan
 import collections
 import six
+import threading
 from pecan import abort, expose
+from pecan.jsonify import encode
 from pecan.rest import RestController
 from resmgr.controllers.enforce_policy import enforce
 from resmgr.exceptions import *
@@ -28,6 +31,17 @@ _pkg = __import__('resmgr.%s' % _provider_name, globals(), locals())
 _module = getattr(_pkg, _provider_name)
 _provider = _module.get_provider(_resmgr_conf_file)
 
+# Query parameters of GET /hosts: pagination, projection and filters
+_HOST_LIST_PARAMS = ('limit', 'marker', 'fields', 'role', 'responding',
+                     'role_status')
+
+# Serialized GET /hosts responses keyed by query parameters:
+# (hosts version, etag, json body), least recently used first. Only
+# responses for the current hosts version are kept.
+_hosts_responses = collections.OrderedDict()
+_hosts_responses_lock = threading.Lock()
+_MAX_HOSTS_RESPONSES = 16
+
 def _json_error_response(response, code, exc):
     """
     json response from an exception object
@@ -41,6 +55,84 @@ def _json_error_response(response, code, exc):
         response.json = {'message': 'Request Failed'}
     return response
 
+def _host_list_params(kwargs, flags=()):
+    """
+    Validate the query parameters of GET /hosts and convert them to keyword
+    arguments for the provider's get_all_hosts.
+    :param dict kwargs: the query parameters
+    :param flags: names of additional true/false parameters
+    """
+    params = {}
+    for key, val in kwargs.items():
+        if key in flags or key == 'responding':
+            if val.lower() not in ['true', 'false']:
+                pecan.abort(400, 'Malformed request')
+            params[key] = val.lower() == 'true'
+        elif key == 'limit':
+            if not val.isdigit():
+                pecan.abort(400, 'Invalid limit {}'.format(val))
+            params[key] = int(val)
+        elif key == 'fields':
+            params[key] = tuple(sorted(set(field.strip()
+                                           for field in val.split(',')
+                                           if field.strip())))
+        elif key in _HOST_LIST_PARAMS:
+            params[key] = val
+        else:
+            pecan.abort(400, 'Invalid flag {}'.format(key))
+    return params
+
+def _cache_hosts_response(key, cached):
+    """
+    Keep a GET /hosts response, dropping the responses for other hosts
+    versions and the least recently used ones beyond _MAX_HOSTS_RESPONSES.
+    """
+    with _hosts_responses_lock:
+        for old_key, old_cached in list(_hosts_responses.items()):
+            if old_cached[0] != cached[0]:
+                del _hosts_responses[old_key]
+        _hosts_responses[key] = cached
+        _hosts_responses.move_to_end(key)
+        while len(_hosts_responses) > _MAX_HOSTS_RESPONSES:
+            _hosts_responses.popitem(last=False)
+
+def _all_hosts_response(params):
+    """
+    json response listing all hosts. The serialized list is kept until the
+    provider reports a change to the hosts, so polling clients are served
+    from memory, and get a 304 without a body if their If-None-Match
+    matches.
+    :param dict params: keyword arguments for the provider's get_all_hosts
+    """
+    version = _provider.get_hosts_version()
+    key = tuple(sorted(params.items()))
+    with _hosts_responses_lock:
+        cached = _hosts_responses.get(key)
+        if cached and cached[0] == version:
+            _hosts_responses.move_to_end(key)
+    if version is None or not cached or cached[0] != version:
+        log.debug('Getting details for all hosts')
+        res = _provider.get_all_hosts(**params)
+        if not res:
+            log.info('No hosts present')
+            res = {}
+        body = encode([val for val in itervalues(res)]).encode('utf-8')
+        cached = (version, hashlib.sha1(body).hexdigest(), body)
+        if version is not None:
+            _cache_hosts_response(key, cached)
+
+    _, etag, body = cached
+    response = pecan.response
+    response.etag = etag
+    if etag in pecan.request.if_none_match:
+        response.status = 304
+        return response
+    response.status = 200
+    response.content_type = 'application/json'
+    response.charset = 'utf-8'
+    response.body = body
+    return response
+
 def _validate_incoming_request_body(req_body):
     """Validate incoming request body for expected structure"""
     if len(req_body) == 0:
@@ -441,21 +533,23 @@ class HostsController(RestController):
     certs = HostCertController()
 
     @expose('json')
-    def get_all(self):
+    def get_all(self, **kwargs):
         """
         Handles requests of type GET /v1/hosts. Returns all hosts known
-        to the resource manager.
+        to the resource manager, in the order of their ids.
+        Optional query parameters:
+            limit, marker: return at most limit hosts, starting after the
+                host with id marker
+            fields: comma separated host attributes to return
+            role, responding, role_status: only return matching hosts
         :return: list of hosts. Empty list if no hosts are present.
         :rtype: list
         """
-        log.debug('Getting details for all hosts')
-        res = _provider.get_all_hosts(**{'role_settings': None})
-
-        if not res:
-            log.info('No hosts present')
-            return []
-
-        return [val for val in itervalues(res)]
+        params = _host_list_params(dict((key, val)
+                                        for key, val in kwargs.items()
+                                        if key in _HOST_LIST_PARAMS))
+        params['role_settings'] = None
+        return _all_hosts_response(params)
 
     @expose('json')
     def get_one(self, host_id):
@@ -502,31 +596,14 @@ class HostsControllerV2(HostsController):
     def get_all(self, **kwargs):
         """
         Handles requests of type GET /v2/hosts. Returns all hosts known
-        to the resource manager.
+        to the resource manager. Takes the query parameters of
+        GET /v1/hosts, and role_settings=true|false.
         :return: list of hosts. Empty list if no hosts are present.
         :rtype: list
         """
-        log.debug('Getting details for all hosts')
-        # Currently this API is experimental and subject to change if more
-        # filters, flags and pagination need to be added. Till that is
-        # formalized perform a "static" validation of parameters being passed.
-        valid_keys = ['role_settings']
-        valid_values = ['true', 'false']
-        params = {}
-        for key, val in kwargs.items():
-            if key not in valid_keys:
-                pecan.abort(400, 'Invalid flag {}'.format(key))
-            elif val.lower() not in valid_values:
-                pecan.abort(400, 'Malformed request')
-            params[key] = val.lower() == 'true'
-
-        res = _provider.get_all_hosts(**params)
-
-        if not res:
-            log.info('No hosts present')
-            return []
-
-        return [val for val in itervalues(res)]
+        # Unlike v1, unknown parameters are rejected
+        params = _host_list_params(kwargs, flags=['role_settings'])
+        return _all_hosts_response(params)
 
 class ServicesController(RestController):
     @enforce(required=['admin'])
@@ -0,0 +1,126 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+In-memory runtime state of the hosts reported by the backbone. The state of
+each host is an immutable HostState record. Writers replace records under a
+lock, readers get a snapshot of all records that is never modified after it
+is handed out, so they can walk it without holding any lock.
+"""
+
+import threading
+
+from collections import namedtuple
+
+HostState = namedtuple('HostState', [
+    # Host dict (id, roles, info) for hosts that are not in the database
+    # yet, None for authorized hosts
+    'unauthorized_host',
+    # Timestamps of the host's last status message, on the host and on the DU
+    'status_time',
+    'status_time_on_du',
+    # Overall role status of an authorized host
+    'role_status',
+    # Data reported by the host, passed through to the API as is
+    'hypervisor_info',
+    'extensions',
+    'cpu_info',
+    'cert_info',
+    # Messages for the host: {level: [{'code': ..., 'message': ...}]}
+    'message'
+])
+
+# Fields that the API doesn't return. Changing them alone doesn't change the
+# version of the store.
+UNVERSIONED_FIELDS = ('status_time', 'status_time_on_du')
+
+EMPTY_HOST_STATE = HostState(unauthorized_host=None,
+                             status_time=None,
+                             status_time_on_du=None,
+                             role_status=None,
+                             hypervisor_info='',
+                             extensions='',
+                             cpu_info='',
+                             cert_info='',
+                             message='')
+
+
+def _versioned(record):
+    """
+    :return: the record without its UNVERSIONED_FIELDS
+    """
+    return record._replace(**dict.fromkeys(UNVERSIONED_FIELDS))
+
+
+class HostStateStore(object):
+    """
+    Copy-on-write store of HostState records keyed by host id. Updates go to
+    a private working copy; the next snapshot() publishes it, so a batch of
+    updates by the poller costs one copy of the map rather than one per host.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._snapshot = {}
+        self._dirty = False
+        # Bumped by every change to a record, except to its
+        # UNVERSIONED_FIELDS
+        self.version = 0
+
+    def snapshot(self):
+        """
+        :return: dict of host id to HostState. Neither the dict nor the
+            records are modified afterwards. Must not be modified by the
+            caller.
+        """
+        if self._dirty:
+            with self._lock:
+                if self._dirty:
+                    self._snapshot = dict(self._hosts)
+                    self._dirty = False
+        return self._snapshot
+
+    def get(self, host_id):
+        """
+        :return: the HostState of the host, or None if it's not known
+        """
+        # Records are immutable, reading one doesn't need a snapshot
+        with self._lock:
+            return self._hosts.get(host_id)
+
+    def update(self, host_id, **fields):
+        """
+        Set fields of the host's record, creating it if needed.
+        :return: the new HostState
+        """
+        return self.modify(host_id, lambda record: record._replace(**fields))
+
+    def modify(self, host_id, func):
+        """
+        Atomically replace the host's record with func(record). func gets
+        EMPTY_HOST_STATE if the host is not known and must not block.
+        :return: the new HostState
+        """
+        with self._lock:
+            old_record = self._hosts.get(host_id)
+            record = func(old_record or EMPTY_HOST_STATE)
+            if record != old_record:
+                self._hosts[host_id] = record
+                self._dirty = True
+                if old_record is None or \
+                        _versioned(record) != _versioned(old_record):
+                    self.version += 1
+        return record
+
+    def remove(self, host_id):
+        """
+        Forget about the host.
+        :return: the HostState the host had, or None
+        """
+        with self._lock:
+            record = self._hosts.pop(host_id, None)
+            if record is not None:
+                self._dirty = True
+                self.version += 1
+        return record
@@ -80,13 +80,28 @@ class ResMgrProvider(object):
         pass
 
     @abstractmethod
-    def get_all_hosts(self, role_settings=False):
+    def get_all_hosts(self, role_settings=False, limit=None, marker=None,
+                      fields=None, role=None, responding=None,
+                      role_status=None):
         """
         Returns information about all known hosts
+        :param int limit: maximum number of hosts to return
+        :param str marker: only return hosts with ids after this one
+        :param fields: names of the host attributes to return
+        :param str role: only return hosts that have this role
+        :param bool responding: only return hosts with this responding state
+        :param str role_status: only return hosts with this role status
         :rtype: dict
         """
         pass
 
+    def get_hosts_version(self):
+        """
+        Returns a value that changes whenever the information returned by
+        get_all_hosts changes, or None if the provider can't tell.
+        """
+        return None
+
     @abstractmethod
     def add_role(self, host_id, role_id, version, host_settings):
         """
@@ -82,7 +82,8 @@ class ResMgrMemProvider(ResMgrProvider):
         ## TODO: error handling
         return sub_roles
 
-    def get_all_hosts(self, role_settings=False):
+    def get_all_hosts(self, role_settings=False, **filters):
+        # No pagination or filtering in the mock
         return self._get_hosts()
 
     def get_host(self, host_id):
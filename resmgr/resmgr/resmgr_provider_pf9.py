@@ -12,6 +12,8 @@ __author__ = 'Platform9'
 """
 This module provides real implementation of Resource Manager provider interface
 """
+import collections
+import concurrent.futures
 import copy
 import datetime
 import time
@@ -24,6 +26,7 @@ import threading
 import rabbit
 import random
 import requests
+import socket
 import string
 import subprocess
 import tempfile
@@ -37,6 +40,7 @@ from bbcommon.utils import is_satisfied_by
 from six.moves.queue import Queue, Empty
 from resmgr import role_states, dict_subst
 from resmgr.dbutils import ResMgrDB
+from resmgr.host_state import HostStateStore, EMPTY_HOST_STATE
 from resmgr.exceptions import *
 from resmgr.resmgr_provider import ResMgrProvider
 from resmgr.consul_roles import ConsulRoles, ConsulUnavailable
@@ -52,16 +56,7 @@ TIMEDRIFT_MSG = 'Host clock may be out of sync'
 # Maintain some state for resource manager
 
 # FIXME: get rid of this - everything should be in the database
-_unauthorized_hosts = {}
-_unauthorized_host_status_time = {}
-_unauthorized_host_status_time_on_du = {}
-_authorized_host_role_status = {}
-_hosts_hypervisor_info = {}
-_hosts_extension_data = {}
-_hosts_cpuinfo_data = {}
-_hosts_message_data = {}
-_hosts_cert_data = {}
-_host_lock = threading.Lock()
+_host_state = HostStateStore()
 _role_update_lock = threading.RLock()
 
 bucket = (2.5, 5.0, 10.0, 20.0, 30.0, 50.0, 100.0, 200.0, float('inf'))
@@ -261,6 +256,41 @@ def _remove_all_host_metrics(host_id, host_name):
     _remove_host_has_pmk_role_metric(host_id, host_name)
     _remove_all_host_cert_metrics(host_id, host_name)
 
+def _add_host_state(host, state):
+    """
+    Fill in the runtime state of a host in the host dict returned by the API
+    :param dict host: the host dict, modified in place
+    :param HostState state: the host's record in the host state store, or None
+    """
+    state = state or EMPTY_HOST_STATE
+    host['hypervisor_info'] = state.hypervisor_info
+    host['extensions'] = state.extensions
+    host['info']['cpu_info'] = state.cpu_info
+    host['cert_info'] = state.cert_info
+    host['message'] = state.message
+    return host
+
+def _unauthorized_host_copy(state):
+    """
+    Copy of the host dict of an unauthorized host that callers are free to
+    modify, with its runtime state filled in.
+    :param HostState state: the host's record in the host state store
+    """
+    host = dict(state.unauthorized_host)
+    host['roles'] = list(host['roles'])
+    host['info'] = dict(host['info'])
+    return _add_host_state(host, state)
+
+def _is_unauthorized_host(host_id):
+    state = _host_state.get(host_id)
+    return bool(state and state.unauthorized_host)
+
+def _host_cpu_info(host_info):
+    try:
+        return host_info['info'].get('cpu_info', '')
+    except KeyError:
+        return ''
+
 @traced_function
 def _update_custom_role_settings(app_info, role_settings, roles):
     """
@@ -897,53 +927,79 @@ class HostInventoryMgr(object):
         self.timeout = config.get("backbone", "requestTimeout")
 
     @traced_function
-    def get_all_hosts(self, role_settings=False):
+    def get_all_hosts(self, role_settings=False, limit=None, marker=None,
+                      fields=None, role=None, responding=None,
+                      role_status=None):
         """
-        Returns information about all known hosts.
+        Returns information about known hosts, in the order of their ids.
         :param role_settings: Boolean indicating whether role settings need to
                               be returned in the response dict
+        :param int limit: maximum number of hosts to return
+        :param str marker: only return hosts with ids after this one, the
+                           last host of the previous page
+        :param fields: names of the host attributes to return, all of them
+                       if None. The id is always returned.
+        :param str role: only return hosts that have this role
+        :param bool responding: only return hosts with this responding state
+        :param str role_status: only return hosts with this role status
         :rtype: dict:
         """
-        result = {}
-        query_op = self.db_handler.query_hosts()
+        # Everything below reads this one version of the host state
+        host_states = _host_state.snapshot()
+        host_ids = None
+        if role_status is not None:
+            host_ids = [id for id, state in iteritems(host_states)
+                        if state.role_status == role_status]
+        query_op = self.db_handler.query_hosts(role=role,
+                                               responding=responding,
+                                               host_ids=host_ids,
+                                               marker=marker, limit=limit)
+        hosts = {}
         for host in query_op:
             host_id = host['id']
-            if _authorized_host_role_status.get(host_id):
-                host['role_status'] = _authorized_host_role_status[host_id]
-            if role_settings is not None:
-                # /v1/hosts sends role_settings as None.
-                host['role_settings'] = {}
-            if role_settings:
-                host['role_settings'] = \
-                    self.db_handler.get_all_custom_settings(host_id)
-            host['hypervisor_info'] = _hosts_hypervisor_info.get(host_id, '')
-            host['extensions'] = _hosts_extension_data.get(host_id, '')
-            host['info']['cpu_info'] = _hosts_cpuinfo_data.get(host_id, '')
-            host['cert_info'] = _hosts_cert_data.get(host_id, '')
-            host['message'] = _hosts_message_data.get(host_id, '')
-            host['cert_info'] = _hosts_cert_data.get(host_id, '')
-            result[host_id] = host
-
-        # Add unauthorized hosts into the result
+            state = host_states.get(host_id)
+            if state and state.role_status:
+                host['role_status'] = state.role_status
+            hosts[host_id] = _add_host_state(host, state)
+        authorized_ids = set(hosts)
+
+        # Add unauthorized hosts into the result. They have neither roles nor
+        # a role status, and are only tracked while they're responding.
         log.debug('Looking up unauthorized hosts')
         iaas_9086_hosts = []
-        with _host_lock:
-            for id in iterkeys(_unauthorized_hosts):
-                if id in result:
+        if role is None and role_status is None and responding is not False:
+            for id, state in iteritems(host_states):
+                if not state.unauthorized_host or \
+                   (marker is not None and id <= marker):
+                    continue
+                if id in hosts:
                     iaas_9086_hosts.append(id)
                     continue
-                host = _unauthorized_hosts[id]
-                host['hypervisor_info'] = _hosts_hypervisor_info.get(host['id'], '')
-                host['extensions'] = _hosts_extension_data.get(host['id'], '')
-                host['info']['cpu_info'] = _hosts_cpuinfo_data.get(host['id'], '')
-                host['cert_info'] = _hosts_cert_data.get(host['id'], '')
-                host['message'] = _hosts_message_data.get(host['id'], '')
-                result[host['id']] = host
-            for id in iaas_9086_hosts:
-                log.debug('handling IAAS-9086 for host %s' % id)
-                _unauthorized_hosts.pop(id, None)
-                _unauthorized_host_status_time.pop(id, None)
-                _unauthorized_host_status_time_on_du.pop(id, None)
+                hosts[id] = _unauthorized_host_copy(state)
+
+        host_ids = sorted(hosts)
+        if limit is not None:
+            host_ids = host_ids[:limit]
+        if fields is not None and 'role_settings' not in fields:
+            role_settings = None
+        result = collections.OrderedDict()
+        for host_id in host_ids:
+            host = hosts[host_id]
+            if host_id in authorized_ids and role_settings is not None:
+                # /v1/hosts sends role_settings as None.
+                host['role_settings'] = {}
+                if role_settings:
+                    host['role_settings'] = \
+                        self.db_handler.get_all_custom_settings(host_id)
+            if fields is not None:
+                host = dict((key, val) for key, val in iteritems(host)
+                            if key == 'id' or key in fields)
+            result[host_id] = host
+
+        for id in iaas_9086_hosts:
+            log.debug('handling IAAS-9086 for host %s' % id)
+            _host_state.update(id, unauthorized_host=None, status_time=None,
+                               status_time_on_du=None)
 
         if iaas_9086_hosts:
             iaas_9086_url = os.getenv('IAAS_9086_WEBHOOK_URL')
@@ -966,9 +1022,9 @@ class HostInventoryMgr(object):
         :rtype: dict
         :raises HostNotFound: if the host is not present
         """
-        if host_id in _hosts_cert_data:
-            host_cert_info = _hosts_cert_data.get(host_id, '')
-            return host_cert_info
+        state = _host_state.get(host_id)
+        if state:
+            return state.cert_info
         else:
             log.error('Host %s is not a recognized host', host_id)
             raise HostNotFound(host_id)
@@ -986,15 +1042,10 @@ class HostInventoryMgr(object):
         if not result:
             # If not found in the authorized host list, look up the unauthorized
             # host list.
-            with _host_lock:
-                if host_id in _unauthorized_hosts:
-                    log.info('Found %s in unauthorized hosts', host_id)
-                    result = _unauthorized_hosts[host_id]
-                    result['hypervisor_info'] = _hosts_hypervisor_info.get(host_id, '')
-                    result['extensions'] = _hosts_extension_data.get(host_id, '')
-                    result['message'] = _hosts_message_data.get(host_id, '')
-                    result['info']['cpu_info'] = _hosts_cpuinfo_data.get(host_id, '')
-                    result['cert_info'] = _hosts_cert_data.get(host_id, '')
+            state = _host_state.get(host_id)
+            if state and state.unauthorized_host:
+                log.info('Found %s in unauthorized hosts', host_id)
+                result = _unauthorized_host_copy(state)
 
         return result
 
@@ -1009,14 +1060,10 @@ class HostInventoryMgr(object):
         """
         host = self.db_handler.query_host(host_id)
         if host:
-            if _authorized_host_role_status.get(host_id):
-                host['role_status'] = _authorized_host_role_status[host_id]
-            host['hypervisor_info'] = _hosts_hypervisor_info.get(host['id'], '')
-            host['extensions'] = _hosts_extension_data.get(host['id'], '')
-            host['message'] = _hosts_message_data.get(host['id'], '')
-            host['info']['cpu_info'] = _hosts_cpuinfo_data.get(host['id'], '')
-            host['cert_info'] = _hosts_cert_data.get(host['id'], '')
-            return host
+            state = _host_state.get(host_id)
+            if state and state.role_status:
+                host['role_status'] = state.role_status
+            return _add_host_state(host, state)
 
         return {}
 
@@ -1036,10 +1083,20 @@ class BbonePoller(object):
         self.config = config
         self.db_handle = db_handle
         self.rolemgr = rolemgr
-        # Backbone polling interval, in seconds
+        # Backbone polling interval, in seconds. Hosts are processed as soon
+        # as bbmaster announces a change, so this is only the interval of the
+        # full reconciliation sweep over all hosts.
         self.poll_interval = config.getint('backbone', 'pollInterval')
         self.bbone_endpoint = config.get('backbone', 'endpointURI')
         self.sidekick_url = config.get('sidekick', 'endpointURI')
+        # Maximum number of hosts looked up in a single bbmaster request
+        self.host_query_batch_size = config.getint('backbone', 'hostQueryBatchSize') \
+            if config.has_option('backbone', 'hostQueryBatchSize') else 100
+        # Number of threads existing hosts are processed with
+        self.host_workers = config.getint('backbone', 'hostProcessingWorkers') \
+            if config.has_option('backbone', 'hostProcessingWorkers') else 4
+        self._host_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(self.host_workers, 1))
         self.notifier = notifier
         # The default threshold time after which not responding hosts should
         # be removed, in seconds
@@ -1057,6 +1114,14 @@ class BbonePoller(object):
         # allows us to wake up the bbone poller on demand
         self._command_queue = Queue()
 
+        # Backbone host state, kept up to date with the bbmaster changes feed.
+        # _bbone_revision is the feed revision the cache is current to.
+        self._bbone_hosts = {}
+        self._bbone_revision = 0
+        # Fingerprint of the resmgr state each authorized host was last
+        # reconciled against. See _reconcile_fingerprint.
+        self._reconciled_hosts = {}
+
     def _responding_within_threshold(self,
                                     status_time,
                                     threshold=None):
@@ -1074,55 +1139,129 @@ class BbonePoller(object):
         return time_delta < threshold and -time_delta < threshold
 
     def _add_host_message(self, host_id, level, msg, code):
-        if host_id not in _hosts_message_data:
-            _hosts_message_data[host_id] = {}
-        message = _hosts_message_data[host_id]
-        if level not in message:
-            message[level] = []
-        else:
-            message[level] = list(filter(lambda item : item['code'] != code, message[level]))
-        message[level].append({'code' : code, 'message' : msg})
+        # The message dicts are shared with readers of the host state, so
+        # they are replaced rather than modified.
+        def add_message(state):
+            message = dict(state.message or {})
+            message[level] = [item for item in message.get(level, [])
+                              if item['code'] != code]
+            message[level].append({'code' : code, 'message' : msg})
+            return state._replace(message=message)
+        _host_state.modify(host_id, add_message)
 
     def _remove_host_message(self, host_id, level, code):
-        if host_id not in _hosts_message_data:
-            return
-        message = _hosts_message_data[host_id]
-        if level not in message:
+        state = _host_state.get(host_id)
+        if not state or not state.message or \
+           not any(item['code'] == code for item in state.message.get(level, [])):
             return
-        message[level] = list(filter(lambda item : item['code'] != code, message[level]))
-        if len(message[level]) == 0:
-            message.pop(level, None)
-            if len(_hosts_message_data[host_id]) == 0:
-                    _hosts_message_data.pop(host_id, None)
+        def remove_message(state):
+            message = dict(state.message or {})
+            items = [item for item in message.get(level, [])
+                     if item['code'] != code]
+            if items:
+                message[level] = items
+            else:
+                message.pop(level, None)
+            return state._replace(message=message or '')
+        _host_state.modify(host_id, remove_message)
 
     @traced_function
-    def _get_backbone_host(self, host):
-        return call_remote_service('%s/v1/hosts/%s' %
-                                   (self.bbone_endpoint, host))
+    def _get_backbone_hosts(self, host_ids):
+        """
+        Query backbone for the state of a set of hosts. The hosts are looked
+        up in batches of host_query_batch_size, so that a poll cycle costs a
+        handful of requests regardless of the number of hosts.
+        :param set host_ids: IDs of the hosts to look up
+        :return: backbone host state keyed by host id. Hosts that backbone
+                 does not know about are left out.
+        :rtype: dict
+        :raises BBMasterNotFound: if communication to the backbone fails
+        """
+        result = {}
+        host_ids = sorted(host_ids)
+        for i in range(0, len(host_ids), self.host_query_batch_size):
+            batch = host_ids[i:i + self.host_query_batch_size]
+            hosts = call_remote_service('%s/v1/hosts?ids=%s' %
+                                        (self.bbone_endpoint, ','.join(batch)))
+            for host_info in hosts:
+                result[host_info['host_id']] = host_info
+        return result
 
     @traced_function
     def _get_backbone_host_ids(self):
         return set(call_remote_service('%s/v1/hosts/ids' %
                                        self.bbone_endpoint))
 
+    @traced_function
+    def _get_backbone_host_changes(self, since):
+        return call_remote_service('%s/v1/hosts/changes?since=%d' %
+                                   (self.bbone_endpoint, since))
+
+    @traced_function
+    def _refresh_backbone_hosts(self, host_ids):
+        """
+        Bring the cached backbone host state up to date. Only the hosts whose
+        state changed since the previous refresh are downloaded, the status
+        timestamps of the other hosts are taken from the changes feed. The
+        hosts whose volatile extensions (resource usage, cpu stats) changed
+        alone are downloaded too, and only their extensions are updated.
+        :param set host_ids: IDs of the hosts backbone is aware of
+        :return: IDs of the hosts whose state changed
+        :rtype: set
+        :raises BBMasterNotFound: if communication to the backbone fails
+        """
+        changes = self._get_backbone_host_changes(self._bbone_revision)
+        changed_ids = set(changes['changed']) & host_ids
+        changed_ids |= host_ids - set(self._bbone_hosts)
+        metrics_ids = set(changes.get('metrics_changed', [])) & host_ids
+        metrics_ids -= changed_ids
+        downloaded = self._get_backbone_hosts(changed_ids | metrics_ids)
+
+        for host in list(self._bbone_hosts):
+            if host not in host_ids:
+                del self._bbone_hosts[host]
+        self._bbone_hosts.update(downloaded)
+        for host, timestamps in iteritems(changes['timestamps']):
+            if host in self._bbone_hosts and host not in downloaded:
+                self._bbone_hosts[host].update(timestamps)
+        for host in metrics_ids & set(downloaded):
+            if _host_state.get(host) is not None:
+                _host_state.update(host, extensions=downloaded[host].get(
+                    'extensions', ''))
+        self._bbone_revision = changes['revision']
+        return set(downloaded) - metrics_ids
+
+    @staticmethod
+    def _reconcile_fingerprint(host_details, responding):
+        """
+        Summarize the resmgr state an authorized host is reconciled against.
+        A host whose backbone state did not change needs no reconciliation
+        as long as this stays the same.
+        """
+        return json.dumps([responding,
+                           host_details['role_states'],
+                           host_details['apps_config'],
+                           host_details['role_settings']],
+                          sort_keys=True, default=str)
+
     G = g_hosts_processing_time_last.labels('new_hosts')
     H = g_hosts_processing_time.labels('new_hosts')
     @G.time()
     @H.time()
     @traced_function
-    def _process_new_hosts(self, host_ids):
+    def _process_new_hosts(self, host_ids, bbone_hosts):
         """
         Process hosts that are reported by backbone but are not present in resource
         manager's state
         :param list host_ids: list of host IDs
+        :param dict bbone_hosts: backbone host state keyed by host id
         """
         # These hosts are new from the DB point of view. Such hosts have to
         # start in the unauthorized bucket
         for host in host_ids:
-            try:
-                host_info = self._get_backbone_host(host)
-            except BBMasterNotFound:
-                log.exception('Querying backbone for %s failed', host)
+            host_info = bbone_hosts.get(host)
+            if not host_info:
+                log.warn('No backbone state for %s', host)
                 continue
 
             if host_info['status'] == 'missing' or 'info' not in iterkeys(host_info):
@@ -1151,20 +1290,15 @@ class BbonePoller(object):
             # TODO: There is a potential case here where we want to clear out remnant
             # roles (pf9apps) from a newly/unauthorized hosts.
 
-            # assignment to _unauthorized_* dicts is atomic. There is no need
-            # for a lock here.
-            # See http://effbot.org/pyfaq/what-kinds-of-global-value-mutation-are-thread-safe.htm
             log.info('adding new host %s to unauthorized hosts', unauth_host)
-            _unauthorized_hosts[host] = unauth_host
-            _unauthorized_host_status_time[host] = status_time
-            _unauthorized_host_status_time_on_du[host] = status_time_on_du
-            _hosts_hypervisor_info[host] = host_info.get('hypervisor_info', '')
-            _hosts_extension_data[host] = host_info.get('extensions', '')
-            try:
-                _hosts_cpuinfo_data[host] = host_info['info'].get('cpu_info', '')
-            except KeyError:
-                _hosts_cpuinfo_data[host] = ''
-            _hosts_cert_data[host] = host_info.get('cert_info', '')
+            _host_state.update(host,
+                               unauthorized_host=unauth_host,
+                               status_time=status_time,
+                               status_time_on_du=status_time_on_du,
+                               hypervisor_info=host_info.get('hypervisor_info', ''),
+                               extensions=host_info.get('extensions', ''),
+                               cpu_info=_host_cpu_info(host_info),
+                               cert_info=host_info.get('cert_info', ''))
 
 
             # Trigger the notifier so that clients know about it.
@@ -1183,19 +1317,14 @@ class BbonePoller(object):
         :param dict authorized_hosts: details of the authorized hosts
         """
         for host in host_ids:
-            with _host_lock:
-                if host in _unauthorized_hosts:
-                    log.warn("Unauthorized host being removed: %s", host)
-                    _remove_all_host_metrics(id, _unauthorized_hosts[id]['info']['hostname'])
-                    _unauthorized_hosts.pop(host, None)
-                    _unauthorized_host_status_time.pop(host, None)
-                    _unauthorized_host_status_time_on_du.pop(host, None)
-                    _hosts_hypervisor_info.pop(host, None)
-                    _hosts_extension_data.pop(host, None)
-                    _hosts_cpuinfo_data.pop(host, None)
-                    _hosts_cert_data.pop(host, None)
-                    self.notifier.publish_notification('delete', 'host', host)
-                    continue
+            state = _host_state.get(host)
+            if state and state.unauthorized_host:
+                log.warn("Unauthorized host being removed: %s", host)
+                _remove_all_host_metrics(
+                    host, state.unauthorized_host['info']['hostname'])
+                _host_state.remove(host)
+                self.notifier.publish_notification('delete', 'host', host)
+                continue
 
             with _role_update_lock:
                 # There may be hosts that need to be deauthorized but are offline (and
@@ -1232,8 +1361,9 @@ class BbonePoller(object):
         else:
             host_status = host['status']
 
-        if _authorized_host_role_status.get(host_id) != host_status:
-            _authorized_host_role_status[host_id] = host_status
+        state = _host_state.get(host_id)
+        if (state.role_status if state else None) != host_status:
+            _host_state.update(host_id, role_status=host_status)
             self.notifier.publish_notification('change', 'host', host_id)
 
     G = g_hosts_processing_time_last.labels('existing_hosts')
@@ -1241,21 +1371,49 @@ class BbonePoller(object):
     @G.time()
     @H.time()
     @traced_function
-    def _process_existing_hosts(self, host_ids, authorized_hosts):
+    def _process_existing_hosts(self, host_ids, authorized_hosts, bbone_hosts,
+                                changed_ids):
         """
         Process hosts that are reported by backbone and is also tracked in our state
         :param list host_ids: list of host ids
         :param dict authorized_hosts: details of the authorized hosts
+        :param dict bbone_hosts: backbone host state keyed by host id
+        :param set changed_ids: ids of the hosts whose backbone state changed
+                                since the previous poll
+        """
+        host_ids = list(host_ids)
+        if self.host_workers <= 1 or len(host_ids) <= 1:
+            self._process_existing_host_shard(host_ids, authorized_hosts,
+                                              bbone_hosts, changed_ids)
+            return
+
+        # Shard the hosts by id so that a host is only ever handled by a
+        # single worker, sequentially.
+        shards = [[] for _ in range(self.host_workers)]
+        for host in host_ids:
+            shards[hash(host) % self.host_workers].append(host)
+        futures = [self._host_pool.submit(self._process_existing_host_shard,
+                                          shard, authorized_hosts,
+                                          bbone_hosts, changed_ids)
+                   for shard in shards if shard]
+        # Wait for all the shards before surfacing the first failure
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def _process_existing_host_shard(self, host_ids, authorized_hosts,
+                                     bbone_hosts, changed_ids):
+        """
+        Process a list of existing hosts one after another. See
+        _process_existing_hosts for the parameters.
         """
         for host in host_ids:
             with _role_update_lock:
                 self._advance_from_transient_state(host,
                                                    authorized_hosts.get(host))
-            try:
-                host_info = self._get_backbone_host(host)
-            except BBMasterNotFound:
-                log.exception('Querying backbone for %s failed', host)
-                # TODO: Should we return instead of continuing here?
+            host_info = bbone_hosts.get(host)
+            if not host_info:
+                log.warn('No backbone state for %s', host)
                 continue
 
             status_time = datetime.datetime.strptime(host_info['timestamp'],
@@ -1267,13 +1425,13 @@ class BbonePoller(object):
                 hostname = host_info['info']['hostname']
             except KeyError:
                 hostname = None
-            _hosts_hypervisor_info[host] = host_info.get('hypervisor_info', '')
-            _hosts_extension_data[host] = host_info.get('extensions', '')
-            try:
-                _hosts_cpuinfo_data[host] = host_info['info'].get('cpu_info', '')
-            except KeyError:
-                _hosts_cpuinfo_data[host] = ''
-            _hosts_cert_data[host] = host_info.get('cert_info')
+            changed = host in changed_ids
+            if changed:
+                _host_state.update(host,
+                                   hypervisor_info=host_info.get('hypervisor_info', ''),
+                                   extensions=host_info.get('extensions', ''),
+                                   cpu_info=_host_cpu_info(host_info),
+                                   cert_info=host_info.get('cert_info'))
 
             host_status = host_info['status']
             if host_status in ('converging', 'retrying'):
@@ -1301,6 +1459,19 @@ class BbonePoller(object):
                     log.info('Marking %s as %s responding, status time: %s',
                              host, '' if (responding or responding_on_du) else 'not', host_info['timestamp'])
 
+                # Hosts whose backbone state and resmgr state are unchanged
+                # since they were last reconciled need no further work,
+                # unless one of their roles is still moving through the
+                # state machine.
+                fingerprint = self._reconcile_fingerprint(
+                    authorized_hosts[host], responding or responding_on_du)
+                role_states_now = authorized_hosts[host]['role_states']
+                if not changed and \
+                   self._reconciled_hosts.get(host) == fingerprint and \
+                   not any(role_states.role_is_converging(str(s))
+                           for s in role_states_now.values()):
+                    continue
+
                 # Active hosts but we need to change the configuration
                 try:
                     if self.rolemgr.received_since_last_push(host, host_info) and \
@@ -1361,19 +1532,22 @@ class BbonePoller(object):
                             self.db_handle.update_host_info(host, updated_host_info)
                             self.notifier.publish_notification('change', 'host', host)
 
+                    self._reconciled_hosts[host] = fingerprint
                 except (BBMasterNotFound, HostConfigFailed):
                     log.exception('Backbone request for %s failed', host)
                     continue
             else:
-                # assignment to _unauthorized_* dicts is atomic. There is no need
-                # for a lock here.
-                # See http://effbot.org/pyfaq/what-kinds-of-global-value-mutation-are-thread-safe.htm
-                _unauthorized_host_status_time[host] = status_time
-                _unauthorized_host_status_time_on_du[host] = status_time_on_du
+                state = _host_state.update(host, status_time=status_time,
+                                           status_time_on_du=status_time_on_du)
+                unauth_host = state.unauthorized_host
                 # TODO: Is there a need to update the unauthorized hosts with more data
                 # returned from bbone?
-                if hostname and _unauthorized_hosts[host]['info']['hostname'] != hostname:
-                    _unauthorized_hosts[host]['info']['hostname'] = hostname
+                if changed and hostname and unauth_host and \
+                   unauth_host['info']['hostname'] != hostname:
+                    unauth_host = dict(unauth_host)
+                    unauth_host['info'] = dict(unauth_host['info'],
+                                               hostname=hostname)
+                    _host_state.update(host, unauthorized_host=unauth_host)
                     self.notifier.publish_notification('change', 'host', host)
 
     H = g_misc_functions_processing_time.labels('_finish_role_converge')
@@ -1500,30 +1674,32 @@ class BbonePoller(object):
         within the status time.
         """
         cleanup_hosts = []
-        with _host_lock:
-            for id in iterkeys(_unauthorized_hosts):
-                if not (self._responding_within_threshold(_unauthorized_host_status_time[id])
-                        or self._responding_within_threshold(_unauthorized_host_status_time_on_du[id])):
-                    # Maintain a list of hosts that are past the threshold
-                    cleanup_hosts.append(id)
-
-            if cleanup_hosts:
-                log.warn("Unauthorized hosts that are being removed: %s", cleanup_hosts)
-
-            for id in cleanup_hosts:
-                _remove_all_host_metrics(id, _unauthorized_hosts[id]['info']['hostname'])
-                _unauthorized_hosts.pop(id, None)
-                _unauthorized_host_status_time.pop(id, None)
-                _unauthorized_host_status_time_on_du.pop(id, None)
-                _hosts_message_data.pop(id, None)
-                self.notifier.publish_notification('delete', 'host', id)
+        for id, state in iteritems(_host_state.snapshot()):
+            if not state.unauthorized_host:
+                continue
+            if not (self._responding_within_threshold(state.status_time)
+                    or self._responding_within_threshold(state.status_time_on_du)):
+                # Maintain a list of hosts that are past the threshold
+                cleanup_hosts.append((id, state))
+
+        if cleanup_hosts:
+            log.warn("Unauthorized hosts that are being removed: %s",
+                     [id for id, _ in cleanup_hosts])
+
+        for id, state in cleanup_hosts:
+            _remove_all_host_metrics(id, state.unauthorized_host['info']['hostname'])
+            _host_state.update(id, unauthorized_host=None, status_time=None,
+                               status_time_on_du=None, message='')
+            self.notifier.publish_notification('delete', 'host', id)
 
     def process_metrics(self):
         authorized_hosts = self.db_handle.query_host_and_app_details()
+        host_states = _host_state.snapshot()
 
         for ak, av in authorized_hosts.items():
+            state = host_states.get(ak)
             _record_host_up_metric(av['responding'], ak, av['hostname'])
-            _record_host_converged_metric(_authorized_host_role_status.get(ak, 'unknown') == 'ok',
+            _record_host_converged_metric(bool(state) and state.role_status == 'ok',
                                           ak, av['hostname'])
 
             ispmkhost = False
@@ -1533,28 +1709,32 @@ class BbonePoller(object):
                     break
             _record_host_has_pmk_role_metric(ispmkhost, ak ,av['hostname'])
             # Process the host cert related metrics
-            if ak in _hosts_cert_data:
-                cert_info = _hosts_cert_data.get(ak, '')
-                if cert_info:
-                    _record_host_cert_metrics(cert_info, ak, av['hostname'])
+            if state and state.cert_info:
+                _record_host_cert_metrics(state.cert_info, ak, av['hostname'])
 
-        for uk, uv in _unauthorized_hosts.items():
+        for uk, state in iteritems(host_states):
+            uv = state.unauthorized_host
+            if not uv:
+                continue
             _record_host_up_metric(1, uk, uv['info']['hostname'])
-            if uk in _hosts_cert_data:
-                cert_info = _hosts_cert_data.get(uk, '')
-                if cert_info:
-                    _record_host_cert_metrics(cert_info, uk,
-                                        uv['info']['hostname'])
+            if state.cert_info:
+                _record_host_cert_metrics(state.cert_info, uk,
+                                    uv['info']['hostname'])
 
     G = g_hosts_processing_time_last.labels('all_hosts')
     H = g_hosts_processing_time.labels('all_hosts')
     @G.time()
     @H.time()
     @traced_function
-    def process_hosts(self, post_db_read_hook_func=None):
+    def process_hosts(self, post_db_read_hook_func=None, host_ids=None):
         """
         Routine to query bbone for host info and process it
+        :param set host_ids: If specified, only these hosts are processed,
+            instead of sweeping over all hosts
         """
+        if host_ids is not None:
+            self._process_changed_hosts(host_ids)
+            return
         try:
             bbone_ids = self._get_backbone_host_ids()
         except BBMasterNotFound:
@@ -1563,7 +1743,9 @@ class BbonePoller(object):
             # Get authorized host ids and unauthorized host ids and store it
             # in all_ids
             authorized_hosts = self.db_handle.query_host_and_app_details()
-            all_ids = set(list(iterkeys(authorized_hosts)) + list(iterkeys(_unauthorized_hosts)))
+            all_ids = set(authorized_hosts)
+            all_ids.update(id for id, state in iteritems(_host_state.snapshot())
+                           if state.unauthorized_host)
             new_ids = bbone_ids - all_ids
             del_ids = all_ids - bbone_ids
             exist_ids = all_ids & bbone_ids
@@ -1579,42 +1761,109 @@ class BbonePoller(object):
             if post_db_read_hook_func:
                 post_db_read_hook_func()
 
+            # Download the state of the hosts that changed since the
+            # previous poll
+            try:
+                changed_ids = self._refresh_backbone_hosts(bbone_ids)
+                bbone_hosts = self._bbone_hosts
+            except BBMasterNotFound:
+                log.exception('Querying backbone for host state failed')
+                changed_ids = set()
+                bbone_hosts = {}
+
             # Process hosts that are newly reported from backbone
-            self._process_new_hosts(new_ids)
+            self._process_new_hosts(new_ids, bbone_hosts)
             # Process hosts that backbone claims are not present anymore(?)
             self._process_absent_hosts(del_ids, authorized_hosts)
             # Deal with changes to existing hosts
-            self._process_existing_hosts(exist_ids, authorized_hosts)
+            self._process_existing_hosts(exist_ids, authorized_hosts,
+                                         bbone_hosts, changed_ids)
+            for host in list(self._reconciled_hosts):
+                if host not in authorized_hosts:
+                    del self._reconciled_hosts[host]
             # Cleanup older unauthorized hosts
             self._cleanup_unauthorized_hosts()
 
-            # Process metrics at the end of the loop
+            # Process metrics at the end of a full sweep
             self.process_metrics()
 
+    @traced_function
+    def _process_changed_hosts(self, host_ids):
+        """
+        Process the hosts bbmaster reported as changed. Only the state of
+        these hosts is read from backbone and from the database, the other
+        hosts are left to the next sweep.
+        :param set host_ids: IDs of the hosts
+        """
+        try:
+            bbone_hosts = self._get_backbone_hosts(host_ids)
+        except BBMasterNotFound:
+            log.exception('Querying backbone for host state failed')
+            return
+        authorized_hosts = self.db_handle.query_host_and_app_details(
+            host_ids=host_ids)
+        known_ids = set(authorized_hosts)
+        for host in host_ids:
+            state = _host_state.get(host)
+            if state and state.unauthorized_host:
+                known_ids.add(host)
+        bbone_ids = set(bbone_hosts)
+        # The sweep downloads these hosts again, the changes feed reports
+        # them too
+        self._bbone_hosts.update(bbone_hosts)
+
+        self._process_new_hosts(bbone_ids - known_ids, bbone_hosts)
+        self._process_absent_hosts(known_ids - bbone_ids, authorized_hosts)
+        self._process_existing_hosts(known_ids & bbone_ids, authorized_hosts,
+                                     bbone_hosts, bbone_ids)
+
     def run(self):
         """
         Main poller routine
         """
         log.debug('start backbone poll routine')
+        next_sweep = 0
+        changed_hosts = set()
         while (True):
             # Get the host ids that backbone is aware of
             try:
-                self.process_hosts()
-                command = self._command_queue.get(block=True,
-                                                  timeout=self.poll_interval)
-                if command == 'stop':
-                    log.debug('Stopping bbone poller')
-                    break
-                elif command == 'wake':
-                    log.debug('Running bbone poll after a request')
+                hosts, changed_hosts = changed_hosts, set()
+                if time.time() >= next_sweep:
+                    self.process_hosts()
+                    next_sweep = time.time() + self.poll_interval
+                elif hosts:
+                    log.debug('Processing changed hosts %s', hosts)
+                    self.process_hosts(host_ids=hosts)
+                command = self._command_queue.get(
+                        block=True, timeout=max(next_sweep - time.time(), 0))
+                # Coalesce the commands that queued up in the meantime
+                while True:
+                    if command == 'stop':
+                        log.debug('Stopping bbone poller')
+                        return
+                    elif command == 'wake':
+                        log.debug('Running bbone poll after a request')
+                        next_sweep = 0
+                    else:
+                        changed_hosts.add(command[1])
+                    command = self._command_queue.get_nowait()
             except Empty:
-                log.debug('Running bbone poller again after %d seconds',
-                          self.poll_interval)
+                if not changed_hosts:
+                    log.debug('Running bbone poller again after %d seconds',
+                              self.poll_interval)
             except:
                 # Ensure that this poller will never go down.
                 # Log and continue
                 log.exception('Poller encountered an error')
 
+    def on_bbone_host_change(self, msg):
+        """
+        Callback for the host change records bbmaster publishes on the
+        pf9-changes exchange. Runs in the notifier's I/O thread.
+        :param dict msg: change record with change_type, obj_type and obj_id
+        """
+        self._command_queue.put(('host', msg['obj_id']))
+
     def wake_up(self):
         self._command_queue.put('wake')
 
@@ -1654,6 +1903,10 @@ class ResMgrPf9Provider(ResMgrProvider):
         t = threading.Thread(target=self.bbone_poller.run)
         t.daemon = True
         t.start()
+        notifier.subscribe(log, config,
+                           'resmgr-bbone-host-changes-%s' % socket.gethostname(),
+                           ['change.bbone_host.*'],
+                           self.bbone_poller.on_bbone_host_change)
 
         while True:
             try:
@@ -1802,14 +2055,25 @@ class ResMgrPf9Provider(ResMgrProvider):
     def get_app_versions(self, role_name):
         return self.roles_mgr.get_app_versions(role_name)
 
-    def get_all_hosts(self, role_settings=False):
+    def get_all_hosts(self, role_settings=False, **filters):
         """
         Returns information about all known hosts
+        :param filters: pagination, projection and filters, see
+                        HostInventoryMgr.get_all_hosts
         :return: dictionary of hosts and their information
         :rtype: dict
         """
         return self.host_inventory_mgr.get_all_hosts(
-            role_settings=role_settings)
+            role_settings=role_settings, **filters)
+
+    def get_hosts_version(self):
+        """
+        Returns a value that changes whenever the result of get_all_hosts may
+        have changed: the database write generation and the version of the
+        in-memory host state. Both are counted by this process: writes to
+        the database by another resmgr replica don't change it.
+        """
+        return self.res_mgr_db.write_generation, _host_state.version
 
     def get_host(self, host_id):
         """
@@ -1828,7 +2092,7 @@ class ResMgrPf9Provider(ResMgrProvider):
         :raises HostConfigFailed: if setting the configuration fails or times out
         :raises BBMasterNotFound: if communication to the backbone fails
         """
-        if host_id in _unauthorized_hosts:
+        if _is_unauthorized_host(host_id):
             log.warn('Host %s is classified as unauthorized host. Nothing '
                      'to delete', host_id)
             return
@@ -1981,7 +2245,7 @@ class ResMgrPf9Provider(ResMgrProvider):
 
         initially_inactive = not host_inst['roles']
         host_inst['roles'].append(role_name)
-        _authorized_host_role_status[host_id] = None
+        _host_state.update(host_id, role_status=None)
 
         if initially_inactive:
             notifier.publish_notification('change', 'host', host_id)
@@ -2005,13 +2269,11 @@ class ResMgrPf9Provider(ResMgrProvider):
                                                                      version)
                 curr_role_state = self._move_to_apply_edit_state(host_id,
                                                                  role_name)
-                with _host_lock:
-                    # Once added to the DB, remove it from the unauthorized
-                    # host dict. Note that we don't need to undo this in the
-                    # exception handler; it's re-added by process_hosts
-                    _unauthorized_hosts.pop(host_id, None)
-                    _unauthorized_host_status_time.pop(host_id, None)
-                    _unauthorized_host_status_time_on_du.pop(host_id, None)
+                # Once added to the DB, it's no longer an unauthorized host.
+                # Note that we don't need to undo this in the exception
+                # handler; it's re-added by process_hosts
+                _host_state.update(host_id, unauthorized_host=None,
+                                   status_time=None, status_time_on_du=None)
                 # IAAS-6519: rabbit changes after state machine starts
                 rabbit_user, rabbit_password = \
                         self.create_rabbit_credentials(host_id, role_name, version)
@@ -2066,7 +2328,7 @@ class ResMgrPf9Provider(ResMgrProvider):
 
         # FIXME - I think this can be removed. Not sure why we're not just
         # using the db state.
-        if host_id in _unauthorized_hosts:
+        if _is_unauthorized_host(host_id):
             log.warn('Host %s is classified as unauthorized host. Nothing '
                      'to delete', host_id)
             return
@@ -0,0 +1,114 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved.
+
+"""
+Compiled role config templates. A role's desiredconfig is a JSON document
+whose strings may contain python format tokens like %(host_id)s. Compiling
+it once walks the document and keeps only the strings that have tokens in
+them, so rendering it for a host is a matter of filling in those slots.
+"""
+
+import re
+
+from six import iteritems
+
+# Previous versions of resource manager used string substitution with
+# tokens like __HOST_ID__. These may still be in the role spec in the
+# resource manager database.
+LEGACY_TOKENS = {
+    '__HOST_ID__': '%(host_id)s',
+    '__RABBIT_USERID__': '%(rabbit_userid)s',
+    '__RABBIT_PASSWORD__': '%(rabbit_password)s',
+    '__RABBIT_TRANSPORT_URL__': '%(rabbit_transport_url)s',
+    '__HOST_CONFIG__': '%(host_config)s'
+}
+
+_PARAM_RE = re.compile(r'%(?:%|\(([^)]*)\))')
+
+
+def replace_legacy_tokens(value):
+    """
+    Replace the legacy __TOKEN__ style tokens in a string with python format
+    tokens.
+    """
+    for underscore_token, py_token in iteritems(LEGACY_TOKENS):
+        value = value.replace(underscore_token, py_token)
+    return value
+
+
+class _Slot(object):
+    """A string with format tokens in it."""
+    __slots__ = ('fmt',)
+
+    def __init__(self, fmt, names):
+        """
+        :raises ValueError: if the format is malformed
+        """
+        # Rendered with a dummy value that suits any conversion type, so
+        # that only the format itself can fail
+        try:
+            fmt % dict.fromkeys(names, 0)
+        except (ValueError, TypeError) as e:
+            raise ValueError('Bad format string %r: %s' % (fmt, e))
+        self.fmt = fmt
+
+
+def _compile(value, params):
+    if isinstance(value, dict):
+        return dict((_compile(k, params), _compile(v, params))
+                    for k, v in iteritems(value))
+    if isinstance(value, list):
+        return [_compile(v, params) for v in value]
+    if isinstance(value, str):
+        value = replace_legacy_tokens(value)
+        if '%' in value:
+            names = set(name for name in _PARAM_RE.findall(value) if name)
+            params.update(names)
+            return _Slot(value, names)
+    return value
+
+
+def _render(node, params):
+    node_type = type(node)
+    if node_type is dict:
+        return dict((_render(k, params), _render(v, params))
+                    for k, v in iteritems(node))
+    if node_type is list:
+        return [_render(v, params) for v in node]
+    if node_type is _Slot:
+        return node.fmt % params
+    return node
+
+
+class RoleTemplate(object):
+    """
+    A role config document compiled for rendering.
+    """
+    def __init__(self, spec):
+        """
+        :param dict spec: The role config, as loaded from JSON
+        :raises ValueError: if a string of the config is a malformed format
+        """
+        params = set()
+        self._tree = _compile(spec, params)
+        # Names of the parameters the config needs to be rendered
+        self.params = frozenset(params)
+
+    def validate(self, params):
+        """
+        Check that all the parameters the config needs are available.
+        :param params: mapping of parameter names to values
+        :raises KeyError: naming a missing parameter
+        """
+        missing = sorted(name for name in self.params if name not in params)
+        if missing:
+            raise KeyError(missing[0])
+
+    def render(self, params):
+        """
+        Fill in the config's format tokens.
+        :param params: mapping of parameter names to values
+        :return: a new copy of the config, callers are free to modify it
+        :raises KeyError: if a parameter is missing
+        """
+        return _render(self._tree, params)
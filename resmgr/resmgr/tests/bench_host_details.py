@@ -0,0 +1,100 @@
+# Copyright (c) 2016 Platform9 Systems Inc. All Rights Reserved.
+
+"""
+Benchmark for ResMgrDB.query_host_and_app_details, which the bbone poller
+calls at least twice per cycle. Populates a scratch sqlite database with the
+requested number of hosts, each with two roles and their rabbit credentials,
+and reports the number of SQL statements and the wall time of the query,
+both for a first call and for a repeated one.
+
+    python -m resmgr.tests.bench_host_details 1000 5000
+"""
+
+import copy
+import mock
+import os
+import sys
+import tempfile
+import time
+
+from io import StringIO
+from six.moves.configparser import ConfigParser
+from sqlalchemy import event
+from resmgr import dbutils
+from resmgr import migrate_db
+from resmgr import role_states
+from resmgr.tests.dbtestcase import RESMGR_CONF, TEST_HOST, TEST_ROLE
+
+ROLES = ('test-role', 'test-role-2')
+
+
+def _test_roles():
+    roles = copy.deepcopy(TEST_ROLE)
+    roles['test-role-2'] = copy.deepcopy(TEST_ROLE['test-role'])
+    roles['test-role-2']['1.0']['role_name'] = 'test-role-2'
+    roles['test-role-2']['1.0']['config']['test-role-2'] = \
+        roles['test-role-2']['1.0']['config'].pop('test-role')
+    return roles
+
+
+def _populate(db, num_hosts):
+    details = TEST_HOST['details']
+    with db.dbsession() as session:
+        for i in range(num_hosts):
+            host_id = 'host-%d' % i
+            session.add(dbutils.Host(id=host_id,
+                                     hostname='%s.platform9.sys' % host_id,
+                                     hostosfamily=details['os_family'],
+                                     hostarch=details['arch'],
+                                     hostosinfo=details['os_info'],
+                                     responding=True,
+                                     role_settings={}))
+            for rolename in ROLES:
+                session.add(dbutils.HostRoleAssociation(
+                    host_id=host_id, role_id='%s_1.0' % rolename,
+                    current_state=str(role_states.APPLIED)))
+                session.add(dbutils.RabbitCredential(
+                    host_id=host_id, rolename=rolename,
+                    userid='user-%d' % i, password='p@55wd'))
+
+
+def run(num_hosts):
+    fd, sqlite_file = tempfile.mkstemp(prefix='resmgr-bench-',
+                                       suffix='.sqlite')
+    os.close(fd)
+    cfg = ConfigParser()
+    cfg.read_file(StringIO(RESMGR_CONF % {'sqlite_temp_file': sqlite_file}))
+    try:
+        with mock.patch('resmgr.migrate_db._get_resmgr_db_url',
+                        return_value=cfg.get('database', 'sqlconnectURI')), \
+             mock.patch.object(dbutils.ResMgrDB, '_load_roles_from_files',
+                               return_value=_test_roles()), \
+             mock.patch.object(dbutils.SafeValue, 'get_resmgr_db_cipher_key',
+                               return_value='wjFGEGAmdEaaaaaa'):
+            migrate_db.migrate_db()
+            dbutils.engineHandle = None
+            db = dbutils.ResMgrDB(cfg)
+            _populate(db, num_hosts)
+
+            statements = []
+            def before_cursor_execute(conn, cursor, statement, *args):
+                statements.append(statement)
+            event.listen(db.dbengine, 'before_cursor_execute',
+                         before_cursor_execute)
+            # The second pass finds the rendered role configs in the cache
+            for run_name in ('cold', 'warm'):
+                del statements[:]
+                start = time.time()
+                hosts = db.query_host_and_app_details()
+                elapsed = time.time() - start
+                assert len(hosts) == num_hosts
+                print('%6d hosts (%s): %6d queries, %8.3f seconds' %
+                      (num_hosts, run_name, len(statements), elapsed))
+    finally:
+        dbutils.engineHandle = None
+        os.unlink(sqlite_file)
+
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:] or ['1000', '5000']:
+        run(int(arg))
@@ -4,6 +4,7 @@ import copy
 import logging
 import os
 
+from sqlalchemy import event
 from resmgr import dbutils
 from resmgr import role_states
 from resmgr.tests.dbtestcase import DbTestCase, TEST_HOST, TEST_ROLE
@@ -56,6 +57,18 @@ class TestDb(DbTestCase):
         self.assertEqual(applied_roleversion,
                           deets[host_id]['role_details'][0].version)
 
+    def test_query_host_and_app_details_by_ids(self):
+        self._add_host_with_customizable_role(None, '1.0',
+                                {'customizable_key': 'customizable_value'})
+        host_id = TEST_HOST['id']
+        deets = self._db.query_host_and_app_details(
+            host_ids=set([host_id, 'unknown']))
+        self.assertEqual([host_id], list(deets))
+        self.assertEqual({}, self._db.query_host_and_app_details(
+            host_ids=set(['unknown'])))
+        self.assertEqual({}, self._db.query_host_and_app_details(
+            host_ids=set()))
+
     def test_add_host_with_customizable_role(self):
         self._add_host_with_customizable_role(None, '1.0',
                                 {'customizable_key': 'customizable_value'})
@@ -243,6 +256,28 @@ class TestDb(DbTestCase):
         self.assertEqual(role_states.START_APPLY,
                           deets[host_id]['role_states']['test-role_1.0'])
 
+    def test_write_generation(self):
+        self._associate_role('test-role', None,
+                             {'customizable_key': 'customizable_value'},
+                             'rabbit', 'p@55wd')
+        host_id = TEST_HOST['id']
+        generation = self._db.write_generation
+        self._db.query_hosts()
+        self._db.get_all_role_associations(host_id)
+        self.assertFalse(self._db.advance_role_state(host_id, 'test-role',
+                                                     role_states.APPLIED,
+                                                     role_states.START_EDIT))
+        self.assertEqual(generation, self._db.write_generation)
+
+        self._db.mark_host_state(host_id, responding=False)
+        self.assertEqual(generation + 1, self._db.write_generation)
+        self.assertTrue(self._db.advance_role_state(host_id, 'test-role',
+                                                    role_states.NOT_APPLIED,
+                                                    role_states.START_APPLY))
+        self.assertEqual(generation + 2, self._db.write_generation)
+        self._db.remove_role_from_host(host_id, 'test-role')
+        self.assertEqual(generation + 3, self._db.write_generation)
+
     def test_move_new_state(self):
         self._associate_role('test-role', None,
                              {'customizable_key': 'customizable_value'},
@@ -294,3 +329,65 @@ class TestDb(DbTestCase):
         self.assertTrue(assocs)
         self.assertEqual(['test-role', 'test-role-2'],
                           sorted([a.role.rolename for a in assocs]))
+
+    def _count_host_details_queries(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(self._db.dbengine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            deets = self._db.query_host_and_app_details()
+        finally:
+            event.remove(self._db.dbengine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return deets, len(statements)
+
+    def test_host_details_query_count(self):
+        host = copy.deepcopy(TEST_HOST)
+        for i in range(5):
+            host_id = 'host-%d' % i
+            for rolename in ('test-role', 'test-role-2'):
+                self._db.insert_update_host(host_id, host['details'],
+                                            rolename, None, {})
+                self._db.associate_role_to_host(host_id, rolename)
+                self._db.associate_rabbit_credentials_to_host(
+                    host_id, rolename, 'rabbit-%d' % i, 'p@55wd')
+            if i == 0:
+                _, one_host_queries = self._count_host_details_queries()
+
+        # the number of queries doesn't grow with hosts and roles
+        deets, queries = self._count_host_details_queries()
+        self.assertEqual(one_host_queries, queries)
+        self.assertEqual(5, len(deets))
+        for i in range(5):
+            conf = deets['host-%d' % i]['apps_config_including_deauthed_roles']
+            self.assertEqual(['test-role', 'test-role-2'], sorted(conf))
+            self.assertEqual('rabbit-%d' % i, conf['test-role']['config'][
+                'test_conf']['DEFAULT']['rabbit_user'])
+
+    def test_rendered_config_cache(self):
+        self._associate_role('test-role', None,
+                             {'customizable_key': 'customizable_value'},
+                             'rabbit', 'p@55wd')
+        host_id = TEST_HOST['id']
+        config_params = self._db._flat_config()
+        flat_config = self._patchobj(dbutils.ResMgrDB, '_flat_config')
+        flat_config.return_value = config_params
+
+        def conf1():
+            deets = self._db.query_host_and_app_details()
+            return deets[host_id]['apps_config_including_deauthed_roles'][
+                'test-role']['config']['test_conf']['DEFAULT']['conf1']
+
+        # rendered once, then served from the cache
+        self.assertEqual('conf1_value', conf1())
+        self.assertEqual('conf1_value', conf1())
+        self.assertEqual(1, flat_config.call_count)
+
+        # a config change is picked up once the generation is bumped
+        flat_config.return_value['test-role.conf1'] = 'conf1_new_value'
+        self.assertEqual('conf1_value', conf1())
+        self._db.bump_config_generation()
+        self.assertEqual('conf1_new_value', conf1())
+        self.assertEqual(2, flat_config.call_count)
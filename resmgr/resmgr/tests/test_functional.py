@@ -130,3 +130,68 @@ class TestResMgr(FunctionalTest):
             LOG.info('test_delete_host_on_deauth_failure response body: %s',
                      resp.text)
             self.assertEqual(400, resp.status_code)
+
+    def test_get_hosts_etag(self):
+        resp = self.app.get('/v1/hosts')
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.etag)
+        self.assertEqual('application/json', resp.content_type)
+
+        resp = self.app.get('/v1/hosts',
+                            headers={'If-None-Match': '"%s"' % resp.etag})
+        self.assertEqual(304, resp.status_code)
+        self.assertFalse(resp.body)
+
+        resp = self.app.get('/v1/hosts', headers={'If-None-Match': '"other"'})
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.json_body)
+
+    def test_get_hosts_cached(self):
+        from resmgr.controllers import resmgr_controller
+        hosts = {'rsc_1': {'id': 'rsc_1', 'roles': []}}
+        with mock.patch.dict(resmgr_controller._hosts_responses, clear=True), \
+             mock.patch.object(ResMgrMemProvider, 'get_hosts_version',
+                               return_value=1) as get_version, \
+             mock.patch.object(ResMgrMemProvider, 'get_all_hosts',
+                               return_value=hosts) as get_all_hosts:
+            self.assertEqual([hosts['rsc_1']], self._get_hosts())
+            self.assertEqual([hosts['rsc_1']], self._get_hosts())
+            self.assertEqual(1, get_all_hosts.call_count)
+
+            # v2 responses with different parameters are cached separately
+            resp = self.app.get('/v2/hosts?role_settings=true')
+            self.assertEqual([hosts['rsc_1']], resp.json_body)
+            get_all_hosts.assert_called_with(role_settings=True)
+            self.assertEqual(2, get_all_hosts.call_count)
+
+            get_version.return_value = 2
+            hosts['rsc_1']['roles'] = ['test-role']
+            self.assertEqual([hosts['rsc_1']], self._get_hosts())
+            self.assertEqual(3, get_all_hosts.call_count)
+            # responses for the previous version are dropped
+            self.assertEqual(1, len(resmgr_controller._hosts_responses))
+            first_key = next(iter(resmgr_controller._hosts_responses))
+
+            # the least recently used responses are dropped
+            for limit in range(resmgr_controller._MAX_HOSTS_RESPONSES + 5):
+                self.app.get('/v1/hosts?limit=%d' % limit)
+            self.assertEqual(resmgr_controller._MAX_HOSTS_RESPONSES,
+                             len(resmgr_controller._hosts_responses))
+            self.assertNotIn(first_key, resmgr_controller._hosts_responses)
+
+    def test_get_hosts_params(self):
+        with mock.patch.object(ResMgrMemProvider, 'get_all_hosts',
+                               return_value={}) as get_all_hosts:
+            self.app.get('/v1/hosts?limit=10&marker=rsc_1&fields=roles,info'
+                         '&role=test-role&responding=true&role_status=ok&_=1')
+            get_all_hosts.assert_called_with(
+                role_settings=None, limit=10, marker='rsc_1',
+                fields=('info', 'roles'), role='test-role', responding=True,
+                role_status='ok')
+
+            self.app.get('/v2/hosts?role_settings=true&limit=1')
+            get_all_hosts.assert_called_with(role_settings=True, limit=1)
+
+            for query in ['limit=-1', 'responding=maybe', '_=1']:
+                resp = self.app.get('/v2/hosts?' + query, expect_errors=True)
+                self.assertEqual(400, resp.status_code)
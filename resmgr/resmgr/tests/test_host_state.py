@@ -0,0 +1,65 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved
+
+from unittest import TestCase
+from resmgr.host_state import HostStateStore, EMPTY_HOST_STATE
+
+class TestHostStateStore(TestCase):
+
+    def test_snapshots(self):
+        store = HostStateStore()
+        self.assertEqual({}, store.snapshot())
+        self.assertIsNone(store.get('host-1'))
+
+        store.update('host-1', role_status='ok', cert_info={'a': 1})
+        snap = store.snapshot()
+        self.assertIs(snap, store.snapshot())
+        self.assertEqual(EMPTY_HOST_STATE._replace(role_status='ok',
+                                                   cert_info={'a': 1}),
+                         snap['host-1'])
+
+        # later updates don't show up in a snapshot that's been handed out
+        store.update('host-1', role_status='failed')
+        store.update('host-2', extensions={'b': 2})
+        self.assertEqual('ok', snap['host-1'].role_status)
+        self.assertEqual(['host-1'], list(snap))
+        self.assertEqual('failed', store.get('host-1').role_status)
+        self.assertEqual({'a': 1}, store.get('host-1').cert_info)
+        # reading a record doesn't publish the pending updates
+        self.assertIs(snap, store._snapshot)
+
+        new_snap = store.snapshot()
+        self.assertEqual(set(['host-1', 'host-2']), set(new_snap))
+        self.assertIs(store.get('host-1'), store.snapshot()['host-1'])
+
+        self.assertEqual('failed', store.remove('host-1').role_status)
+        self.assertIsNone(store.remove('host-1'))
+        self.assertIn('host-1', new_snap)
+        self.assertEqual(['host-2'], list(store.snapshot()))
+
+    def test_modify(self):
+        store = HostStateStore()
+        def add_message(state):
+            return state._replace(message=dict(state.message or {},
+                                               warn=['msg']))
+        self.assertEqual({'warn': ['msg']},
+                         store.modify('host-1', add_message).message)
+        self.assertEqual({'warn': ['msg']}, store.get('host-1').message)
+        self.assertIsNone(store.get('host-1').unauthorized_host)
+
+    def test_version(self):
+        store = HostStateStore()
+        store.update('host-1', role_status='ok')
+        version = store.version
+        # no-op updates and removals leave the version alone
+        store.update('host-1', role_status='ok')
+        store.remove('host-2')
+        self.assertEqual(version, store.version)
+        # nor do the status timestamps, the API doesn't return them
+        store.update('host-1', status_time=1, status_time_on_du=2)
+        self.assertEqual(1, store.get('host-1').status_time)
+        self.assertEqual(version, store.version)
+        store.update('host-1', role_status='failed')
+        self.assertEqual(version + 1, store.version)
+        store.remove('host-1')
+        self.assertEqual(version + 2, store.version)
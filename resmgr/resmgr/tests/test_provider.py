@@ -22,6 +22,7 @@ from resmgr import resmgr_provider_pf9
 from resmgr import role_states
 from resmgr.exceptions import DuConfigError, RoleUpdateConflict, HostDown
 from resmgr.exceptions import RoleVersionExists, RoleVersionNotFound
+from resmgr.host_state import HostStateStore
 from resmgr.resmgr_provider_pf9 import ResMgrPf9Provider, BbonePoller
 from resmgr.resmgr_provider_pf9 import log as provider_logger
 from resmgr.tests.dbtestcase import DbTestCase
@@ -220,6 +221,7 @@ class TestProvider(DbTestCase):
         # FIXME: verify notifier calls
         self._patchfun('notifier.init')
         self._patchfun('notifier.publish_notification')
+        self._patchfun('notifier.subscribe')
 
         self._create_rabbit_user = self._patchobj(RabbitMgmtClient,
                                                   'create_user')
@@ -262,9 +264,25 @@ class TestProvider(DbTestCase):
         self._get_backbone_host_ids = \
             self._patchobj(BbonePoller, '_get_backbone_host_ids')
         self._get_backbone_host_ids.return_value = BBONE_IDS
-        self._get_backbone_host = \
-            self._patchobj(BbonePoller, '_get_backbone_host')
+        # Per-host backbone state is served by _get_backbone_host, through
+        # the bulk _get_backbone_hosts query.
+        self._get_backbone_host = mock.Mock()
         self._get_backbone_host.return_value = self._unauthed_host()
+        self._get_backbone_hosts = \
+            self._patchobj(BbonePoller, '_get_backbone_hosts')
+        self._get_backbone_hosts.side_effect = lambda host_ids: \
+            dict((host, self._get_backbone_host(host)) for host in host_ids)
+        # Unless a test says otherwise, every host changed since last poll.
+        self._changed_host_ids = BBONE_IDS
+        self._metrics_changed_host_ids = set()
+        self._get_backbone_host_changes = \
+            self._patchobj(BbonePoller, '_get_backbone_host_changes')
+        self._get_backbone_host_changes.side_effect = lambda since: {
+            'revision': since + 1,
+            'changed': list(self._changed_host_ids),
+            'metrics_changed': list(self._metrics_changed_host_ids),
+            'timestamps': {}
+        }
         self._responding_within_threshold = \
             self._patchobj(BbonePoller, '_responding_within_threshold')
         self._responding_within_threshold.return_value = True
@@ -289,15 +307,7 @@ class TestProvider(DbTestCase):
 
     @staticmethod
     def _reset_provider_global_state():
-        resmgr_provider_pf9._unauthorized_hosts = {}
-        resmgr_provider_pf9._unauthorized_host_status_time = {}
-        resmgr_provider_pf9._unauthorized_host_status_time_on_du = {}
-        resmgr_provider_pf9._authorized_host_role_status = {}
-        resmgr_provider_pf9._hosts_hypervisor_info = {}
-        resmgr_provider_pf9._hosts_extension_data = {}
-        resmgr_provider_pf9._hosts_cpuinfo_data = {}
-        resmgr_provider_pf9._hosts_message_data = {}
-        resmgr_provider_pf9._host_lock = threading.Lock()
+        resmgr_provider_pf9._host_state = HostStateStore()
         resmgr_provider_pf9._role_delete_lock = threading.RLock()
 
     def _assert_role_state(self, host_id, rolename, state):
@@ -561,6 +571,140 @@ class TestProvider(DbTestCase):
         hosts = self._inventory.get_all_hosts()
         self.assertFalse(hosts)
 
+    def test_unchanged_host_not_reconciled(self):
+        host_id = TEST_HOST['id']
+        rolename = TEST_ROLE['test-role']['1.0']['role_name']
+        self._add_and_converge_role(rolename)
+        self._requests_put.reset_mock()
+
+        # bbmaster reports no change for the host, its cached state is used
+        # and the converged host is left alone.
+        self._changed_host_ids = set()
+        self._get_backbone_host.return_value = self._empty_host()
+        self._bbone.process_hosts()
+        self.assertFalse(self._requests_put.called)
+
+        # once the change shows up, the configuration is pushed again
+        self._changed_host_ids = BBONE_IDS
+        self._bbone.process_hosts()
+        self._requests_put.assert_called_with(
+                'http://fake/v1/hosts/1234/apps',
+                match_dict_to_jsonified(BBONE_PUSH))
+        self._assert_role_state(host_id, rolename, role_states.APPLIED)
+
+    def test_metrics_changed_host(self):
+        host_id = TEST_HOST['id']
+        host = self._unauthed_host()
+        host['extensions']['resource_usage'] = {
+            'status': 'ok', 'data': {'cpu': {'percent': 75}}}
+        self._get_backbone_host.return_value = host
+
+        # Only the resource usage changed, it shows up in the host listing
+        self._changed_host_ids = set()
+        self._metrics_changed_host_ids = BBONE_IDS
+        self._bbone.process_hosts()
+        self._get_backbone_hosts.assert_called_with(BBONE_IDS)
+        hosts = self._inventory.get_all_hosts()
+        self.assertEqual(host['extensions'], hosts[host_id]['extensions'])
+
+    def test_host_change_events(self):
+        host_id = TEST_HOST['id']
+        calls = []
+        def process_hosts(**kwargs):
+            calls.append(kwargs)
+            if kwargs:
+                self._bbone.stop()
+        self._patchobj(BbonePoller, 'process_hosts').side_effect = \
+                process_hosts
+
+        # the first pass is a full sweep, after which the queued up change
+        # events for the host are processed together.
+        self._bbone.poll_interval = 3600
+        msg = {'change_type': 'change', 'obj_type': 'bbone_host',
+               'obj_id': host_id}
+        self._bbone.on_bbone_host_change(msg)
+        self._bbone.on_bbone_host_change(msg)
+        self._bbone.run()
+        self.assertEqual([{}, {'host_ids': set([host_id])}], calls)
+
+    def test_existing_hosts_sharded(self):
+        process_shard = self._patchobj(BbonePoller,
+                                       '_process_existing_host_shard')
+        self._bbone.host_workers = 3
+        host_ids = ['host-%d' % i for i in range(20)]
+        # the pool's worker threads need to really start
+        with mock.patch.object(threading.Thread, 'start',
+                               self._real_thread_start):
+            self._bbone._process_existing_hosts(host_ids, {}, {}, set())
+
+        # every host is handed to exactly one worker
+        shards = [call[0][0] for call in process_shard.call_args_list]
+        self.assertTrue(1 < len(shards) <= 3)
+        self.assertEqual(sorted(host_ids), sorted(sum(shards, [])))
+
+    def test_get_all_hosts_filters(self):
+        details = TEST_HOST['details']
+        for i in range(4):
+            host_id = 'host-%d' % i
+            self._db.insert_update_host(host_id, details, 'test-role', None, {})
+            if i % 2:
+                self._db.associate_role_to_host(host_id, 'test-role')
+        self._db.mark_host_state('host-3', responding=False)
+        host_state = resmgr_provider_pf9._host_state
+        host_state.update('host-1', role_status='ok', extensions={'ext': 1})
+        host_state.update('host-3', role_status='failed')
+        host_state.update('host-2a', unauthorized_host={
+            'id': 'host-2a', 'roles': [], 'info': {'hostname': 'unauth'}})
+
+        def host_ids(**kwargs):
+            return list(self._inventory.get_all_hosts(**kwargs))
+
+        # TEST_HOST is reported by bbone and unauthorized
+        self.assertEqual(['1234', 'host-0', 'host-1', 'host-2', 'host-2a',
+                          'host-3'], host_ids())
+        self.assertEqual(['1234', 'host-0'], host_ids(limit=2))
+        self.assertEqual(['host-0', 'host-1'], host_ids(marker='1234',
+                                                        limit=2))
+        self.assertEqual(['host-2', 'host-2a'],
+                         host_ids(marker='host-1', limit=2))
+        self.assertEqual(['host-3'], host_ids(marker='host-2a', limit=2))
+        self.assertEqual(['host-1', 'host-3'], host_ids(role='test-role'))
+        self.assertEqual(['host-3'], host_ids(responding=False))
+        self.assertEqual(['1234', 'host-0', 'host-1', 'host-2', 'host-2a'],
+                         host_ids(responding=True))
+        self.assertEqual(['host-1'], host_ids(role_status='ok'))
+        self.assertEqual(['host-3'], host_ids(role='test-role',
+                                              role_status='failed'))
+
+        hosts = self._inventory.get_all_hosts(fields=('roles', 'extensions'),
+                                              marker='host-0', limit=1,
+                                              role_settings=True)
+        self.assertEqual({'host-1': {'id': 'host-1', 'roles': ['test-role'],
+                                     'extensions': {'ext': 1}}}, hosts)
+        hosts = self._inventory.get_all_hosts(fields=('role_settings',),
+                                              role_settings=True)
+        self.assertEqual({'id': 'host-1', 'role_settings':
+                              self._db.get_all_custom_settings('host-1')},
+                         hosts['host-1'])
+        self.assertEqual({'id': 'host-2a'}, hosts['host-2a'])
+
+    def test_process_changed_hosts(self):
+        host_id = TEST_HOST['id']
+        self._get_backbone_host_ids.reset_mock()
+        self._get_backbone_hosts.reset_mock()
+        self._get_backbone_host_changes.reset_mock()
+        host = self._unauthed_host()
+        host['extensions'] = {'interfaces': {'status': 'ok', 'data': {}}}
+        self._get_backbone_host.return_value = host
+
+        # Only the changed host is looked up, without the changes feed
+        self._bbone.process_hosts(host_ids=set([host_id]))
+        self.assertFalse(self._get_backbone_host_ids.called)
+        self.assertFalse(self._get_backbone_host_changes.called)
+        self._get_backbone_hosts.assert_called_once_with(set([host_id]))
+        self.assertEqual(host['extensions'],
+                         resmgr_provider_pf9._host_state.get(host_id).extensions)
+
     def test_delete_one_role_keep_another(self):
         # add and converge both roles
         host_id = TEST_HOST['id']
@@ -0,0 +1,66 @@
+# Copyright 2018 Platform9 Systems Inc.
+# All Rights Reserved
+
+from unittest import TestCase
+from resmgr.role_template import RoleTemplate
+import json
+
+class TestRoleTemplate(TestCase):
+
+    spec = {
+        'app': {
+            'version': '1.0',
+            'count': 3,
+            'enabled': True,
+            'url': 'http://%(host)s:%(port)s/',
+            'config': {
+                'DEFAULT': {
+                    'host_id': '__HOST_ID__',
+                    'percent': '100%%',
+                    'servers': ['%(host)s', 'other'],
+                    'empty': None
+                },
+                '%(host_id)s': 'keyed by host'
+            }
+        }
+    }
+    params = {'host': 'example.com', 'port': '8080', 'host_id': '1234'}
+
+    def test_render(self):
+        orig_json = json.dumps(self.spec)
+        template = RoleTemplate(self.spec)
+        self.assertEqual(frozenset(['host', 'port', 'host_id']),
+                         template.params)
+
+        rendered = template.render(self.params)
+        # same as substituting into the serialized config
+        expected = json.loads(orig_json.replace('__HOST_ID__', '%(host_id)s')
+                              % self.params)
+        self.assertEqual(expected, rendered)
+        self.assertEqual('100%', rendered['app']['config']['DEFAULT']['percent'])
+
+        # the rendered config is a copy
+        rendered['app']['config']['DEFAULT']['servers'].append('new')
+        self.assertEqual(expected, template.render(self.params))
+        self.assertEqual(orig_json, json.dumps(self.spec))
+
+    def test_validate(self):
+        template = RoleTemplate(self.spec)
+        template.validate(self.params)
+
+        params = dict(self.params)
+        del params['port']
+        with self.assertRaises(KeyError):
+            template.validate(params)
+        with self.assertRaises(KeyError):
+            template.render(params)
+
+    def test_bad_format(self):
+        # The config could never be rendered, whatever the parameters
+        for bad in ['50%', '%(host)q', '%(host)s and %s']:
+            spec = {'app': {'url': 'http://%(host)s/', 'value': bad}}
+            with self.assertRaises(ValueError):
+                RoleTemplate(spec)
+        template = RoleTemplate({'app': {'port': '%(port)d', 'a': '50%%'}})
+        self.assertEqual({'app': {'port': '8080', 'a': '50%'}},
+                         template.render({'port': 8080}))